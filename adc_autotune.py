@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+"""
+Automatic choice of the ADC block size for continuous streams.
+
+Each ADC block makes one report. With small blocks, the reports come too often: above some
+400 reports per second, the USB backend may lose them (see usb_backend_process.py). With large
+blocks, each sample waits long before it is sent, so the latency grows. The AdcAutoTuner picks
+the block size from a target latency and a maximum report rate, and then watches the stream:
+
+  * if the device had to delay a block because USB was busy (block_delayed_by_usb), or if the
+    decoded reports pile up waiting for their callbacks, the block size is doubled;
+  * if the stream runs smoothly for a while with blocks larger than the target latency
+    requires, the block size is halved back towards it.
+
+Each change stops the ADC with adc_stop(), waits until the last block (which the firmware
+always finishes) arrives, and restarts adc() with the new block size. This makes a short gap
+in the data. Every decision is logged.
+
+    tuner = AdcAutoTuner(rp, callback=my_stage, channel_mask=0b11, clkdiv=95, target_latency_s=0.01)
+    tuner.start()
+    ...
+    tuner.stop()
+"""
+
+import logging
+import threading
+import time
+
+import adc_stream
+
+
+MAX_BLOCKSIZE = 8192        # limit given by the adc() command
+
+
+
+class AdcAutoTuner():
+    def __init__(self, rp, callback, channel_mask=1, clkdiv=95, target_latency_s=0.05, max_report_rate=300,
+            max_queue_depth=20, check_interval_s=0.5, relax_after_s=10., **adc_kwargs):
+        """
+        Each report is passed to *callback*. The *channel_mask* and *clkdiv* and other keyword
+        arguments are passed to adc(). The block size is kept so that blocks last at most
+        *target_latency_s* if possible, but reports never come more often than *max_report_rate*
+        per second. More than *max_queue_depth* reports waiting for their callback count as
+        an overload. The stream is checked every *check_interval_s*; the block size is only
+        decreased after *relax_after_s* without any overload.
+        """
+        self.rp, self.callback = rp, callback
+        self.channel_mask, self.clkdiv, self.adc_kwargs = channel_mask, clkdiv, adc_kwargs
+        self.channel_count = len(adc_stream.channels_from_mask(channel_mask))
+        self.total_rate = adc_stream.ADC_CLOCK_HZ / (clkdiv + 1)   # samples of all channels per second
+        self.target_latency_s, self.max_report_rate = target_latency_s, max_report_rate
+        self.max_queue_depth, self.check_interval_s, self.relax_after_s = max_queue_depth, check_interval_s, relax_after_s
+
+        self.min_blocksize = self._round(self.total_rate / max_report_rate, up=True)
+        self.target_blocksize = max(self._round(self.total_rate * target_latency_s), self.min_blocksize)
+        if self.target_blocksize > self._round(self.total_rate * target_latency_s):
+            logging.warning(f"ADC auto-tune: target latency {target_latency_s*1e3:.1f} ms would exceed " +
+                    f"{max_report_rate} reports/s, using {self.target_blocksize/self.total_rate*1e3:.1f} ms blocks")
+        self.blocksize = self.target_blocksize
+
+        self.lock = threading.Lock()
+        self.delayed_blocks, self.max_depth_seen, self.reports = 0, 0, 0
+        self.last_report_time = 0
+        self.running = threading.Event()
+        self.decisions = []     # (time, old blocksize, new blocksize, reason)
+
+    def _round(self, blocksize, up=False):
+        """ Whole rounds of all channels, so that each block starts at the first channel """
+        rounds = -(-blocksize // self.channel_count) if up else blocksize // self.channel_count
+        return int(min(max(rounds, 1) * self.channel_count, MAX_BLOCKSIZE // self.channel_count * self.channel_count))
+
+    def _queue_depth(self):
+        # (only decoded reports count; the report_queue holds USB byte chunks of any size)
+        return self.rp._i.async_report_cb_queue.qsize()
+
+    def _on_report(self, report):
+        with self.lock:
+            self.reports += 1
+            self.delayed_blocks += report.block_delayed_by_usb
+            self.max_depth_seen = max(self.max_depth_seen, self._queue_depth())
+            self.last_report_time = time.time()
+        self.callback(report)
+
+    def _start_adc(self):
+        self.rp.adc(channel_mask=self.channel_mask, blocksize=self.blocksize, clkdiv=self.clkdiv, infinite=1,
+                _callback=self._on_report, **self.adc_kwargs)
+
+    def start(self):
+        logging.info(f"ADC auto-tune: starting with blocksize {self.blocksize} " +
+                f"({self.blocksize/self.total_rate*1e3:.1f} ms, {self.total_rate/self.blocksize:.0f} reports/s)")
+        self.running.set()
+        self._start_adc()
+        self.thread = threading.Thread(target=self._tuner, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        self.thread.join()
+        self.rp.adc_stop()
+
+    def _restart(self, new_blocksize, reason):
+        old = self.blocksize
+        logging.info(f"ADC auto-tune: blocksize {old} -> {new_blocksize} " +
+                f"({new_blocksize/self.total_rate*1e3:.1f} ms, {self.total_rate/new_blocksize:.0f} reports/s): {reason}")
+        self.decisions.append((time.time(), old, new_blocksize, reason))
+        self.rp.adc_stop()
+
+        # The block being sampled is still finished and sent; a new adc() would disturb it
+        quiet_s = 2 * old / self.total_rate + 0.05
+        while time.time() - self.last_report_time < quiet_s:
+            time.sleep(quiet_s / 4)
+        self.blocksize = new_blocksize
+        with self.lock:     # only the reports of the new block size matter now
+            self.delayed_blocks, self.max_depth_seen, self.reports = 0, 0, 0
+        self._start_adc()
+
+    def _tuner(self):
+        calm_since, relax_after_s, relaxed_at = time.time(), self.relax_after_s, 0
+        while self.running.is_set():
+            time.sleep(self.check_interval_s)
+            with self.lock:
+                delayed, depth, reports = self.delayed_blocks, self.max_depth_seen, self.reports
+                self.delayed_blocks, self.max_depth_seen, self.reports = 0, 0, 0
+            if not self.running.is_set():
+                return
+
+            if (delayed or depth > self.max_queue_depth) and self.blocksize < self._round(MAX_BLOCKSIZE):
+                if time.time() - relaxed_at < relax_after_s:
+                    relax_after_s *= 2      # the smaller blocks did not work, wait longer before retrying
+                self._restart(self._round(self.blocksize * 2),
+                        f"{delayed} blocks delayed by USB, up to {depth} reports queued in {self.check_interval_s} s")
+                calm_since = time.time()
+            elif delayed or depth > self.max_queue_depth:
+                calm_since = time.time()
+                logging.warning(f"ADC auto-tune: overloaded ({delayed} blocks delayed, {depth} queued) " +
+                        "at the maximum blocksize")
+            elif self.blocksize > self.target_blocksize and time.time() - calm_since > relax_after_s:
+                self._restart(max(self._round(self.blocksize // 2), self.target_blocksize),
+                        f"no overload for {relax_after_s} s, returning towards the target latency")
+                calm_since = relaxed_at = time.time()
+
+
+
+if __name__ == "__main__":
+    # Self-check with a simulated device whose USB gets overloaded above 150 reports/s (no device needed)
+    from collections import namedtuple
+    import queue
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    Report = namedtuple('adc_report_values', ['channel_mask', 'blocks_to_send', 'block_delayed_by_usb', 'data'])
+
+    class SimulatedRp():
+        def __init__(self):
+            self._i = type('internals', (), {'async_report_cb_queue': queue.Queue()})()
+            self.stop_event, self.blocksizes = threading.Event(), []
+
+        def adc(self, channel_mask, blocksize, clkdiv, infinite, _callback):
+            self.stop_event = stop_event = threading.Event()
+            self.blocksizes.append(blocksize)
+            def run():
+                period = blocksize * (clkdiv + 1) / adc_stream.ADC_CLOCK_HZ
+                while not stop_event.is_set():
+                    time.sleep(period)
+                    _callback(Report(channel_mask, 0, int(1 / period > 150), [0] * blocksize))
+            threading.Thread(target=run, daemon=True).start()
+
+        def adc_stop(self):
+            self.stop_event.set()
+
+    rp, received = SimulatedRp(), []
+    tuner = AdcAutoTuner(rp, received.append, channel_mask=0b11, clkdiv=959, target_latency_s=0.002,
+            max_report_rate=400, check_interval_s=0.2, relax_after_s=1.)
+    tuner.start()
+    time.sleep(6)
+    tuner.stop()
+    print(f"Block sizes used: {rp.blocksizes}; {len(received)} reports received")
+    assert rp.blocksizes[:3] == [126, 252, 504] and max(rp.blocksizes) == 504   # 50 kS/s / 504 < 150 reports/s
+    relax_waits = [reason for t, old, new, reason in tuner.decisions if new < old]
+    assert relax_waits[:2] == ["no overload for 1.0 s, returning towards the target latency", 
+            "no overload for 2.0 s, returning towards the target latency"]   # failed attempts back off
@@ -0,0 +1,276 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+"""
+Fan-out of a streamed ADC signal to other processes through shared memory.
+
+The publisher is a stage of the ADC stream (see adc_stream.py) which writes each block of
+samples into a ring of slots in a `multiprocessing.shared_memory` segment. Any number of
+subscribers, in any processes, attach to the segment by its name and read the blocks as
+read-only NumPy views, without the data being pickled or copied for each of them.
+
+Each block gets a sequence number. The ring does not wait for slow subscribers: a subscriber
+which falls behind by more than the ring length skips the lost blocks and counts them as
+overruns. Since the views point directly into the ring, a block can also be overwritten while
+it is being processed; `is_valid(block)` tells whether it was not (or use `copy=True`).
+
+In the acquiring process:
+
+    publisher = adc_shared_memory.publish_adc(rp, channel_mask=0b11, blocksize=2000, clkdiv=95)
+    # ... start workers with publisher.name ...
+    publisher.stop(rp)      # adc_stop(), then close() once the last block arrived
+
+In each worker process:
+
+    for block in adc_shared_memory.AdcSubscriber(name):
+        analyze(block.data)     # (channel_count, n) uint16 array
+"""
+
+from collections import namedtuple
+from multiprocessing import shared_memory
+import threading
+import time
+
+import numpy as np
+
+import adc_stream
+
+
+# Layout of the segment: a header, then per-slot metadata, then the sample data of all slots
+HEADER_FIELDS = ['magic', 'channel_mask', 'clkdiv', 'slot_samples', 'slot_count', 'write_seq', 'closed']
+MAGIC = 0x72703264_61710001     # identifies the layout version
+META_FIELDS = ['seq', 'sample_count', 'start_time_us', 'end_time_us']
+
+SharedBlock = namedtuple('SharedBlock', ['seq', 'start_time_us', 'end_time_us', 'data'])
+
+
+
+def attach(name):
+    """ Opens an existing shared memory segment, without taking over the responsibility to free it """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:   # Python < 3.13 would unlink the segment when this process ends
+        from multiprocessing import resource_tracker
+        register, resource_tracker.register = resource_tracker.register, lambda *args: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+
+def _segment_arrays(buf, channel_count, slot_samples, slot_count):
+    header = np.ndarray((len(HEADER_FIELDS),), dtype=np.int64, buffer=buf)
+    meta = np.ndarray((slot_count, len(META_FIELDS)), dtype=np.int64, buffer=buf, offset=header.nbytes)
+    data = np.ndarray((slot_count, channel_count, slot_samples), dtype=np.uint16, buffer=buf,
+            offset=header.nbytes + meta.nbytes)
+    return header, meta, data
+
+
+
+class AdcPublisher():
+    def __init__(self, channel_mask=1, clkdiv=95, slot_samples=4000, slot_count=64, name=None):
+        """
+        Creates the shared memory ring for *slot_count* blocks of up to *slot_samples* samples
+        per channel. The *channel_mask* and *clkdiv* must match those given to adc(); they are
+        stored in the segment for the subscribers.
+        """
+        self.channels = adc_stream.channels_from_mask(channel_mask)
+        size = 8*len(HEADER_FIELDS) + 8*len(META_FIELDS)*slot_count + 2*len(self.channels)*slot_samples*slot_count
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.name = self.shm.name
+        self.header, self.meta, self.data = _segment_arrays(self.shm.buf, len(self.channels), slot_samples, slot_count)
+        self.slot_samples, self.slot_count = slot_samples, slot_count
+        self.block_duration_s = slot_samples / adc_stream.sample_rate(clkdiv, channel_mask)
+        self.lock = threading.Lock()    # close() must not free the ring while a block is written
+        self.closed = False
+        self.last_report_time = time.time()
+
+        self.meta[:, 0] = -1
+        self.header[:] = [0, channel_mask, clkdiv, slot_samples, slot_count, 0, 0]
+        self.header[0] = MAGIC    # written last, marks the segment as ready
+
+    def __call__(self, report):
+        self.last_report_time = time.time()
+        self.publish(adc_stream.split_channels(report), report.start_time_us, report.end_time_us)
+
+    def publish(self, block, start_time_us=0, end_time_us=0):
+        """
+        Writes a (channel_count, n) array of samples into the next slot, returns its sequence number.
+        Once the publisher is closed, the blocks still coming from the device are dropped (returns None).
+        """
+        n = block.shape[1]
+        if n > self.slot_samples:
+            raise ValueError(f"Block of {n} samples per channel does not fit into a slot of {self.slot_samples}")
+        with self.lock:
+            if self.closed:
+                return None
+            return self._write(block, n, start_time_us, end_time_us)
+
+    def _write(self, block, n, start_time_us, end_time_us):
+        seq = int(self.header[5])
+        slot = seq % self.slot_count
+
+        # Subscribers check the slot's sequence number before and after reading, so it must be
+        # invalidated during writing
+        self.meta[slot, 0] = -1
+        self.data[slot, :, :n] = block
+        self.meta[slot, 1:] = n, start_time_us, end_time_us
+        self.meta[slot, 0] = seq
+        self.header[5] = seq + 1
+        return seq
+
+    def close(self):
+        """ Tells the subscribers that the stream ended, and frees the shared memory """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.header[6] = 1
+            del self.header, self.meta, self.data   # no views may remain before the buffer is released
+            self.shm.close()
+            self.shm.unlink()
+
+    def stop(self, rp):
+        """
+        Stops the ADC stream by rp.adc_stop() and closes the publisher after the last block, which
+        the firmware still finishes and sends, has been published.
+        """
+        rp.adc_stop()
+        quiet_s = 2 * self.block_duration_s + 0.05
+        while time.time() - self.last_report_time < quiet_s:
+            time.sleep(quiet_s / 4)
+        self.close()
+
+
+
+def publish_adc(rp, channel_mask=1, blocksize=1000, clkdiv=95, slot_count=64, **kwargs):
+    """
+    Starts an infinite ADC stream on the device and publishes it in shared memory. Returns the
+    AdcPublisher; its `name` is what the subscribers need. Other keyword arguments are passed
+    to adc(). Stop the stream by `publisher.stop(rp)`, which calls `rp.adc_stop()` and closes
+    the publisher once the last block arrived.
+    """
+    publisher = AdcPublisher(channel_mask=channel_mask, clkdiv=clkdiv,
+            slot_samples=-(-blocksize // len(adc_stream.channels_from_mask(channel_mask))), slot_count=slot_count)
+    rp.adc(channel_mask=channel_mask, blocksize=blocksize, clkdiv=clkdiv, infinite=1, _callback=publisher, **kwargs)
+    return publisher
+
+
+
+class AdcSubscriber():
+    def __init__(self, name, copy=False, poll_interval=0.0005, from_oldest=False):
+        """
+        Attaches to the ring of the publisher with given *name*. By default, reading starts
+        with the next published block; with *from_oldest*, it starts with the oldest block
+        still in the ring. With *copy*, the blocks are copied out of the ring, so that they
+        can not be overwritten later.
+        """
+        self.shm = attach(name)
+        header = np.ndarray((len(HEADER_FIELDS),), dtype=np.int64, buffer=self.shm.buf)
+        if header[0] != MAGIC:
+            raise RuntimeError(f"Shared memory {name} does not contain an ADC stream")
+        self.channel_mask, self.clkdiv, self.slot_samples, self.slot_count = [int(x) for x in header[1:5]]
+        self.channels = adc_stream.channels_from_mask(self.channel_mask)
+        self.rate = adc_stream.sample_rate(self.clkdiv, self.channel_mask)
+        self.header, self.meta, data = _segment_arrays(self.shm.buf, len(self.channels), self.slot_samples, self.slot_count)
+        self.data = data.view()
+        self.data.flags.writeable = False
+
+        write_seq = int(self.header[5])
+        self.next_seq = max(write_seq - self.slot_count + 1, 0) if from_oldest else write_seq
+        self.copy, self.poll_interval = copy, poll_interval
+        self.overruns = 0    # number of blocks lost by falling behind
+
+    def __iter__(self):
+        while True:
+            block = self.read()
+            if block is None:
+                return
+            yield block
+
+    def read(self, timeout=None):
+        """
+        Returns the next SharedBlock, waiting for it if needed. Returns None if the stream was
+        closed (or if *timeout* in seconds passed).
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            write_seq = int(self.header[5])
+            if self.next_seq < write_seq - self.slot_count + 1:  # the slot being written is lost, too
+                lost = write_seq - self.slot_count + 1 - self.next_seq
+                self.overruns += lost
+                self.next_seq += lost
+            if self.next_seq < write_seq:
+                slot = self.next_seq % self.slot_count
+                seq, n, start_time_us, end_time_us = [int(x) for x in self.meta[slot]]
+                data = self.data[slot, :, :n]
+                if self.copy:
+                    data = data.copy()
+                if seq == self.next_seq and self.meta[slot, 0] == seq:
+                    self.next_seq += 1
+                    return SharedBlock(seq=seq, start_time_us=start_time_us, end_time_us=end_time_us, data=data)
+                continue   # overwritten meanwhile, the next loop counts it as overrun
+            if self.header[6] or (deadline is not None and time.time() > deadline):
+                return None
+            time.sleep(self.poll_interval)
+
+    def is_valid(self, block):
+        """ True if the block was not overwritten in the ring since it was read """
+        return int(self.meta[block.seq % self.slot_count, 0]) == block.seq
+
+    def close(self):
+        del self.header, self.meta, self.data
+        self.shm.close()
+
+
+
+def _benchmark_worker(name, slow, results):
+    subscriber = AdcSubscriber(name, from_oldest=True)
+    checksum, blocks = 0, 0
+    for block in subscriber:
+        value = int(block.data[:, 0].astype(np.int64).sum())
+        if slow:
+            time.sleep(0.002)
+        if subscriber.is_valid(block):  # a slow reader may see the block overwritten
+            checksum += value
+            blocks += 1
+    results.put((slow, blocks, subscriber.overruns, checksum))
+    subscriber.close()
+
+
+
+if __name__ == "__main__":
+    # Self-check and benchmark with worker processes (does not need any device)
+    import multiprocessing
+
+    block_count, blocksize = 2000, 4000
+    publisher = AdcPublisher(channel_mask=0b11, clkdiv=95, slot_samples=blocksize//2, slot_count=64)
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_benchmark_worker, args=(publisher.name, slow, results))
+            for slow in (False, False, False, True)]
+    for w in workers:
+        w.start()
+    time.sleep(1)   # let all workers attach
+
+    rng = np.random.default_rng(0)
+    blocks = rng.integers(0, 4096, size=(16, 2, blocksize//2), dtype=np.uint16)
+    t0 = time.time()
+    for i in range(block_count):
+        publisher.publish(blocks[i % 16], start_time_us=i)
+        time.sleep(0.0002)   # like the device stream, not as fast as the CPU can go
+    dt = time.time() - t0
+    time.sleep(0.5)
+    publisher.close()
+    assert publisher.publish(blocks[0]) is None     # a block coming late after close() is dropped
+    print(f"Published {block_count*blocksize} samples in {dt:.3f} s, {block_count*blocksize/dt/1e6:.1f} MS/s")
+
+    expected = sum(int(blocks[i % 16, :, 0].astype(np.int64).sum()) for i in range(block_count))
+    for w in workers:
+        slow, count, overruns, checksum = results.get()
+        print(f"{'slow' if slow else 'fast'} subscriber: {count} valid blocks, {overruns} overruns")
+        if not slow:
+            assert count == block_count and overruns == 0 and checksum == expected
+        else:
+            assert overruns > 0 and count + overruns <= block_count
+    for w in workers:
+        w.join()
@@ -0,0 +1,590 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+"""
+Building blocks for processing continuously streamed ADC data.
+
+When the ADC runs with `rp.adc(infinite=1, _callback=...)`, each report brings one block of
+samples from all enabled channels, interleaved in ascending order of channel number. The
+helpers below convert such reports into NumPy arrays; the processing stages (defined in this
+module and elsewhere) are callable objects which can be passed directly as the `_callback`,
+or called from a user callback with the report.
+
+    stage = SomeStage(...)
+    rp.adc(channel_mask=0b11, blocksize=2000, infinite=1, clkdiv=95, _callback=stage)
+"""
+
+from collections import deque, namedtuple
+
+import numpy as np
+
+
+ADC_CLOCK_HZ = 48_000_000
+ADC_CHANNEL_NAMES = {0:"GPIO 26", 1:"GPIO 27", 2:"GPIO 28", 3:"ref V", 4:"builtin thermometer"}
+
+
+
+def channels_from_mask(channel_mask):
+    """ Returns the list of ADC channel numbers enabled by the bit mask, in the order of sampling """
+    return [ch for ch in range(5) if channel_mask & (1<<ch)]
+
+
+
+def sample_rate(clkdiv, channel_mask=1):
+    """ Sampling rate per channel in Hz, for the clkdiv and channel_mask values given to adc() """
+    return ADC_CLOCK_HZ / (clkdiv + 1) / len(channels_from_mask(channel_mask))
+
+
+
+def split_channels(report):
+    """
+    Returns a 2D uint16 array of shape (channel_count, samples_per_channel) from an ADC report.
+    Each block starts at the first enabled channel; if the blocksize is not a multiple of the
+    channel count, the incomplete last round of samples is dropped.
+    """
+    channel_count = len(channels_from_mask(report.channel_mask))
+    data = np.asarray(report.data, dtype=np.uint16)
+    return data[:len(data)//channel_count*channel_count].reshape(-1, channel_count).T
+
+
+
+TriggerFrame = namedtuple('TriggerFrame', ['index', 'time_us', 'data'])
+TriggerStats = namedtuple('TriggerStats', ['frames', 'triggers_skipped', 'trigger_rate_hz', 'dead_time_fraction', 'elapsed_s'])
+
+
+
+class SoftwareTrigger():
+    def __init__(self, channel_mask=1, clkdiv=95, channel=None, mode='rising', level=2048, hysteresis=0, 
+            window=(1024, 3072), pre_samples=500, post_samples=500, holdoff_samples=0, callback=None, max_frames=100):
+        """
+        Searches the streamed data of one ADC *channel* (by default the first enabled) for trigger 
+        events, and captures frames of all channels around them: *pre_samples* before and 
+        *post_samples* after (and including) the trigger sample.
+
+        The *mode* can be 'rising', 'falling' or 'either' (crossing of the *level*), or 'window_exit' 
+        and 'window_enter' (leaving or entering the range given by *window*). The *hysteresis* 
+        requires the signal to first return by so many ADC units below the level (or inside the 
+        window) before another trigger, which suppresses repeated triggering by noise.
+
+        After each trigger, next triggers are ignored until its post-trigger samples and 
+        *holdoff_samples* pass. Each frame is passed to the *callback*; if there is none, it is 
+        appended to the `frames` deque, which keeps the last *max_frames*.
+        """
+        assert mode in ('rising', 'falling', 'either', 'window_exit', 'window_enter')
+        self.channels = channels_from_mask(channel_mask)
+        self.rate = sample_rate(clkdiv, channel_mask)
+        self.row = self.channels.index(self.channels[0] if channel is None else channel)
+        self.mode, self.level, self.hysteresis, self.window = mode, level, hysteresis, window
+        self.pre, self.post, self.holdoff = pre_samples, post_samples, holdoff_samples
+        self.callback = callback
+        self.frames = deque(maxlen=max_frames)
+
+        self.ring = np.zeros((len(self.channels), 0), dtype=np.uint16) # pre-trigger history, allocated on 1st block
+        self.total = 0               # samples per channel received so far
+        self.state = -1              # hysteresis state carried over blocks; -1 = unknown
+        self.next_allowed = pre_samples
+        self.pending = []            # (index, time_us) of triggers waiting for their post-trigger samples
+        self.frame_count, self.triggers_skipped, self.dead_samples = 0, 0, 0
+
+    def __call__(self, report):
+        self.process(split_channels(report), report.start_time_us)
+
+    def _states(self, x):
+        """ Returns 0/1 state of each sample (i.e. below/above level, or inside/outside window) """
+        mark = np.full(len(x), -1, dtype=np.int8)
+        if self.mode.startswith('window'):
+            low, high = self.window
+            mark[(x >= low + self.hysteresis) & (x <= high - self.hysteresis)] = 0
+            mark[(x < low) | (x > high)] = 1
+        elif self.mode == 'falling':
+            mark[x <= self.level] = 0
+            mark[x > self.level + self.hysteresis] = 1
+        else:
+            mark[x < self.level - self.hysteresis] = 0
+            mark[x >= self.level] = 1
+
+        # Samples within the hysteresis band keep the last defined state
+        last = np.maximum.accumulate(np.where(mark >= 0, np.arange(len(x)), -1))
+        return np.where(last >= 0, mark[last], self.state)
+
+    def process(self, block, start_time_us=0):
+        """ Processes a (channel_count, n) array of new samples """
+        n, first_index = block.shape[1], self.total
+        if self.ring.shape[1] < self.pre + self.post + n:
+            self._resize_ring(self.pre + self.post + n)
+        cap = self.ring.shape[1]
+        self.ring[:, np.arange(first_index, first_index + n) % cap] = block
+        self.total += n
+
+        state = self._states(block[self.row].astype(np.int32))
+        prev = np.concatenate(([self.state], state[:-1]))
+        self.state = state[-1]
+        if self.mode in ('rising', 'window_exit'):
+            edges = (prev == 0) & (state == 1)
+        elif self.mode in ('falling', 'window_enter'):
+            edges = (prev == 1) & (state == 0)
+        else:
+            edges = (prev >= 0) & (prev != state)
+        candidates = np.flatnonzero(edges) + first_index
+
+        # Hold-off: jump over all candidates until the next allowed one
+        i = int(np.searchsorted(candidates, self.next_allowed))
+        self.triggers_skipped += i
+        while i < len(candidates):
+            t = int(candidates[i])
+            self.pending.append((t, start_time_us + (t - first_index) / self.rate * 1e6))
+            self.next_allowed = t + self.post + self.holdoff
+            self.dead_samples += self.post + self.holdoff
+            j = int(np.searchsorted(candidates, self.next_allowed))
+            self.triggers_skipped += j - i - 1
+            i = j
+
+        while self.pending and self.pending[0][0] + self.post <= self.total:
+            t, time_us = self.pending.pop(0)
+            frame = TriggerFrame(index=t, time_us=time_us, 
+                    data=self.ring[:, np.arange(t - self.pre, t + self.post) % cap])
+            self.frame_count += 1
+            if self.callback:
+                self.callback(frame)
+            else:
+                self.frames.append(frame)
+
+    def _resize_ring(self, capacity):
+        old, cap = self.ring, self.ring.shape[1]
+        self.ring = np.zeros((len(self.channels), capacity), dtype=np.uint16)
+        if cap:
+            kept = min(cap, self.total)
+            idx = np.arange(self.total - kept, self.total)
+            self.ring[:, idx % capacity] = old[:, idx % cap]
+
+    def stats(self):
+        elapsed_s = self.total / self.rate
+        return TriggerStats(frames=self.frame_count, triggers_skipped=self.triggers_skipped,
+                trigger_rate_hz=self.frame_count / elapsed_s if elapsed_s else 0.,
+                dead_time_fraction=min(self.dead_samples / self.total, 1.) if self.total else 0.,
+                elapsed_s=elapsed_s)
+
+
+
+ChannelStatistics = namedtuple('ChannelStatistics', ['channels', 'count', 'mean', 'std', 'rms', 'min', 'max', 
+        'histogram', 'bin_width', 'time_span_s'])
+
+
+
+class StreamStatistics():
+    def __init__(self, channel_mask=1, clkdiv=95, window_s=None, segments=16, bins=4096):
+        """
+        Keeps running statistics of each channel: mean and variance (by Welford's algorithm, 
+        merged block-wise), extremes and a histogram of the 12-bit values in *bins* bins.
+
+        By default, the statistics are cumulative since the start. With *window_s*, they cover 
+        only the last *window_s* seconds: the window is divided into *segments* buckets, each 
+        keeping its own statistics, and the oldest bucket is reset whenever a new one starts. 
+        The window thus slides in steps of window_s/segments, and the memory used is constant.
+
+        The producer never waits for readers: `snapshot()` can be called from any thread, and 
+        simply retries if a block was being added meanwhile.
+        """
+        assert 4096 % bins == 0, "Number of bins must divide 4096"
+        self.channels = channels_from_mask(channel_mask)
+        self.rate = sample_rate(clkdiv, channel_mask)
+        self.bins, self.bin_shift = bins, (4096 // bins).bit_length() - 1
+        self.bucket_count = segments if window_s else 1
+        self.bucket_len = max(int(window_s * self.rate) // segments, 1) if window_s else None
+
+        b, c = self.bucket_count, len(self.channels)
+        self.n = np.zeros(b, dtype=np.int64)
+        self.mean, self.m2 = np.zeros((b, c)), np.zeros((b, c))
+        self.min, self.max = np.full((b, c), 4095, dtype=np.uint16), np.zeros((b, c), dtype=np.uint16)
+        self.hist = np.zeros((b, c, bins), dtype=np.int64)
+        self.total = 0       # samples per channel received so far
+        self.version = 0     # odd while the producer updates the buckets
+
+    def __call__(self, report):
+        self.process(split_channels(report))
+
+    def process(self, block):
+        """ Adds a (channel_count, n) array of new samples """
+        self.version += 1
+        pos = 0
+        while pos < block.shape[1]:
+            if self.bucket_len:  # split the block at bucket boundaries
+                bucket, offset = divmod(self.total, self.bucket_len)
+                bucket %= self.bucket_count
+                part = block[:, pos:pos + self.bucket_len - offset]
+                if offset == 0:
+                    self._reset(bucket)
+            else:
+                bucket, part = 0, block
+            self._add(bucket, part)
+            pos += part.shape[1]
+            self.total += part.shape[1]
+        self.version += 1
+
+    def _reset(self, bucket):
+        self.n[bucket] = 0
+        self.mean[bucket], self.m2[bucket] = 0, 0
+        self.min[bucket], self.max[bucket] = 4095, 0
+        self.hist[bucket] = 0
+
+    def _add(self, bucket, x):
+        nb = x.shape[1]
+        block_mean = x.mean(axis=1)
+        block_m2 = ((x - block_mean[:, None])**2).sum(axis=1)
+        na, n = self.n[bucket], self.n[bucket] + nb
+        delta = block_mean - self.mean[bucket]
+        self.mean[bucket] += delta * (nb / n)
+        self.m2[bucket] += block_m2 + delta**2 * (na * nb / n)
+        self.n[bucket] = n
+
+        np.minimum(self.min[bucket], x.min(axis=1), out=self.min[bucket])
+        np.maximum(self.max[bucket], x.max(axis=1), out=self.max[bucket])
+        offsets = np.arange(len(self.channels))[:, None] * self.bins
+        self.hist[bucket] += np.bincount(((x >> self.bin_shift) + offsets).ravel(), 
+                minlength=len(self.channels) * self.bins).reshape(len(self.channels), self.bins)
+
+    def snapshot(self):
+        """ Returns ChannelStatistics with one value (or histogram) per channel """
+        while True:
+            version = self.version
+            n, mean, m2 = self.n.copy(), self.mean.copy(), self.m2.copy()
+            mins, maxs, hist = self.min.copy(), self.max.copy(), self.hist.copy()
+            if version == self.version and not version % 2:
+                break
+
+        used = n > 0
+        n, mean, m2, mins, maxs, hist = n[used], mean[used], m2[used], mins[used], maxs[used], hist[used]
+        count = int(n.sum())
+        if not count:
+            nan = np.full(len(self.channels), np.nan)
+            return ChannelStatistics(channels=self.channels, count=0, mean=nan, std=nan, rms=nan, min=nan, max=nan,
+                    histogram=np.zeros((len(self.channels), self.bins), dtype=np.int64), 
+                    bin_width=4096 // self.bins, time_span_s=0.)
+        total_mean = (n[:, None] * mean).sum(axis=0) / count
+        total_m2 = (m2 + n[:, None] * (mean - total_mean)**2).sum(axis=0)
+        return ChannelStatistics(channels=self.channels, count=count, mean=total_mean, 
+                std=np.sqrt(total_m2 / count), rms=np.sqrt(total_mean**2 + total_m2 / count),
+                min=mins.min(axis=0), max=maxs.max(axis=0), histogram=hist.sum(axis=0), 
+                bin_width=4096 // self.bins, time_span_s=count / self.rate)
+
+
+
+SpectrogramRow = namedtuple('SpectrogramRow', ['time_s', 'psd'])
+
+
+
+class SpectralAnalyzer():
+    def __init__(self, clkdiv=95, channel_mask=None, segment_length=1024, overlap=0.5, window='hann', 
+            averages=None, spectrogram_rows=0, callback=None):
+        """
+        Computes the power spectral density of each channel by Welch's method: the stream is cut 
+        into segments of *segment_length* samples, overlapping by the *overlap* fraction, also 
+        across the block boundaries. Each segment has its mean removed, is multiplied by the 
+        *window* ('hann', 'hamming', 'blackman' or 'boxcar') and transformed; all segments 
+        completed by a block are processed as one batch.
+
+        The PSD (in ADC units squared per Hz) is averaged over all segments so far or, if 
+        *averages* is given, exponentially over roughly that many last segments. The sampling 
+        rate is computed from *clkdiv* and the channel count, which is taken from the first 
+        report if no *channel_mask* is given.
+
+        If *spectrogram_rows* is nonzero, the PSD of each segment is also kept in the 
+        `spectrogram` deque of SpectrogramRows, and/or passed to the *callback*.
+        """
+        self.clkdiv, self.segment_length = clkdiv, segment_length
+        self.hop = max(int(round(segment_length * (1 - overlap))), 1)
+        self.window = {'hann': np.hanning, 'hamming': np.hamming, 'blackman': np.blackman, 
+                'boxcar': np.ones}[window](segment_length)
+        self.averages, self.callback = averages, callback
+        self.spectrogram = deque(maxlen=spectrogram_rows or None) if spectrogram_rows else None
+        if channel_mask is not None:
+            self._reset(channel_mask)
+        else:
+            self.channel_mask = None
+
+    def _reset(self, channel_mask):
+        self.channel_mask = channel_mask
+        self.channels = channels_from_mask(channel_mask)
+        self.rate = sample_rate(self.clkdiv, channel_mask)
+        self.frequencies = np.fft.rfftfreq(self.segment_length, 1 / self.rate)
+
+        # One-sided density scaling, so that the PSD integrates to the signal variance
+        self.scale = np.full(len(self.frequencies), 2 / (self.rate * (self.window**2).sum()))
+        self.scale[0] /= 2
+        if not self.segment_length % 2:
+            self.scale[-1] /= 2
+
+        self.buffer = np.zeros((len(self.channels), 0))
+        self.buffer_start = 0    # index of the first buffered sample since the stream start
+        self.psd_sum = np.zeros((len(self.channels), len(self.frequencies)))
+        self.segment_count = 0
+
+    def __call__(self, report):
+        if report.channel_mask != self.channel_mask:
+            self._reset(report.channel_mask)
+        self.process(split_channels(report))
+
+    def process(self, block):
+        """ Adds a (channel_count, n) array of new samples """
+        buf = np.concatenate((self.buffer, block), axis=1)
+        count = (buf.shape[1] - self.segment_length) // self.hop + 1 if buf.shape[1] >= self.segment_length else 0
+        if count:
+            segments = np.lib.stride_tricks.sliding_window_view(buf, self.segment_length, axis=1)[:, ::self.hop][:, :count]
+            segments = (segments - segments.mean(axis=2, keepdims=True)) * self.window
+            power = np.abs(np.fft.rfft(segments, axis=2))**2 * self.scale    # (channels, count, frequencies)
+
+            if self.averages:
+                # exponential averaging, done per segment in a vectorized form
+                alpha = 1 / self.averages
+                weights = alpha * (1 - alpha)**np.arange(count - 1, -1, -1)
+                self.psd_sum = self.psd_sum * (1 - alpha)**count + np.einsum('k,ckf->cf', weights, power)
+            else:
+                self.psd_sum += power.sum(axis=1)
+            self.segment_count += count
+
+            if self.spectrogram is not None or self.callback:
+                centers = self.buffer_start + np.arange(count) * self.hop + self.segment_length / 2
+                for time_s, row in zip(centers / self.rate, power.transpose(1, 0, 2)):
+                    row = SpectrogramRow(time_s=time_s, psd=row)
+                    if self.spectrogram is not None:
+                        self.spectrogram.append(row)
+                    if self.callback:
+                        self.callback(row)
+
+        self.buffer = buf[:, count * self.hop:]
+        self.buffer_start += count * self.hop
+
+    def psd(self):
+        """ Returns the frequencies (Hz) and the averaged PSD as a (channel_count, frequencies) array """
+        if self.averages:
+            # normalize the exponential average while it is still starting up
+            return self.frequencies, self.psd_sum / (1 - (1 - 1 / self.averages)**max(self.segment_count, 1))
+        return self.frequencies, self.psd_sum / max(self.segment_count, 1)
+
+
+
+SYS_CLOCK_HZ = 250_000_000      # set in rp2daq.c; PWM frequencies derive from it
+
+
+
+def pwm_frequency(wrap_value=999, clkdiv=1, clkdiv_int_frac=0):
+    """ Frequency in Hz of the PWM cycle, for the parameters given to pwm_configure_pair() """
+    return SYS_CLOCK_HZ / ((wrap_value + 1) * (clkdiv + clkdiv_int_frac / 16))
+
+
+
+def _lowpass(x, a, state):
+    """
+    First-order IIR filter y[n] = a*y[n-1] + (1-a)*x[n] of a complex array, starting from 
+    *state* = y[-1]. Vectorized by cumulative sums in chunks short enough that the scaling 
+    factors a**-k stay well within the float range. Returns the output and the new state.
+    """
+    out = np.empty_like(x)
+    chunk = max(int(20 / -np.log(a)), 1)
+    for i in range(0, len(x), chunk):
+        k = np.arange(min(chunk, len(x) - i))
+        y = a**k * (state * a + (1 - a) * np.cumsum(x[i:i+chunk] * a**-k))
+        out[i:i+chunk], state = y, y[-1]
+    return out, state
+
+
+
+LockInOutput = namedtuple('LockInOutput', ['time_s', 'x', 'y', 'r', 'theta_deg'])
+
+
+
+class LockIn():
+    def __init__(self, clkdiv=95, channel_mask=0b11, signal_channel=None, reference_channel=None, 
+            frequency=None, phase_deg=0, time_constant_s=0.01, filter_order=4, output_rate_hz=100, 
+            callback=None, max_points=10000):
+        """
+        Dual-phase lock-in detection of the *signal_channel* (by default the first enabled), 
+        with the reference either 
+
+          * measured on the *reference_channel*, whose rising crossings of its mean value define 
+            the zero phase; between them the phase is interpolated linearly (a square-wave 
+            reference has its edges resolved only to one sample, i.e. 360°/samples per period), or
+          * synthesized with known *frequency* (e.g. `pwm_frequency(...)` of the PWM driving 
+            the experiment; both PWM and ADC clocks derive from the same crystal) and a constant 
+            *phase_deg* offset.
+
+        The signal is mixed with the reference and filtered by *filter_order* cascaded RC 
+        low-pass stages with given *time_constant_s*. The skew between interleaved channels is 
+        compensated. The outputs are decimated to *output_rate_hz*; x and y are the in-phase and 
+        quadrature components, r is the amplitude of the signal at the reference frequency, and 
+        theta_deg its phase (0 means a sine in phase with the reference). Each LockInOutput of 
+        arrays is passed to the *callback* and appended to `outputs` (keeping *max_points*).
+
+        The filter states and phases carry over between blocks, so the output is continuous 
+        regardless of the block boundaries.
+        """
+        assert (reference_channel is None) != (frequency is None), "Give either reference_channel, or frequency"
+        self.channels = channels_from_mask(channel_mask)
+        self.rate = sample_rate(clkdiv, channel_mask)
+        self.row = self.channels.index(self.channels[0] if signal_channel is None else signal_channel)
+        self.ref_row = None if reference_channel is None else self.channels.index(reference_channel)
+        self.frequency, self.phase0 = frequency, np.deg2rad(phase_deg)
+        self.a = np.exp(-1 / (self.rate * time_constant_s))
+        self.filter_state = np.zeros(filter_order, dtype=complex)
+        self.decimation = max(int(round(self.rate / output_rate_hz)), 1)
+        self.callback = callback
+        self.outputs = deque(maxlen=max_points)
+
+        self.total = 0                  # index of the first sample not demodulated yet
+        self.phase = 0.                 # reference phase at that sample (known frequency mode)
+        self.pending = np.zeros((len(self.channels), 0), dtype=np.uint16)  # waiting for next reference edge
+        self.last_edge = None           # fractional sample index of the last reference rising edge
+        self.ref_level, self.ref_span, self.ref_state = None, None, -1
+
+    def __call__(self, report):
+        self.process(split_channels(report))
+
+    def _reference_phase(self, block):
+        """ Returns the reference phase of all samples that can be demodulated now, as cycles """
+        x = np.concatenate((self.pending, block), axis=1)
+        ref = x[self.ref_row].astype(float)
+        if self.ref_level is None:
+            self.ref_level, self.ref_span = ref.mean(), ref.max() - ref.min()
+        hysteresis = 0.05 * self.ref_span
+
+        # rising crossings, with hysteresis carried over the blocks as in SoftwareTrigger
+        new = ref[self.pending.shape[1]:]
+        mark = np.full(len(new), -1, dtype=np.int8)
+        mark[new < self.ref_level - hysteresis] = 0
+        mark[new >= self.ref_level] = 1
+        last = np.maximum.accumulate(np.where(mark >= 0, np.arange(len(new)), -1))
+        state = np.where(last >= 0, mark[last], self.ref_state)
+        prev = np.concatenate(([self.ref_state], state[:-1]))
+        self.ref_state = state[-1]
+        i = np.flatnonzero((prev == 0) & (state == 1)) + self.pending.shape[1]
+        self.ref_level = 0.99 * self.ref_level + 0.01 * new.mean()   # follows slow drifts
+
+        # sub-sample position of the crossing, relative to the first pending sample
+        before = ref[i-1] if len(i) and i[0] > 0 else ref[np.maximum(i-1, 0)]
+        frac = np.clip((self.ref_level - before) / np.maximum(ref[i] - before, 1e-9), 0, 1)
+        edges = i - 1 + frac
+        if self.last_edge is not None:
+            edges = np.concatenate(([self.last_edge - self.total], edges))
+        if len(edges) < 2:
+            if len(edges):
+                self.last_edge = edges[0] + self.total
+            self.pending = x
+            return x[:, :0], np.zeros(0), np.zeros(0)
+
+        # cycles (i.e. phase/2π) of samples between the first and last known edges
+        ready = int(np.floor(edges[-1])) + 1
+        start = max(int(np.ceil(edges[0])), 0)
+        idx = np.arange(start, ready)
+        cycle = np.searchsorted(edges, idx, side='right') - 1
+        period = np.diff(edges)[np.minimum(cycle, len(edges) - 2)]
+        phase = cycle + (idx - edges[cycle]) / period
+
+        self.last_edge = edges[-1] + self.total
+        self.pending = x[:, ready:]
+        self.total += ready
+        # samples before the first edge have no phase; they are dropped
+        return x[:, start:ready], phase, period
+
+    def process(self, block):
+        """ Adds a (channel_count, n) array of new samples """
+        first_index = self.total
+        if self.ref_row is None:
+            n = block.shape[1]
+            cycles_per_sample = self.frequency / self.rate
+            phase = self.phase + cycles_per_sample * np.arange(n)
+            self.phase = (self.phase + cycles_per_sample * n) % 1
+            self.total += n
+            x, skew_cycles = block, cycles_per_sample * self.row / len(self.channels)
+        else:
+            x, phase, period = self._reference_phase(block)
+            first_index = self.total - x.shape[1]
+            skew_cycles = (self.row - self.ref_row) / len(self.channels) / period if len(phase) else 0
+        if not len(phase):
+            return
+
+        # mixing with i*exp(-iφ) turns A*sin(φ+θ) into A*exp(iθ) plus components at 2f, which
+        # are removed by the low-pass filter along with the (mid-scale subtracted) offset
+        angle = 2 * np.pi * (phase + skew_cycles) + self.phase0
+        z = 2j * (x[self.row] - 2048.) * np.exp(-1j * angle)
+        for k in range(len(self.filter_state)):
+            z, self.filter_state[k] = _lowpass(z, self.a, self.filter_state[k])
+
+        picked = np.arange(-first_index % self.decimation, len(z), self.decimation)
+        if not len(picked):
+            return
+        z = z[picked]
+        output = LockInOutput(time_s=(first_index + picked) / self.rate, x=z.real, y=z.imag, 
+                r=np.abs(z), theta_deg=np.rad2deg(np.angle(z)))
+        self.outputs.extend(zip(*output))
+        if self.callback:
+            self.callback(output)
+
+
+
+if __name__ == "__main__":
+    # Self-check and benchmark of the stages on synthetic data (does not need any device)
+    import time
+
+    rate = sample_rate(95, 0b11)
+    t = np.arange(2_000_000) / rate
+    rng = np.random.default_rng(0)
+    sine = 2048 + 1500*np.sin(2*np.pi*1000*t) + rng.normal(0, 30, len(t))     # 1 kHz with noise
+    data = np.stack([sine, 4095-sine]).clip(0, 4095).astype(np.uint16)
+
+    trigger = SoftwareTrigger(channel_mask=0b11, clkdiv=95, level=2048, hysteresis=100, 
+            pre_samples=50, post_samples=200, max_frames=10000)
+    t0 = time.time()
+    for i in range(0, data.shape[1], 1000):
+        trigger.process(data[:, i:i+1000])
+    dt = time.time() - t0
+    print(f"SoftwareTrigger: {data.shape[1]*2/dt/1e6:.1f} MS/s, {trigger.stats()}")
+    assert abs(trigger.stats().trigger_rate_hz - 1000) < 2     # exactly one trigger per period despite noise
+    frame = trigger.frames[-1]
+    assert np.array_equal(frame.data, data[:, frame.index-50:frame.index+200])
+    assert frame.data[0, 49] < 2048 <= frame.data[0, 50] + 100
+
+    for window_s in (None, 0.1):
+        statistics = StreamStatistics(channel_mask=0b11, clkdiv=95, window_s=window_s, bins=256)
+        t0 = time.time()
+        for i in range(0, data.shape[1], 1000):
+            statistics.process(data[:, i:i+1000])
+        dt = time.time() - t0
+        snapshot = statistics.snapshot()
+        print(f"StreamStatistics (window {window_s} s): {data.shape[1]*2/dt/1e6:.1f} MS/s, " + 
+                f"mean {snapshot.mean.round(2)}, std {snapshot.std.round(2)} over {snapshot.time_span_s:.3f} s")
+        expected = data[:, -snapshot.count:].astype(float)
+        assert np.allclose(snapshot.mean, expected.mean(axis=1)) and np.allclose(snapshot.std, expected.std(axis=1))
+        assert np.array_equal(snapshot.min, expected.min(axis=1)) and np.array_equal(snapshot.max, expected.max(axis=1))
+        assert np.array_equal(snapshot.histogram[1], np.bincount(expected[1].astype(int) >> 4, minlength=256))
+
+    analyzer = SpectralAnalyzer(clkdiv=95, channel_mask=0b11, segment_length=4096, spectrogram_rows=100)
+    t0 = time.time()
+    for i in range(0, data.shape[1], 1000):
+        analyzer.process(data[:, i:i+1000])
+    dt = time.time() - t0
+    f, psd = analyzer.psd()
+    print(f"SpectralAnalyzer: {data.shape[1]*2/dt/1e6:.1f} MS/s, {analyzer.segment_count} segments, " + 
+            f"peak at {f[psd[0].argmax()]:.1f} Hz")
+    assert abs(f[psd[0].argmax()] - 1000) <= f[1]
+    variance = data[0, :analyzer.buffer_start].astype(float).var()
+    assert abs(psd[0].sum() * f[1] / variance - 1) < 0.02      # Parseval: the PSD integrates to the variance
+    assert len(analyzer.spectrogram) == 100 and analyzer.spectrogram[-1].psd.shape == psd.shape
+
+    # Lock-in: 0.5 % signal at 5 kHz PWM frequency, buried in noise, on channel 1; PWM on channel 0
+    f = pwm_frequency(wrap_value=1999, clkdiv=25)
+    adc_rate = ADC_CLOCK_HZ / 96
+    n = np.arange(1_000_000)
+    t_ref, t_sig = (2*n) / adc_rate, (2*n + 1) / adc_rate      # channels are sampled alternately
+    pwm = np.where((t_ref * f) % 1 < .5, 3000, 1000)
+    signal = 2048 + 10 * np.sin(2*np.pi*f*t_sig + np.deg2rad(30)) + rng.normal(0, 100, len(n))
+    data = np.stack([pwm, signal]).clip(0, 4095).astype(np.uint16)
+
+    for kwargs in ({'reference_channel': 0}, {'frequency': f}):
+        lockin = LockIn(clkdiv=95, channel_mask=0b11, signal_channel=1, time_constant_s=0.2, **kwargs)
+        t0 = time.time()
+        for i in range(0, data.shape[1], 1000):
+            lockin.process(data[:, i:i+1000])
+        dt = time.time() - t0
+        time_s, x, y, r, theta_deg = lockin.outputs[-1]
+        print(f"LockIn ({kwargs}): {data.shape[1]*2/dt/1e6:.1f} MS/s, {len(lockin.outputs)} outputs, " + 
+                f"R={r:.2f}, θ={theta_deg:.1f}° at {time_s:.2f} s")
+        assert abs(r - 10) < 1 and abs(theta_deg - 30) < 5
@@ -9,10 +9,12 @@ operation of a CCD detector thus requires driving several control pins, and
 simultaneously quite fast digitization of its output voltage. 
 
 Raspberry Pi Pico with rp2daq appears ideal for this task. This program is
-split into two classes: 
+split into three classes: 
 
  * `TCD1304_Backend` which is specific for accessing the CCD hardware, and can be 
- reused when this Python file is imported as a module; and 
+ reused when this Python file is imported as a module; 
+ * `SpectrumProcessor` which turns the raw readouts into calibrated spectra using
+ NumPy, also reusable elsewhere; and 
  * `GraphicalSpectrometerApp` which shows the recorded intensity profiles in a
  window and provides basic operations one would use with a handheld
  spectrometer - a typical use of this high-resolution linear CCD array.
@@ -25,7 +27,10 @@ flatbed scanners, accurate position sensors etc.
 
 from matplotlib.figure import Figure 
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+from collections import deque, namedtuple
+import itertools
 import numpy as np
+import queue
 import threading
 import time
 import tkinter as tk
@@ -33,6 +38,9 @@ import tkinter as tk
 import rp2daq
 
 
+CCDFrame = namedtuple('CCDFrame', ['shutter_index', 'shutter_us', 'data', 'end_time_us'])
+
+
 class TCD1304_Backend:
 
     def __init__(self, rp, verbose=False):
@@ -93,12 +101,47 @@ class TCD1304_Backend:
                           #         ba98_7654_3210   = bit numbering 
                           #         PIVS MA__ ____   = bit assignment towards CCD 
         rp.gpio_out_seq(          0b0111_1100_0000, # <--- bit mask
-                                  0b0110_0100_0000, 1 )
+                                 [0b0110_0100_0000, 1])
 
         # todo: try setting GPIO23 to control the onboard SMPS power save enable pin, could reduce noise? 
 
         self.verbose=verbose
 
+    def adc_clkdiv(self, oversample=1):
+        clkdiv = int(48000//(self.CCD_freq_kHz/self.px_per_clk*oversample) - 1)  
+        # TODO This is weird. Find out why the above code made ADC in sync with CCD clk (i.e. 250ksps or slower) ...
+        #clkdiv = int(48000//(self.CCD_freq_kHz/px_per_clk*oversample) - 0) 
+        #  ... but this gets out-of-sync. However it allows for up to 500 ksps, and 2MHz PhiM clock.
+        if self.verbose: 
+            print('Arming ADC with  clkdiv=,', clkdiv, ', aiming for sampling rate ',  48e6/(clkdiv+1))
+        return clkdiv
+
+    def frame_sequence(self, shutter_us, preflush_count=10, wait_for_readout=False):
+        """
+        Returns the flat [value, wait, ...] list for one gpio_out_seq command that flushes the CCD
+        and then exposes it for `shutter_us`, starting the ADC in sync with the CCD readout. 
+        With `wait_for_readout`, the sequence also waits until the readout finishes, so that 
+        another sequence can be queued right after it.
+        """
+        # CCD pre-flush - improves signal to noise ratio and recovery from deep oversaturation
+        # Hex bit numbering: ba98_7654_3210   
+        # Bit names on CCD:  PIVS MA__ ____   
+        preflush = [ 0b0011_0100_0000,    1, # SH strobe to flush the CCD
+                     0b0010_0100_0000,    self.minimum_readout_us, 
+                     0b0110_0100_0000,    1, # integ time
+                     ] * preflush_count
+
+        # CCD driving sequence from datasheet, also starts ADC acquisition in sync with CCD signal.
+        drive = [ 0b0011_0100_0000,    1, # SH strobe to flush the CCD
+                  0b0010_0100_0000,    1, 
+
+                  0b0110_1100_0000,    shutter_us, # integ time from 20_000 up to 50_000_000 microseconds
+                  0b0011_0100_0000,    1, # SH strobe to get useful signal
+                  0b0010_0100_0000,    1, # must wait before ICG goes up
+                  0b0110_0000_0000,    1, # start ADC in sync with CCD output
+                  0b0110_0100_0000,    self.minimum_readout_us+100 if wait_for_readout else 1]
+        return preflush + drive
+
     def start_CCD_acquisition(self, rp, callback_on_ADC_data_ready, shutter_us, oversample=1):
         # Every falling edge of SH ends one integration period, and starts a new one
         # Every falling edge of ICG starts a readout period
@@ -110,48 +153,151 @@ class TCD1304_Backend:
         ## Note that timing of the ADC sequence is accurately in-sync with the driving signal thanks 
         ## to (1) the ADC using direct memory access independent on Pico's CPU load , and 
         ## (2) its being triggered directly by one pins in the readout sequence below.
-        clkdiv = int(48000//(self.CCD_freq_kHz/self.px_per_clk*oversample) - 1)  
-        # TODO This is weird. Find out why the above code made ADC in sync with CCD clk (i.e. 250ksps or slower) ...
-        #clkdiv = int(48000//(self.CCD_freq_kHz/px_per_clk*oversample) - 0) 
-        #  ... but this gets out-of-sync. However it allows for up to 500 ksps, and 2MHz PhiM clock.
-
-        if self.verbose: 
-            print('Arming ADC with  clkdiv=,', clkdiv, ', aiming for sampling rate ',  48e6/(clkdiv+1))
         rp.adc(channel_mask=0x01,
                 blocksize=self.CCD_pixel_count*oversample,  
                 blocks_to_send=1, 
                 trigger_gpio=self.A,
                 trigger_on_falling_edge=1, 
-                clkdiv=clkdiv,  # 4 master clock = 1 CCD pixel shift
+                clkdiv=self.adc_clkdiv(oversample),  # 4 master clock = 1 CCD pixel shift
                 _callback=callback_on_ADC_data_ready,
                 )
 
-        # CCD pre-flush - improves signal to noise ratio and recovery from deep oversaturation
-        for x in range(10):
-            rp.gpio_out_seq(   0b0111_1100_0000, # this is the mask of bits being changed
-                               0b0011_0100_0000,    1, # SH strobe to flush the CCD
-                               0b0010_0100_0000,    self.minimum_readout_us, 
-                               0b0110_0100_0000,    1, # integ time
-                               )
+        # Pre-flush and exposure in one command (used to be ten pre-flush round trips, some 120 ms)
+        rp.gpio_out_seq(0b0111_1100_0000, self.frame_sequence(shutter_us)) # mask of bits being changed
 
-        # CCD driving sequence from datasheet, also starts ADC acquisition in sync with CCD signal.
-        # Hex bit numbering: ba98_7654_3210   
-        # Bit names on CCD:  PIVS MA__ ____   
-        rp.gpio_out_seq(   0b0111_1100_0000, # this is the mask of bits being changed
-
-                         # 0b0110_0100_0000,       # bit state from previous gpio_out_seq
-                           0b0011_0100_0000,    1, # SH strobe to flush the CCD
-                           0b0010_0100_0000,    1, 
+        ## No return values here; the user-supplied `callback` will be called when ADC accumulation is finished
 
-                           0b0110_1100_0000,    shutter_us, # integ time from 20_000 up to 50_000_000 microseconds
-                                                # TODO split the seq_command here, making its 1st half 
-                                                # asynchronous, to avoid blocking the thread with long shutters
-                           0b0011_0100_0000,    1, # SH strobe to get useful signal
-                           0b0010_0100_0000,    1, # must wait before ICG goes up
-                           0b0110_0000_0000,    1, # start ADC in sync with CCD output
-                           0b0110_0100_0000,    1) 
+    def start_continuous(self, shutters_us, oversample=1, queue_size=8, max_in_flight=2, preflush_count=10):
+        """
+        Starts repeated acquisition, cycling through the list of `shutters_us`. The ADC is armed 
+        once to be re-triggered by each exposure, and a background thread keeps up to 
+        `max_in_flight` exposure sequences queued in the device, so that the frame rate is limited 
+        by the shutter and readout times, not by the processing of the previous frames.
+
+        The frames are published to the bounded `self.frames` queue as CCDFrame named tuples, whose 
+        `shutter_index` tells the position in `shutters_us`. If the consumer does not keep up, the oldest frames are dropped and counted in `self.frames_dropped`. 
+        Call stop_continuous() before using start_CCD_acquisition() again.
+        """
+        assert min(shutters_us) > self.minimum_readout_us
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.frames_dropped = 0
+        self.continuous_running = threading.Event()
+        self.continuous_running.set()
+        self._shutters_issued = deque()  # the ADC reports come in the same order as the sequences
+        self._sequence_slots = threading.Semaphore(max_in_flight)
+        self._max_in_flight = max_in_flight
+
+        self.rp.adc(channel_mask=0x01,
+                blocksize=self.CCD_pixel_count*oversample,  
+                infinite=1, 
+                trigger_gpio=self.A,
+                trigger_on_falling_edge=1, 
+                clkdiv=self.adc_clkdiv(oversample),
+                _callback=self._on_continuous_frame,
+                )
 
-        ## No return values here; the user-supplied `callback` will be called when ADC accumulation is finished
+        sequences = {shutter_us: self.frame_sequence(shutter_us, preflush_count, wait_for_readout=True) 
+                for shutter_us in set(shutters_us)}
+        def acquisition_loop():
+            for shutter_index, shutter_us in itertools.cycle(enumerate(shutters_us)):
+                self._sequence_slots.acquire()
+                if not self.continuous_running.is_set(): 
+                    break
+                self._shutters_issued.append((shutter_index, shutter_us))
+                self.rp.gpio_out_seq(0b0111_1100_0000, sequences[shutter_us], 
+                        _callback=lambda rv: self._sequence_slots.release())
+        self.acquisition_thread = threading.Thread(target=acquisition_loop, daemon=True)
+        self.acquisition_thread.start()
+
+    def _on_continuous_frame(self, rv):
+        shutter_index, shutter_us = self._shutters_issued.popleft()
+        frame = CCDFrame(shutter_index=shutter_index, shutter_us=shutter_us, data=rv.data, 
+                end_time_us=rv.end_time_us)
+        while True:
+            try:
+                self.frames.put_nowait(frame)
+                return
+            except queue.Full:  # make room by dropping the oldest frame
+                try:
+                    self.frames.get_nowait()
+                    self.frames_dropped += 1
+                except queue.Empty: 
+                    pass
+
+    def stop_continuous(self):
+        self.continuous_running.clear()
+        self._sequence_slots.release()  # let the acquisition thread notice
+        self.acquisition_thread.join()
+        for x in range(self._max_in_flight): # wait until the queued exposures are read out
+            self._sequence_slots.acquire()
+        self.rp.adc_stop()
+
+
+
+class SpectrumProcessor:
+
+    def __init__(self, pixel_count, oversample=1, calibration=((534, 404.), (1805, 532.)),
+            baseline_pixels=5, deadtime_s=0.005, saturation_counts=600):
+        """
+        Vectorized processing of raw CCD readouts into spectra: decoding, oversample averaging,
+        baseline subtraction and normalization to counts per second, dark subtraction, flat-field
+        division, wavelength calibration and HDR merging of several shutter times.
+
+        The calibration is given by two (pixel, wavelength in nm) pairs; the wavelength axis is
+        computed only once here. The first `baseline_pixels` of each readout are light-shielded
+        and give the zero level. Pixels whose signal exceeds `saturation_counts` ADC counts in
+        a single exposure are treated as saturated by the HDR merge.
+        """
+        self.pixel_count = pixel_count
+        self.oversample = oversample
+        self.baseline_pixels = baseline_pixels
+        self.deadtime_s = deadtime_s
+        self.saturation_counts = saturation_counts
+
+        (p1, l1), (p2, l2) = calibration
+        self.wavelength = l1 + (np.arange(pixel_count) - p1) * (l2-l1)/(p2-p1)
+
+        self.dark_spectra = {}    # uncorrected spectra, by shutter time in seconds
+        self.bright_spectra = {}
+
+    def decode(self, data):
+        """ Converts the ADC report data into a float array, averaging the oversampled values """
+        raw = np.asarray(data, dtype=np.float32)
+        if self.oversample > 1:
+            raw = raw[:len(raw)//self.oversample*self.oversample].reshape(-1, self.oversample).mean(axis=1)
+        return raw
+
+    def normalize(self, data, shutter_s):
+        """ Returns the uncorrected spectrum in ADC counts per second of exposure """
+        raw = self.decode(data)
+        y_ref = raw[:self.baseline_pixels].mean()  # CCD output voltage drops with illumination
+        return (y_ref - raw) / (shutter_s - self.deadtime_s)
+
+    def correct(self, spectrum, shutter_s):
+        """ Returns a new array with the dark spectrum subtracted and divided by the bright one """
+        dark = self.dark_spectra.get(shutter_s)
+        bright = self.bright_spectra.get(shutter_s)
+        corrected = spectrum - dark if dark is not None else spectrum.copy()
+        if bright is not None:
+            corrected /= (bright - dark) if dark is not None else bright
+        return corrected
+
+    def saturated(self, spectrum, shutter_s):
+        return spectrum * (shutter_s - self.deadtime_s) > self.saturation_counts
+
+    def hdr_merge(self, spectra):
+        """
+        Merges a dict of uncorrected spectra (by shutter time) into one corrected spectrum. Each
+        pixel is the average of its unsaturated exposures weighted by their shutter times, as the
+        longer ones have better signal to noise ratio. Pixels saturated in all exposures take
+        their value from the shortest one.
+        """
+        shutters = sorted(spectra)
+        corrected = np.stack([self.correct(spectra[s], s) for s in shutters])
+        weights = np.stack([np.where(self.saturated(spectra[s], s), 0., s) for s in shutters])
+        weight_sum = weights.sum(axis=0)
+        merged = (corrected * weights).sum(axis=0) / np.where(weight_sum > 0, weight_sum, 1)
+        return np.where(weight_sum > 0, merged, corrected[0])
 
 
 
@@ -168,6 +314,7 @@ class MainApplication(tk.Frame):
         self.dark_button.pack() 
         self.brigth_button = tk.Button(master=root,  command=self.save_bright, text="Save bright ref") 
         self.brigth_button.pack() 
+        root.protocol("WM_DELETE_WINDOW", self.close)
 
         ## Connect to the Pico and CCD hardware
         self.rp = rp2daq.Rp2daq()   # initialize rp2daq device first, to keep independent access to its other functions     
@@ -179,6 +326,7 @@ class MainApplication(tk.Frame):
         self.ax1 = self.fig.add_subplot(111) 
         for color in 'rygcbm':
             self.lines.extend(self.ax1.plot([0,0], color, label='', alpha=.5))
+        self.hdr_line, = self.ax1.plot([0,0], 'k', label='HDR merged', lw=.5)
         self.ax1.grid()
         self.ax1.legend(prop={'size':10}, loc='upper right')
         self.ax1.set_yscale('log')
@@ -193,12 +341,17 @@ class MainApplication(tk.Frame):
         self.canvas.get_tk_widget().pack(fill="x", expand=False)
 
         ## Getting ready to start acquisition
-        self.CCD_acquisition_finished = threading.Event() # future TODO: rewrite to use 2nd thread
         self.acquisition_running = False
-        self.dark_saved_spectra = {}
-        self.bright_saved_spectra = {}
+        self.recent_spectra = {}
         self.ADC_oversample = 1
-        self.int_time = .5
+        self.processor = SpectrumProcessor(self.my_CCD.CCD_pixel_count, oversample=self.ADC_oversample)
+        #self.shutters_s = [ .014, ]  # SINGLE SCAN
+        #self.shutters_s = [0.012, .02, .05, .1, ] # HDR - HIGH ILLUM
+        #self.shutters_s = [.02, .05,   .1, .2, .5, ] # HDR - MEDIUM ILLUM
+        #self.shutters_s = [           .1, .2, .5, 1., 2.]  # HDR - LOW ILLUM
+        self.shutters_s = [                  .5, 1., 2,  5, ]  # HDR - VERY LOW ILLUM
+        #self.shutters_s = [0.014, 0.02, 0.1, .5, ]  # Ultra HDR
+        #self.shutters_s = [.2,   ] # fast oversample
         self.t0 = time.time()
 
         #self.lbl_Progress = tk.Label(self, text='Set config & click Start')
@@ -206,80 +359,49 @@ class MainApplication(tk.Frame):
         #self.btn_Process = tk.Button(self, text='Process!', command=self.btn_Start_click)
         #self.btn_Process.grid(column=1, row=row, columnspan=2); row+=1
 
-    def callback_on_ADC_data_ready(self, rv): # this will be called from rp2daq module, the `rv` contains ADC results
-        deadtime=0.005
-        if self.ADC_oversample == 2:
-            self.new_spectrum = [(y1+y2)/2/(self.int_time-deadtime) for y1,y2 in zip(rv.data[:-1:2], rv.data[1::2])]  
-        else:
-            self.new_spectrum = [y/(self.int_time-deadtime) for y in rv.data]
-        y_ref = sum(self.new_spectrum[:5])/ 4.999
-        self.new_spectrum = [y_ref-y for y in self.new_spectrum]
-
-        self.CCD_acquisition_finished.set()
-
     def update_plot(self): 
-        if self.acquisition_running: return # is this necessary? 
-
-        self.t0 = time.time(); #print(time.time() - self.t0, 'start upd' )
-
-        self.acquisition_running = True
-        self.recent_spectra = {}
-
-        #for n,shutter_time_s in enumerate([ .014, ]):  # SINGLE SCAN
-        #for n,shutter_time_s in enumerate([0.012, .02, .05, .1, ]): #, 1, 3]): # HDR - HIGH ILLUM
-        #for n,shutter_time_s in enumerate([.02, .05,   .1, .2, .5, ]): #, 1, 3]): # HDR - MEDIUM ILLUM
-        #for n,shutter_time_s in enumerate([           .1, .2, .5, 1., 2.]):  # HDR - LOW ILLUM
-        for n,shutter_time_s in enumerate([                  .5, 1., 2,  5, ]):  # HDR - VERY LOW ILLUM
-        #for n,shutter_time_s in enumerate([.02, .02,   .1, .5,  .1, .02]): #, 1, 3]): # TESTING REPEATABILITY
-        #for n,shutter_time_s in enumerate([0.014, 0.02, 0.1, .5, ]):  # Ultra HDR
-        #for n,shutter_time_s in enumerate([.2,   ]*1): #, 1, 3]): # fast oversample
-            self.int_time = shutter_time_s
-            time.sleep(.01) # FIXME is this necessary, why?
-
-            self.CCD_acquisition_finished.clear()
-            self.my_CCD.start_CCD_acquisition(self.rp, 
-                    self.callback_on_ADC_data_ready, int(self.int_time*1e6), oversample=self.ADC_oversample) # takes some 120ms, why?
-
-            # The callback_on_ADC_data_ready stores results into self.new_spectrum now, then 
-            # clears the CCD_acquisition_finished semaphore, so we can plot it here.
-            self.CCD_acquisition_finished.wait()
-            #self.lines[n].set_data(range(len(self.new_spectrum)), np.array(self.new_spectrum)-shutter_time_s*0) 
-            p1,l1,p2,l2 = 534, 404., 1805, 532.
-            pps = np.arange(len(self.new_spectrum))
-
-            ## Simple compensation for light intensity
-            calibrated_spectrum = np.array(self.new_spectrum)-shutter_time_s*0
-
-            self.recent_spectra[shutter_time_s] = calibrated_spectrum
-
-            ## Dark & Bright CCD intensity compensation
-            if shutter_time_s in self.dark_saved_spectra.keys(): #todo: and chk_subtract_dark.checked()
-                calibrated_spectrum -= self.dark_saved_spectra[shutter_time_s]
-
-            if shutter_time_s in self.bright_saved_spectra.keys(): #todo: and chk_divide_by_bright.checked()
-                if shutter_time_s in self.dark_saved_spectra.keys(): #todo: and chk_subtract_dark.checked()
-                    calibrated_spectrum /= (self.bright_saved_spectra[shutter_time_s] - self.dark_saved_spectra[shutter_time_s])
-                else:
-                    calibrated_spectrum /= self.bright_saved_spectra[shutter_time_s]
-
-
-            self.lines[n].set_data(
-                    l1 + (pps-p1) * (l2-l1)/(p2-p1),
-                    calibrated_spectrum) 
+        if not self.acquisition_running: # the first click starts the continuous acquisition
+            self.acquisition_running = True
+            self.my_CCD.start_continuous([round(s*1e6) for s in self.shutters_s], oversample=self.ADC_oversample)
+            self.poll_frames()
+
+    def poll_frames(self): 
+        ## The acquisition thread of my_CCD publishes new frames independently; just process those ready
+        updated = False
+        while not self.my_CCD.frames.empty():
+            frame = self.my_CCD.frames.get()
+            n = frame.shutter_index     # (the shutter times in µs need not be exact in seconds)
+            shutter_time_s = self.shutters_s[n]
+            self.recent_spectra[shutter_time_s] = self.processor.normalize(frame.data, shutter_time_s)
+
+            ## Dark & Bright CCD intensity compensation, and wavelength calibration
+            self.lines[n].set_data(self.processor.wavelength,
+                    self.processor.correct(self.recent_spectra[shutter_time_s], shutter_time_s))
             self.lines[n].set_label(str(shutter_time_s))
+            updated = True
 
-        self.canvas.draw()
-        self.acquisition_running = False
-
+            if n == len(self.shutters_s) - 1:
+                print(time.time() - self.t0, ' s for whole HDR cycle, frames dropped: ', self.my_CCD.frames_dropped)
+                self.t0 = time.time()
 
-        print(time.time() - self.t0, ' s for whole update routine' )
-        root.after(20, self.update_plot) # periodic update
+        if updated:
+            self.hdr_line.set_data(self.processor.wavelength, self.processor.hdr_merge(self.recent_spectra))
+            self.canvas.draw_idle()
+        root.after(20, self.poll_frames) # periodic update
     
+    def close(self):
+        ## Stop the device sequences and the acquisition thread before the window goes
+        if self.acquisition_running:
+            self.acquisition_running = False
+            self.my_CCD.stop_continuous()
+        self.rp.quit()
+        root.destroy()
+
     def save_dark(self):
-        self.dark_saved_spectra = self.recent_spectra.copy()
+        self.processor.dark_spectra = self.recent_spectra.copy()
 
     def save_bright(self):
-        self.bright_saved_spectra = self.recent_spectra.copy()
+        self.processor.bright_spectra = self.recent_spectra.copy()
 
 def crude_CCD_test(): # minimum code for testing
     rp = rp2daq.Rp2daq() 
@@ -289,6 +411,22 @@ def crude_CCD_test(): # minimum code for testing
     while True: # test CCD by just reading data
         my_CCD.start_CCD_acquisition(rp, dummy_callback, 30_000)
 
+def benchmark_spectrum_processor(frames=1000): # does not need the hardware
+    processor = SpectrumProcessor(3694, oversample=2)
+    shutters = [.5, 1., 2, 5]
+    rng = np.random.default_rng(0)
+    data = [list(rng.integers(2000, 2600, 3694*2)) for s in shutters]
+    processor.dark_spectra = {s: processor.normalize(d, s) for s, d in zip(shutters, data)}
+    processor.bright_spectra = {s: processor.normalize(d, s)*2 for s, d in zip(shutters, data)}
+
+    t0 = time.time()
+    for n in range(frames//len(shutters)):
+        spectra = {s: processor.normalize(d, s) for s, d in zip(shutters, data)}
+        corrected = [processor.correct(spectra[s], s) for s in shutters]
+        merged = processor.hdr_merge(spectra)
+    dt = (time.time() - t0) / (frames//len(shutters)*len(shutters))
+    print(f"{dt*1e3:.3f} ms per frame, i.e. up to {1/dt:.0f} frames per second")
+
 
 if __name__ == "__main__":
     root = tk.Tk()
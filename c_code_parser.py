@@ -4,6 +4,7 @@
 """
 """
 
+import bisect
 import pathlib
 import re
 
@@ -33,6 +34,57 @@ def get_next_code_block(s, lbrace="{", rbrace="}"):
 def get_prev_code_block(s, lbrace="{", rbrace="}"):
     return get_next_code_block(s[::-1], lbrace=rbrace, rbrace=lbrace)[::-1]
 
+
+class CodeIndex():
+    """
+    Finds all brace blocks, command handlers `void name()` and named struct instances 
+    `} name;` in one pass over the C code, so that they are then looked up by name. 
+    Like get_next_code_block(), it does NOT ignore braces in strings, comments etc.
+    """
+    def __init__(self, C_code):
+        self.C_code = C_code
+        self.opening = []                   # positions of all '{', ascending
+        self.closing_of, self.opening_of = {}, {}   # matching brace positions, both ways
+        self.functions, self.instances = {}, {}     # name -> end of "void name()", position of '}' before name
+        open_stack = []
+        name_after = re.compile(r"\s*(\w+)")
+        for token in re.finditer(r"void\s+(\w+)\s*\(\)|[{}]", C_code):
+            if token.group(1):
+                self.functions.setdefault(token.group(1), token.end())
+            elif token.group() == "{":
+                self.opening.append(token.start())
+                open_stack.append(token.start())
+            elif open_stack:
+                opening = open_stack.pop()
+                self.closing_of[opening], self.opening_of[token.start()] = token.start(), opening
+                name = name_after.match(C_code, token.end())
+                if name:
+                    self.instances.setdefault(name.group(1), token.start())
+
+    def function_body(self, name):
+        """ Code enclosed by the first brace block following `void name()` """
+        opening = self.opening[bisect.bisect_left(self.opening, self.functions[name])]
+        return self.C_code[opening+1:self.closing_of[opening]]
+
+    def struct_before(self, name):
+        """ Code enclosed by the brace block just before `name`, like in `struct {...} name;` """
+        closing = self.instances[name]
+        return self.C_code[self.opening_of[closing]+1:closing]
+
+
+class RegexLookup():
+    """ The same lookups as CodeIndex, searching the whole code each time (slow, kept as reference) """
+    def __init__(self, C_code):
+        self.C_code = C_code
+
+    def function_body(self, name):
+        q = re.search(f"void\\s+{name}\\s*\\(\\)", self.C_code)
+        return get_next_code_block(self.C_code[q.span()[1]:]) 
+
+    def struct_before(self, name):
+        q = re.search(f"}}\\s*{name}", self.C_code)
+        return get_prev_code_block(self.C_code[:q.span()[0]+1]) 
+
 def generate_command_codes(C_code):
     command_table_match = re.search(r"message_descriptor message_table", C_code, 
             flags=re.M+re.S)
@@ -41,9 +93,16 @@ def generate_command_codes(C_code):
     return {c.group():n//2 for n,c in enumerate(re.finditer(r"\w+", command_table_code, 
         flags=re.M+re.S)) if not c.group().endswith("_report")}
 
-def analyze_c_firmware():
+def get_urgent_commands(C_code):
+    """ Commands marked by a "// urgent" comment in the message_table, to be sent before any others """
+    command_table_match = re.search(r"message_descriptor message_table", C_code, flags=re.M+re.S)
+    command_table_code = get_next_code_block(C_code[command_table_match.span()[1]:])
+    return set(re.findall(r"^\s*\{\s*&(\w+)[^\n]*//\s*urgent\b", command_table_code, flags=re.M))
+
+def analyze_c_firmware(C_code=None, indexed=True):
     """ Parses the RP2DAQ firmware in C language, searching for the table of commands, and 
-    then the binary structures each command is supposed to accept.
+    then the binary structures each command is supposed to accept. The *C_code* is by default
+    gathered from the project files; *indexed* False selects the slower RegexLookup.
     Returns a dict of functions which transmit such binary messages, exactly matching the 
     message specification in the C code. For convenience, these functions have properly named 
     parameters, possibly with default values, and with checks for their minimum/maximum 
@@ -51,9 +110,12 @@ def analyze_c_firmware():
     # Fixme: error-prone assumption that args are always the 1st parentheses block in every 
     # command/function body
 
-    proj_path = pathlib.Path(__file__).resolve().parent
-    C_code = gather_C_code(proj_path)
+    if C_code is None:
+        C_code = gather_C_code(pathlib.Path(__file__).resolve().parent)
+    code_index = CodeIndex(C_code) if indexed else RegexLookup(C_code)
     command_codes = generate_command_codes(C_code)
+    urgent_commands = get_urgent_commands(C_code)
+    rxbuf_len = get_C_code_define('RXBUF_LEN')
 
     # Results that will be dynamically populated
     func_dict = {}  # Rp2daq class' methods for calling commands
@@ -62,13 +124,12 @@ def analyze_c_firmware():
 
     for command_name, command_code in command_codes.items():
         ## Search for the command handlers in C code
-        q = re.search(f"void\\s+{command_name}\\s*\\(\\)", C_code)
-        func_body = get_next_code_block(C_code[q.span()[1]:]) # code enclosed by closest brace block
+        func_body = code_index.function_body(command_name) # code enclosed by closest brace block
         args_struct = get_next_code_block(func_body) 
 
         struct_signature, cmd_length = "", 0
         arg_names, arg_defaults = [], []
-        exec_header, exec_prepro, exec_struct,  exec_stargs = ["" for _ in range(4)]
+        exec_header, exec_prepro, exec_struct,  exec_stargs, exec_array = ["" for _ in range(5)]
 
         try:
             raw_docstring = get_next_code_block(func_body, lbrace="/*", rbrace="*/").strip()
@@ -79,9 +140,10 @@ def analyze_c_firmware():
 
         param_docstring = ""
         args_struct = re.sub(r'\n\s*\/\/', '', args_struct) # allow multi-line comments for params
-        for line in re.finditer(r"(u?)int(8|16|32|64)_t\s+([\w,]*)(.*)", args_struct):
-            unsigned, bits, arg_name_multi, line_comments = line.groups()
+        for line in re.finditer(r"(u?)int(8|16|32|64)_t\s+([\w,]*)(\[\])?(.*)", args_struct):
+            unsigned, bits, arg_name_multi, is_array, line_comments = line.groups()
             bit_width_code = {8:'b', 16:'h', 32:'i', 64:'q'}[int(bits)]
+            assert not exec_array, f"variable-length array must be the last field of {command_name} struct"
 
             arg_attribs = {}
             arg_comment = ""
@@ -94,21 +156,38 @@ def analyze_c_firmware():
                 comment = arg_comment.strip()
 
             for arg_name in arg_name_multi.split(","):
-                cmd_length += int(bits)//8
-                exec_struct += bit_width_code.upper() if unsigned else bit_width_code
-                exec_stargs += f"\n\t\t\t{arg_name},"
                 arg_names.append(arg_name)
-
                 param_maxmindef = ""
+                if is_array:  # trailing variable-length array, packed after the fixed-length fields
+                    typecode = bit_width_code.upper() if unsigned else bit_width_code
+                    exec_array = f"\t_array = struct.pack(f'<{{len({arg_name})}}{typecode}', *{arg_name})\n"
+                    param_maxmindef += f"list of {bits}-bit integers, "
+                    value_check = f"min({arg_name}, default=0)", f"max({arg_name}, default=0)"
+                    m = arg_attribs.get("maxlen")
+                    if m is not None:
+                        exec_prepro += f"\tassert len({arg_name}) <= {m}, "+\
+                                f"'Maximum length of {arg_name} is {m}'\n"
+                        param_maxmindef += f"maxlen={m}, "
+                    m = arg_attribs.get("lenmult")
+                    if m is not None:
+                        exec_prepro += f"\tassert len({arg_name}) % {m} == 0, "+\
+                                f"'Length of {arg_name} must be a multiple of {m}'\n"
+                        param_maxmindef += f"lenmult={m}, "
+                else:
+                    cmd_length += int(bits)//8
+                    exec_struct += bit_width_code.upper() if unsigned else bit_width_code
+                    exec_stargs += f"\n\t\t\t{arg_name},"
+                    value_check = arg_name, arg_name
+
                 m = arg_attribs.get("min")
                 if m is not None:
-                    exec_prepro += f"\tassert {arg_name} >= {arg_attribs['min']}, "+\
+                    exec_prepro += f"\tassert {value_check[0]} >= {arg_attribs['min']}, "+\
                             f"'Minimum value for {arg_name} is {arg_attribs['min']}'\n"
                     param_maxmindef += f"min={m}, "
 
                 m = arg_attribs.get("max")
                 if m is not None:
-                    exec_prepro += f"\tassert {arg_name} <= {arg_attribs['max']},"+\
+                    exec_prepro += f"\tassert {value_check[1]} <= {arg_attribs['max']},"+\
                             f"'Maximum value for {arg_name} is {arg_attribs['max']}'\n"
                     param_maxmindef += f"max={m}, "
 
@@ -126,19 +205,28 @@ def analyze_c_firmware():
                 param_docstring += f"\n"
 
         param_docstring += f"  * **_callback** : Optionally, a function to handle future report(s). "
-        param_docstring += f"If set, makes this command asynchronous so it does not wait for the command being finished. \n\n"
-
-
-        # TODO once 16-bit msglen enabled: cmd_length will go +3, and 1st struct Byte must change to Half-int 
-        exec_msghdr = f"', {cmd_length+2}, {command_code}, "
-        code = f"def {command_name}(self,{exec_header} _callback=None):\n" +\
+        param_docstring += f"If set, makes this command asynchronous so it does not wait for the command being finished. \n"
+        param_docstring += f"  * **_callback_executor** : Optionally, \"process\" or a ProcessOffload object to run the _callback "
+        param_docstring += f"in worker processes, see process_offload.py. \n"
+        param_docstring += f"  * **_urgent** : If True, the command is sent before all other commands waiting to be sent. "
+        param_docstring += f"_(default={command_name in urgent_commands})_ \n\n"
+
+
+        # Message header is the 16-bit length (of command code + arguments + array), and the command code
+        if exec_array:
+            exec_array += f"\tassert len(_array) <= {rxbuf_len - cmd_length - 1}, 'Command too long for device buffer'\n"
+            exec_msghdr, exec_msgtail = f"', {cmd_length+1}+len(_array), {command_code}, ", " + _array"
+        else:
+            exec_msghdr, exec_msgtail = f"', {cmd_length+1}, {command_code}, ", ""
+        exec_header_tail = f"_callback=None, _callback_executor=None, _urgent={command_name in urgent_commands}"
+        code = f"def {command_name}(self,{exec_header} {exec_header_tail}):\n" +\
                 f'\t"""{raw_docstring}\n\nParameters:\n{param_docstring}"""\n' +\
-                exec_prepro +\
+                exec_prepro + exec_array +\
                 f"\tif not self.run_event.is_set(): raise RuntimeError('Sending commands when device disconnected')\n" +\
                 f"\tif {command_code} not in self.sync_report_cb_queues.keys():\n" +\
                 f"\t\tself.sync_report_cb_queues[{command_code}] = queue.Queue()\n" +\
-                f"\tself.report_callbacks[{command_code}] = _callback\n" +\
-                f"\tself.command_queue.put(struct.pack('<BB{exec_struct}{exec_msghdr}{exec_stargs}))\n" +\
+                f"\tself.report_callbacks[{command_code}] = self._wrap_callback(_callback, _callback_executor)\n" +\
+                f"\tself._send(struct.pack('<HB{exec_struct}{exec_msghdr}{exec_stargs}){exec_msgtail}, urgent=_urgent)\n" +\
                 f"\tif not _callback:\n" +\
                 f"\t\treturn self.default_blocking_callback({command_code})"
 
@@ -148,8 +236,7 @@ def analyze_c_firmware():
 
         ## Search for the report structures in C code
         report_docstring = ""
-        q = re.search(f"}}\\s*{command_name}_report", C_code)
-        report_struct_code = get_prev_code_block(C_code[:q.span()[0]+1]) # code enclosed by closest brace block
+        report_struct_code = code_index.struct_before(f"{command_name}_report") # code enclosed by closest brace block
         #report_struct_code = remove_c_comments(report_struct_code)
 
         report_header_signature, report_length = "<", 0
@@ -187,7 +274,7 @@ def analyze_c_firmware():
 
         # Append extracted docstring to the overall API reference
         markdown_docs += f"\n\n## {command_name}\n\n"
-        markdown_docs += f"```Python\n{command_name}({exec_header} _callback=None)\n```\n\n"
+        markdown_docs += f"```Python\n{command_name}({exec_header} {exec_header_tail})\n```\n\n"
         markdown_docs += f"{raw_docstring}\n\n"
         markdown_docs += f"***Command parameters:***\n\n{param_docstring}\n"
         markdown_docs += f"***Report object attributes:***\n\n{report_docstring}\n"
@@ -195,6 +282,31 @@ def analyze_c_firmware():
     return report_names, report_lengths, report_header_signatures, arg_names_for_reports, func_dict, markdown_docs
 
 
+def get_command_formats(C_code=None):
+    """ Returns a dict mapping each command code to its name, the struct format and names of
+    its fixed-length arguments, and the struct typecode of its trailing array (or None). This
+    is the inverse of the generated command functions, used by device_emulator.py. """
+    if C_code is None:
+        C_code = gather_C_code(pathlib.Path(__file__).resolve().parent)
+    code_index = CodeIndex(C_code)
+    command_formats = {}
+    for command_name, command_code in generate_command_codes(C_code).items():
+        args_struct = get_next_code_block(code_index.function_body(command_name))
+        args_struct = re.sub(r'\n\s*\/\/', '', args_struct)
+        struct_format, arg_names, array_typecode = "<", [], None
+        for line in re.finditer(r"(u?)int(8|16|32|64)_t\s+([\w,]*)(\[\])?(.*)", args_struct):
+            unsigned, bits, arg_name_multi, is_array, _ = line.groups()
+            typecode = {8:'b', 16:'h', 32:'i', 64:'q'}[int(bits)]
+            typecode = typecode.upper() if unsigned else typecode
+            if is_array:
+                array_typecode = typecode
+            else:
+                struct_format += typecode * len(arg_name_multi.split(","))
+                arg_names += arg_name_multi.split(",")
+        command_formats[command_code] = (command_name, struct_format, arg_names, array_typecode)
+    return command_formats
+
+
 def gather_C_code(proj_path):
     C_code = open(proj_path/'rp2daq.c').read()
     for included in pathlib.Path(proj_path/'include').glob('*.c'):
@@ -202,13 +314,67 @@ def gather_C_code(proj_path):
     return C_code
 
 
+def get_C_code_define(name):
+    """ Returns the integer value of a constant #define'd in rp2daq.h or in the firmware C code """
+    proj_path = pathlib.Path(__file__).resolve().parent
+    C_code = open(proj_path/'rp2daq.h').read() + gather_C_code(proj_path)
+    return int(re.search(f"^#define\\s+{name}\\s+(\\d+)", C_code, flags=re.M).group(1))
+
+
 def get_C_code_version():
     rp2daq_h_file = open(pathlib.Path(__file__).resolve().parent/'rp2daq.h')
     rp2daq_h_line = [l for l in rp2daq_h_file.readlines() if '#define FIRMWARE_VERSION' in l][0]
     return int(rp2daq_h_line.split('rp2daq_')[1][:6])
 
 
+def synthetic_firmware(command_count):
+    """ C code with given number of simple commands, for benchmarking the parser """
+    C_code = "message_descriptor message_table[] = {\n"
+    C_code += "".join(f"    {{&command{i}, &command{i}_report}},\n" for i in range(command_count)) + "};\n"
+    for i in range(command_count):
+        C_code += f"""
+struct __attribute__((packed)) {{
+    uint8_t report_code;
+    uint16_t _data_count;
+    uint8_t _data_bitwidth;
+    uint32_t value; // Some result of command {i}
+}} command{i}_report;
+
+void command{i}() {{
+    /* Synthetic command number {i}, with a multi-line
+     * docstring.
+     */
+    struct __attribute__((packed)) {{
+        uint8_t gpio;       // min=0 max=25 default={i % 26} Some pin
+        int32_t count;      // min=-1 max=1000 default=-1 Some count
+        uint16_t values[];  // maxlen=100 Some data
+    }} * args = (void*)(command_buffer+1);
+    if (args->gpio) {{ command{i}_report.value = args->count; }}
+    prepare_report(&command{i}_report, sizeof(command{i}_report), 0, 0, 0);
+}}
+"""
+    return C_code
+
+
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Parses the firmware C code and re-generates the Python API reference.")
+    parser.add_argument('--check', type=int, metavar='N', nargs='?', const=300, 
+            help="Instead, compare the indexed parser with the regex lookups on the firmware and on a " +
+            "synthetic firmware with N commands (default 300), and measure both")
+    args = parser.parse_args()
+
+    if args.check:
+        import time
+        for name, C_code in (("firmware", None), (f"synthetic firmware of {args.check} commands", synthetic_firmware(args.check))):
+            timings = {}
+            for indexed in (True, False):
+                t0 = time.perf_counter()
+                timings[indexed] = analyze_c_firmware(C_code, indexed=indexed), time.perf_counter() - t0
+            assert timings[True][0] == timings[False][0], f"Indexed parser gives different results on {name}"
+            print(f"{name}: identical results, indexed {timings[True][1]*1e3:.1f} ms, regex lookups {timings[False][1]*1e3:.1f} ms")
+        raise SystemExit
+
     proj_path = pathlib.Path(__file__).resolve().parent
     reference_file = "./docs/PYTHON_REFERENCE.md"
     print(f"This module was run as a command. It will parse C code and re-generate {reference_file}")
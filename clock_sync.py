@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+"""
+Mapping the device timestamps onto the computer clock, and merging reports of several devices.
+
+The reports carry timestamps of the device clock (microseconds since its start, in fields like
+`start_time_us`, `time_us` or `timestamp_us`). This clock has its own offset and it runs at a
+slightly different rate than the computer clock, up to about 1 %. A ClockSync object sends a
+ping() command to the device every few seconds and notes the computer time before and after
+it. From these probes it fits the offset and the rate of the device clock:
+
+    clock = clock_sync.ClockSync(rp)
+    host_time = clock.to_host(report.start_time_us)     # the same scale as time.time()
+
+The probes delayed by a busy computer are filtered out by their round-trip time, and the
+rest are fitted by the Theil-Sen estimator, which ignores the remaining outliers. A constant
+error remains due to the unknown asymmetry of the USB latency; it is below half of the round
+trip, i.e. typically below 0.1 ms.
+
+Reports of several devices, each with its own ClockSync, are interleaved by their time with
+merge() (for recorded reports) or StreamMerger (for reports as they come).
+"""
+
+from collections import namedtuple
+import heapq
+import threading
+import time
+
+import numpy as np
+
+
+# Report fields with the device time, in the order of preference
+TIME_FIELDS = ('start_time_us', 'time_us', 'timestamp_us', 'start_timestamp_us')
+
+Probe = namedtuple('Probe', ['host_send', 'host_receive', 'device_us'])
+ClockFit = namedtuple('ClockFit', ['device_ref_us', 'host_ref', 'rate', 'residual_s', 'probes_used'])
+AlignedReport = namedtuple('AlignedReport', ['host_time', 'source', 'report'])
+
+
+
+def report_time_us(report):
+    """ Returns the device timestamp of a report, in microseconds """
+    for field in TIME_FIELDS:
+        if field in report._fields:
+            return getattr(report, field)
+    raise ValueError(f"Report {type(report).__name__} has no timestamp")
+
+
+
+def fit_clock(probes, rtt_quantile=0.5, min_span_s=1.):
+    """
+    Fits host time = host_ref + rate * (device time - device_ref) to the probes. Only those
+    with round trip up to *rtt_quantile* of all are used. The rate is assumed to be 1 until
+    the probes span at least *min_span_s*.
+    """
+    host_send, host_receive, device_us = (np.array(x) for x in zip(*probes))
+    rtt = host_receive - host_send
+    keep = rtt <= np.quantile(rtt, rtt_quantile)
+    host, device_us = ((host_send + host_receive) / 2)[keep], device_us[keep].astype(np.int64)
+
+    device_ref_us = int(np.median(device_us))
+    device_s = (device_us - device_ref_us) * 1e-6
+    rate = 1.
+    if np.ptp(device_s) >= min_span_s:
+        # Theil-Sen: median slope of pairs, skipping the close pairs whose slopes are mostly noise
+        i, j = np.triu_indices(len(device_s), k=1)
+        distant = np.abs(device_s[j] - device_s[i]) >= np.ptp(device_s) / 4
+        rate = float(np.median((host[j] - host[i])[distant] / (device_s[j] - device_s[i])[distant]))
+    offsets = host - rate * device_s
+    host_ref = float(np.median(offsets))
+    return ClockFit(device_ref_us, host_ref, rate, float(np.median(np.abs(offsets - host_ref))), int(keep.sum()))
+
+
+
+class ClockSync():
+    def __init__(self, rp, interval_s=2., window=100, initial_probes=8, rtt_quantile=0.5, start=True):
+        """
+        Probes the clock of the device *rp* every *interval_s* in a background thread, and fits
+        the last *window* probes. The first *initial_probes* are sent right away, so that
+        to_host() can be used immediately (though with the rate fitted only later). With
+        *start* False, no probes are sent; they may be given to add_probe() instead.
+        """
+        self.rp, self.interval_s, self.window = rp, interval_s, window
+        self.rtt_quantile = rtt_quantile
+        self.lock = threading.Lock()
+        self.probes, self.fit, self.restarts = [], None, 0
+        self.running = threading.Event()
+        if start:
+            for x in range(initial_probes):
+                self.probe()
+            self.running.set()
+            self.thread = threading.Thread(target=self._prober, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+
+    def _prober(self):
+        while self.running.is_set():
+            time.sleep(self.interval_s)
+            try:
+                self.probe()
+            except RuntimeError:    # device disconnected
+                pass
+
+    def probe(self):
+        host_send = time.time()
+        report = self.rp.ping()
+        self.add_probe(Probe(host_send, time.time(), report.time_us))
+
+    def add_probe(self, probe):
+        with self.lock:
+            if self.probes and probe.device_us < self.probes[-1].device_us:
+                self.probes.clear()     # the device restarted, and so did its clock
+                self.restarts += 1
+            self.probes = self.probes[-self.window+1:] + [probe]
+            self.fit = fit_clock(self.probes, self.rtt_quantile)
+
+    @property
+    def drift_ppm(self):
+        """ How much faster the device clock runs, in parts per million """
+        return (1 / self.fit.rate - 1) * 1e6
+
+    def to_host(self, device_us):
+        """ Converts device time(s) in microseconds to the computer time in seconds, like time.time() """
+        fit = self.fit
+        if fit is None:
+            raise RuntimeError("No clock probes yet")
+        return fit.host_ref + fit.rate * 1e-6 * (np.asarray(device_us, dtype=np.int64) - fit.device_ref_us)
+
+    def block_times(self, report):
+        """ Computer times of the samples in a block (like ADC reports), spread evenly from its start to its end """
+        start, end = self.to_host([report.start_time_us, report.end_time_us])
+        return start + (end - start) * np.arange(len(report.data)) / len(report.data)
+
+
+
+def merge(*sources):
+    """
+    Each source is a (ClockSync, reports) pair, where the reports are in the order they came.
+    Yields AlignedReport tuples of all sources in the order of their computer time; *source*
+    is the index of the pair.
+    """
+    def aligned(index, clock, reports):
+        for report in reports:
+            yield AlignedReport(float(clock.to_host(report_time_us(report))), index, report)
+    return heapq.merge(*(aligned(index, clock, reports) for index, (clock, reports) in enumerate(sources)),
+            key=lambda a: a.host_time)
+
+
+
+class StreamMerger():
+    def __init__(self, clocks, callback, max_wait_s=0.5):
+        """
+        Passes the reports from several devices to *callback* as AlignedReport tuples, in the
+        order of their computer time. Use `merger.source(index)` as the _callback for the
+        device with the ClockSync clocks[index]. A report is passed on once all sources have
+        sent a later one; sources which did not send anything for *max_wait_s* are not waited for.
+        """
+        self.clocks, self.callback, self.max_wait_s = clocks, callback, max_wait_s
+        self.lock = threading.Lock()
+        self.heap, self.counter = [], 0
+        self.latest = [None] * len(clocks)      # host time of the last report from each source
+        self.arrival = [time.time()] * len(clocks)  # when it came
+
+    def source(self, index):
+        return lambda report: self.push(index, report)
+
+    def push(self, index, report):
+        host_time = float(self.clocks[index].to_host(report_time_us(report)))
+        with self.lock:
+            now = time.time()
+            self.latest[index], self.arrival[index] = host_time, now
+            heapq.heappush(self.heap, (host_time, self.counter, AlignedReport(host_time, index, report)))
+            self.counter += 1
+            waiting = [t for t, arrival in zip(self.latest, self.arrival) if now - arrival < self.max_wait_s]
+            if None in waiting:
+                return
+            while self.heap and self.heap[0][0] <= min(waiting):
+                self.callback(heapq.heappop(self.heap)[2])
+
+    def flush(self):
+        """ Passes on all reports still held """
+        with self.lock:
+            while self.heap:
+                self.callback(heapq.heappop(self.heap)[2])
+
+
+
+if __name__ == "__main__":
+    # Self-check on simulated devices: clocks 1 % fast and 0.3 % slow, USB latency with random
+    # jitter and occasional long delays of the computer (does not need any device)
+    rng = np.random.default_rng(0)
+
+    def simulated_probes(offset_s, device_rate, count=100, interval_s=2.):
+        probes, host = [], 1.8e9
+        for x in range(count):
+            host += interval_s
+            out_delay, back_delay = rng.exponential(100e-6, 2) + 50e-6
+            if rng.random() < 0.1:
+                back_delay += rng.uniform(0.005, 0.05)     # the computer was busy
+            device_us = int((host + out_delay - 1.8e9 + offset_s) * device_rate * 1e6)
+            probes.append(Probe(host, host + out_delay + back_delay, device_us))
+        truth = lambda device_us: 1.8e9 + np.asarray(device_us) / device_rate * 1e-6 - offset_s
+        return probes, truth
+
+    clocks = []
+    for offset_s, device_rate in ((12.345, 1.01), (0.5, 0.997)):
+        probes, truth = simulated_probes(offset_s, device_rate)
+        clock = ClockSync(None, start=False)
+        t0 = time.perf_counter()
+        for probe in probes:
+            clock.add_probe(probe)
+        dt = (time.perf_counter() - t0) / len(probes)
+
+        test_us = np.linspace(probes[len(probes)//2].device_us, probes[-1].device_us, 1000).astype(np.int64)
+        error = np.abs(clock.to_host(test_us) - truth(test_us)).max()
+        naive = min(probes, key=lambda p: p.host_receive - p.host_send)     # one best probe, rate of 1
+        naive_error = np.abs((naive.host_send + naive.host_receive) / 2 +
+                (test_us - naive.device_us) * 1e-6 - truth(test_us)).max()
+        print(f"device clock {device_rate-1:+.1%}: fitted drift {clock.drift_ppm:.0f} ppm, max error " +
+                f"{error*1e6:.1f} us (single-probe offset: {naive_error*1e3:.0f} ms), {dt*1e3:.2f} ms per probe")
+        assert error < 200e-6 and naive_error > 0.01
+        clocks.append(clock)
+
+    # Merging: the same events recorded by both devices come out in pairs
+    Report = namedtuple('gpio_on_change_report_values', ['gpio', 'events', 'time_us'])
+    event_times = 1.8e9 + 120 + 0.3 * np.arange(200) + rng.uniform(0, 0.1, 200)
+    streams = [[Report(0, 8, int((t - 1.8e9 + offset_s) * rate * 1e6)) for t in event_times]
+            for offset_s, rate in ((12.345, 1.01), (0.5, 0.997))]
+    merged = list(merge((clocks[0], streams[0]), (clocks[1], streams[1])))
+    assert len(merged) == 400
+    assert all({a.source for a in merged[i:i+2]} == {0, 1} for i in range(0, 400, 2))
+
+    live = []
+    merger = StreamMerger(clocks, live.append)
+    for r0, r1 in zip(*streams):
+        merger.source(1)(r1)
+        merger.source(0)(r0)
+    merger.flush()
+    assert [a.host_time for a in live] == sorted(a.host_time for a in merged)
+    print("Merged 2x200 events in order")
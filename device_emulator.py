@@ -0,0 +1,418 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+"""
+A simulated rp2daq device on a pseudo-terminal, for testing scripts without any hardware.
+
+The emulator decodes the commands by the same C code as the Python interface does (see
+c_code_parser.get_command_formats), so it follows the firmware on its own. Its pseudo-terminal
+behaves like the USB serial port of a real device:
+
+    emulator = device_emulator.DeviceEmulator()
+    rp = rp2daq.Rp2daq(transport=transports.UsbThread(port=emulator.port))  # or transport="emulator"
+
+Emulated are: identify, ping, the GPIO levels (gpio_out, gpio_pull and gpio_in, with the
+events of gpio_on_change and gpio_on_change_batch), the ADC (a sine wave on each channel, at the
+requested timing), the logic analyzer (synthetic SPI traffic on its first three GPIOs), and the
+steppers (stepper_init, stepper_move finishing at once, stepper_status, and stepper_telemetry
+with its periodic reports). All other commands get one immediate report with zero values, except that
+pwm_waveform_start reports its playback as finished. The GPIO levels can also be driven from
+outside by set_level(). Needs POSIX.
+"""
+
+import logging
+import os
+import struct
+import threading
+import time
+import tty
+
+import numpy as np
+
+import c_code_parser
+import logic_analyzer
+
+
+# Fields set in the otherwise zero reports of the commands which are not emulated
+GENERIC_REPORT_FIELDS = {'pwm_waveform_start': {'chunks_played': 1, 'finished': 1}}
+
+
+
+def pack_12bit(values):
+    """ Packs pairs of 12-bit values into byte triplets, like compress_2x12b_to_24b_inplace() in firmware """
+    v = np.asarray(values, dtype=np.uint16)
+    v = np.concatenate([v, np.zeros(len(v) % 2, dtype=np.uint16)]).reshape(-1, 2)
+    a = v[:, 0] & 0xFF
+    b = ((v[:, 0] >> 8) << 4 | (v[:, 1] & 0xFF) >> 4) & 0xFF
+    c = ((v[:, 1] & 0x0F) << 4 | v[:, 1] >> 8) & 0xFF
+    return np.stack([a, b, c], axis=1).astype(np.uint8).tobytes()[:(len(values) * 12 + 7) // 8]
+
+
+
+def spi_samples(count, rng, oversampling=8):
+    """ Samples of SPI traffic of random bytes: chip select in bit 0, clock in bit 1, data in bit 2 """
+    bits = rng.integers(0, 2, count // oversampling + 1)
+    clk = np.tile(np.repeat([0, 1], oversampling // 2), len(bits))
+    mosi = np.repeat(bits, oversampling)
+    return (clk << 1 | mosi << 2)[:count]
+
+
+
+class GpioBatchEncoder():
+    """
+    Packs edges into the 16-bit records of gpio_on_change_batch reports, following
+    gpio_batch_IRQ() in firmware; *send* is called with the start_time_us, events_lost and
+    records of each batch. With *locked* set, all buffers are taken as waiting for USB.
+    """
+    def __init__(self, batch_events, now_us, send):
+        self.batch_events, self.send = batch_events, send
+        self.records, self.events_lost, self.locked = [], 0, False
+        self.ref_time_us = self.prev_time_us = self.first_event_us = now_us
+
+    def _append(self, record, record_time_us):
+        if self.locked:
+            return False
+        if not self.records:
+            self.first_event_us = record_time_us
+        self.records.append(record)
+        self.prev_time_us = record_time_us
+        if len(self.records) >= self.batch_events:
+            self.flush()
+        return True
+
+    def edge(self, gpio, rising, now_us):
+        delta = now_us - self.prev_time_us     # (includes the time of the records lost before)
+        while delta >= 1024:
+            units = min(delta // 1024, 2047)
+            if not self._append(31 | units << 5, self.prev_time_us + units * 1024):
+                self.events_lost += 1
+                return
+            delta -= units * 1024
+        if not self._append(gpio | int(rising) << 5 | delta << 6, now_us):
+            self.events_lost += 1
+
+    def flush(self):
+        records, self.records = self.records, []
+        self.send(self.ref_time_us, self.events_lost, records)
+        self.events_lost, self.ref_time_us = 0, self.prev_time_us
+
+
+
+class DeviceEmulator():
+    def __init__(self, device_id="E6605C0DE0000001", adc_signal_hz=1000., seed=0):
+        """ Opens a pseudo-terminal, whose *port* can be given to the USB transports """
+        self.device_id = device_id
+        self.adc_signal_hz = adc_signal_hz
+        self.rng = np.random.default_rng(seed)
+        self.t0 = time.perf_counter()
+
+        self.version = f"rp2daq_{c_code_parser.get_C_code_version()}_".encode()
+        self.command_formats = c_code_parser.get_command_formats()
+        analysis = c_code_parser.analyze_c_firmware()
+        self.report_formats, self.report_fields = analysis[2], analysis[3]
+        self.codes = {name: code for code, name in analysis[0].items()}
+
+        self.levels = [0] * 30                  # GPIO levels
+        self.on_change = {}                     # gpio -> (on_rising_edge, on_falling_edge)
+        self.streams = {}                       # 'adc' or 'logic_analyzer' -> threading.Event to stop it
+        self.write_lock = threading.Lock()
+
+        self.batch_gpios = {}                   # gpio -> (on_rising_edge, on_falling_edge), for gpio_on_change_batch
+        self.batch_encoder, self.batch_timeout_us = None, 0
+        self.batch_lock = threading.Lock()
+
+        self.stepper_nanopos = {}               # initialized stepper -> its nanopos
+        self.telemetry_stop = threading.Event()
+        self.telemetry_min_interval_us = c_code_parser.get_C_code_define('STEPPER_TELEMETRY_MIN_INTERVAL_US')
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.running = True
+        threading.Thread(target=self._command_reader, daemon=True).start()
+
+    def close(self):
+        self.running = False
+        for stop in self.streams.values():
+            stop.set()
+        self.telemetry_stop.set()
+        os.close(self.slave)
+        os.close(self.master)
+
+    def time_us(self):
+        return int((time.perf_counter() - self.t0) * 1e6)
+
+    def _read_exactly(self, length):
+        data = b''
+        while len(data) < length:
+            data += os.read(self.master, length - len(data))
+        return data
+
+    def _command_reader(self):
+        try:
+            while self.running:
+                length, = struct.unpack('<H', self._read_exactly(2))
+                message = self._read_exactly(length)
+                self._handle(message[0], message[1:])
+        except OSError:     # closed
+            pass
+
+    def send_report(self, name, data=b'', **fields):
+        code = self.codes[name]
+        fields['report_code'] = code
+        values = [fields.get(field, 0) for field in self.report_fields[code]]
+        report = struct.pack(self.report_formats[code], *values) + data
+        with self.write_lock:
+            while report:
+                report = report[os.write(self.master, report):]
+
+    def _handle(self, code, arg_bytes):
+        if code not in self.command_formats:
+            logging.warning(f"Emulator got unknown command {code}")
+            return
+        name, struct_format, arg_names, array_typecode = self.command_formats[code]
+        fixed_length = struct.calcsize(struct_format)
+        args = dict(zip(arg_names, struct.unpack(struct_format, arg_bytes[:fixed_length])))
+        if array_typecode:
+            array_bytes = arg_bytes[fixed_length:]
+            args['_array'] = struct.unpack(f'<{len(array_bytes) // struct.calcsize(array_typecode)}{array_typecode}', array_bytes)
+
+        handler = getattr(self, 'cmd_' + name, None)
+        if handler:
+            handler(**args)
+        else:
+            self.send_report(name, **GENERIC_REPORT_FIELDS.get(name, {}))
+
+    def set_level(self, gpio, value):
+        """ Changes a GPIO level as if driven from outside, with gpio_on_change events """
+        old, self.levels[gpio] = self.levels[gpio], value
+        on_rising_edge, on_falling_edge = self.on_change.get(gpio, (0, 0))
+        if value > old and on_rising_edge or value < old and on_falling_edge:
+            self.send_report('gpio_on_change', gpio=gpio, events=8 if value > old else 4, time_us=self.time_us())
+        with self.batch_lock:
+            on_rising_edge, on_falling_edge = self.batch_gpios.get(gpio, (0, 0))
+            if value > old and on_rising_edge or value < old and on_falling_edge:
+                self.batch_encoder.edge(gpio, value > old, self.time_us())
+
+
+    ## Emulated commands, with the same arguments as in firmware
+
+    def cmd_identify(self, flush_buffer):
+        text = self.version + self.device_id.encode()
+        self.send_report('identify', text, data_count=len(text), data_bitwidth=8)
+
+    def cmd_ping(self, tag):
+        self.send_report('ping', tag=tag, time_us=self.time_us())
+
+    def cmd_gpio_out(self, gpio, value):
+        self.set_level(gpio, value)
+        self.send_report('gpio_out')
+
+    def cmd_gpio_pull(self, gpio, value):
+        self.set_level(gpio, value)
+        self.send_report('gpio_pull')
+
+    def cmd_gpio_in(self, gpio):
+        self.send_report('gpio_in', gpio=gpio, value=self.levels[gpio])
+
+    def cmd_gpio_on_change(self, gpio, on_rising_edge, on_falling_edge):
+        self.on_change[gpio] = (on_rising_edge, on_falling_edge)
+
+    def cmd_gpio_on_change_batch(self, gpio, on_rising_edge, on_falling_edge, batch_events, batch_timeout_us):
+        with self.batch_lock:
+            if not self.batch_encoder or not self.batch_gpios:  # (re)start the time reference
+                self.batch_encoder = GpioBatchEncoder(batch_events, self.time_us(), self._send_batch)
+            self.batch_encoder.batch_events = min(max(batch_events, 1), 1024)
+            self.batch_timeout_us = batch_timeout_us
+            if on_rising_edge or on_falling_edge:
+                if not self.batch_gpios:
+                    threading.Thread(target=self._batch_timer, daemon=True).start()
+                self.batch_gpios[gpio] = (on_rising_edge, on_falling_edge)
+            else:
+                self.batch_gpios.pop(gpio, None)
+                self.batch_encoder.flush()  # the (possibly empty) final report
+
+    def _send_batch(self, start_time_us, events_lost, records):
+        self.send_report('gpio_on_change_batch', struct.pack(f'<{len(records)}H', *records),
+                data_count=len(records), data_bitwidth=16, start_time_us=start_time_us, events_lost=events_lost)
+
+    def _batch_timer(self):
+        # Like gpio_batch_on_main_loop(), reports the batches that became too old
+        while self.running and self.batch_gpios:
+            time.sleep(0.001)
+            with self.batch_lock:
+                encoder = self.batch_encoder
+                if encoder.records and self.batch_timeout_us and \
+                        self.time_us() - encoder.first_event_us >= self.batch_timeout_us:
+                    encoder.flush()
+
+    def cmd_adc(self, channel_mask, blocksize, infinite, blocks_to_send, clkdiv, trigger_gpio, trigger_on_falling_edge):
+        if 'adc' not in self.streams:
+            self._start_stream('adc', self._adc_block, blocks_to_send, infinite,
+                    channel_mask=channel_mask, blocksize=blocksize, clkdiv=clkdiv)
+
+    def cmd_adc_stop(self, finish_last_adc_packet):
+        self.send_report('adc_stop', aborted_blocks_to_send=self._stop_stream('adc'))
+
+    def cmd_logic_analyzer(self, first_gpio, gpio_count, clkdiv, clkdiv_frac, blocksize, infinite, blocks_to_send):
+        if 'logic_analyzer' not in self.streams:
+            self._start_stream('logic_analyzer', self._logic_block, blocks_to_send, infinite,
+                    first_gpio=first_gpio, gpio_count=min(gpio_count, 30 - first_gpio), clkdiv=clkdiv, clkdiv_frac=clkdiv_frac,
+                    blocksize=blocksize)
+
+    def cmd_logic_analyzer_stop(self, finish_last_block):
+        self.send_report('logic_analyzer_stop', aborted_blocks_to_send=self._stop_stream('logic_analyzer'))
+
+    def cmd_stepper_init(self, stepper_number, dir_gpio, step_gpio, endswitch_gpio, disable_gpio, inertia):
+        self.stepper_nanopos[stepper_number] = 0
+        self.send_report('stepper_init')
+
+    def cmd_stepper_move(self, stepper_number, to, speed, endswitch_sensitive_up, endswitch_sensitive_down,
+            relative, reset_nanopos_at_endswitch):
+        if stepper_number not in self.stepper_nanopos:
+            return  # (no report, like in firmware)
+        nanopos = self.stepper_nanopos[stepper_number] = to + (self.stepper_nanopos[stepper_number] if relative else 0)
+        now = self.time_us()
+        self.send_report('stepper_move', stepper_number=stepper_number, nanopos=nanopos,
+                steppers_init_bitmask=self._steppers_init_bitmask(), start_time_us=now, end_time_us=now)
+
+    def cmd_stepper_status(self, stepper_number):
+        self.send_report('stepper_status', timestamp_us=self.time_us(), stepper_number=stepper_number,
+                nanopos=self.stepper_nanopos.get(stepper_number, 0), steppers_init_bitmask=self._steppers_init_bitmask())
+
+    def cmd_stepper_telemetry(self, stepper_mask, interval_us):
+        self.telemetry_stop.set()
+        stop = self.telemetry_stop = threading.Event()
+        self._send_telemetry(stepper_mask)
+        if interval_us:
+            interval_s = max(interval_us, self.telemetry_min_interval_us) / 1e6
+            def run():
+                while not stop.wait(interval_s):
+                    self._send_telemetry(stepper_mask)
+            threading.Thread(target=run, daemon=True).start()
+
+    def _steppers_init_bitmask(self):
+        return sum(1 << m for m in self.stepper_nanopos)
+
+    def _send_telemetry(self, stepper_mask):
+        nanopos = [self.stepper_nanopos.get(m, 0) for m in range(16) if stepper_mask & (1 << m)]
+        self.send_report('stepper_telemetry', struct.pack(f'<{len(nanopos)}i', *nanopos), data_count=len(nanopos),
+                data_bitwidth=32, timestamp_us=self.time_us(), stepper_mask=stepper_mask,
+                steppers_init_bitmask=self._steppers_init_bitmask())
+
+
+    ## Streams of blocks, each sent after the time its acquisition would take
+
+    def _start_stream(self, name, make_block, blocks_to_send, infinite, **config):
+        stop = self.streams[name] = threading.Event()
+        stop.blocks_to_send = blocks_to_send
+
+        def run():
+            sample_index = 0
+            while (infinite or stop.blocks_to_send) and not stop.is_set():
+                start_time_us = self.time_us()
+                duration_s, data, fields, sample_index = make_block(sample_index, **config)
+                stop.wait(duration_s)
+                if not infinite:
+                    stop.blocks_to_send = max(0, stop.blocks_to_send - 1)
+                self.send_report(name, data, start_time_us=start_time_us, end_time_us=self.time_us(),
+                        blocks_to_send=stop.blocks_to_send, **fields)
+                if stop.is_set():
+                    break
+            self.streams.pop(name, None)
+        threading.Thread(target=run, daemon=True).start()
+
+    def _stop_stream(self, name):
+        stop = self.streams.get(name)
+        if not stop:
+            return 0
+        aborted, stop.blocks_to_send = stop.blocks_to_send, 0
+        stop.set()
+        return aborted
+
+    def _adc_block(self, sample_index, channel_mask, blocksize, clkdiv):
+        # Channels interleaved in the round-robin order; each a sine of different phase, with noise
+        channels = [ch for ch in range(5) if channel_mask & (1 << ch)]
+        sample_rate = 48e6 / (clkdiv + 1)
+        i = sample_index + np.arange(blocksize)
+        channel = np.array(channels)[i % len(channels)]
+        t = (i // len(channels)) / (sample_rate / len(channels))
+        values = 2048 + 1500 * np.sin(2 * np.pi * self.adc_signal_hz * t + channel) + self.rng.normal(0, 3, blocksize)
+        data = pack_12bit(np.clip(np.rint(values), 0, 4095))
+        return blocksize / sample_rate, data, dict(data_count=blocksize, data_bitwidth=12, channel_mask=channel_mask), \
+                sample_index + blocksize
+
+    def _logic_block(self, sample_index, first_gpio, gpio_count, clkdiv, clkdiv_frac, blocksize):
+        samples_per_word = logic_analyzer.samples_per_word(gpio_count)
+        samples = spi_samples(blocksize * samples_per_word, self.rng)
+        data = struct.pack(f'<{blocksize}I', *logic_analyzer.pack_samples(samples, gpio_count))
+        duration_s = blocksize * samples_per_word / logic_analyzer.sample_rate(clkdiv, clkdiv_frac)
+        return duration_s, data, dict(data_count=blocksize, data_bitwidth=32, first_gpio=first_gpio,
+                gpio_count=gpio_count, clkdiv=clkdiv, clkdiv_frac=clkdiv_frac), sample_index + len(samples)
+
+
+
+if __name__ == "__main__":
+    # Self-check through the whole Python interface (needs no device)
+    from collections import namedtuple
+    import rp2daq
+    import transports
+
+    # Decoding of batched edges, with batches flushed within runs of overflow records, and with
+    # events lost while the buffers wait for USB
+    Batch = namedtuple('Batch', ['start_time_us', 'events_lost', 'data'])
+    batches = []
+    encoder = GpioBatchEncoder(batch_events=2, now_us=100, send=lambda *b: batches.append(Batch(*b)))
+    event_times = [150, 9_000_000, 9_000_500, 20_000_000, 30_000_000, 30_000_001]
+    for t in event_times:
+        encoder.locked = (t == 20_000_000)
+        encoder.edge(7, True, t)
+    encoder.flush()
+    decoded = np.concatenate([rp2daq.decode_gpio_batch(batch)[0] for batch in batches])
+    expected = [t for t in event_times if t != 20_000_000]
+    assert list(decoded) == expected and sum(b.events_lost for b in batches) == 1, (decoded, expected)
+
+    emulator = DeviceEmulator()
+    rp = rp2daq.Rp2daq(transport=transports.UsbThread(port=emulator.port))
+
+    assert rp.ping(tag=1234).tag == 1234
+    rp.gpio_out(3, 1)
+    assert rp.gpio_in(3).value == 1
+
+    events = []
+    rp.gpio_on_change(5, on_rising_edge=1, on_falling_edge=1, _callback=events.append)
+    rp.ping(_urgent=False)   # the emulator has taken the command once it replies (an urgent ping could overtake it)
+    emulator.set_level(5, 1)
+    emulator.set_level(5, 0)
+
+    report = rp.adc(channel_mask=3, blocksize=1000, clkdiv=959)    # 2x 25 ksps
+    a = np.array(report.data[0::2])
+    assert len(report.data) == 1000 and 500 < a.min() and a.max() < 3600 and np.ptp(a) > 2500
+
+    report = rp.logic_analyzer(first_gpio=0, gpio_count=3, blocksize=100)
+    clk = logic_analyzer.bit_planes(report, [1])[0]
+    assert len(logic_analyzer.edges(report, [1]).index) in (249, 250) and clk.any()   # 1000 samples, clock period 8
+    assert rp.logic_analyzer(first_gpio=20, gpio_count=16, blocksize=10).gpio_count == 10   # up to GPIO 29
+
+    # Blocking calls of the commands whose later reports are periodic or batched
+    rp.stepper_init(0, dir_gpio=10, step_gpio=11)
+    rp.stepper_move(0, to=-100, speed=100)
+    telemetry = []
+    rp.stepper_telemetry(stepper_mask=1, interval_us=0)
+    rp.stepper_telemetry(stepper_mask=1, interval_us=2000, _callback=telemetry.append)
+    time.sleep(0.05)
+    assert rp.stepper_telemetry(stepper_mask=1, interval_us=0).data == [-100] == [rp.stepper_status(0).nanopos]
+    assert len(telemetry) > 5 and telemetry[-1].data == [-100] and rp.stepper_state[0].nanopos == -100
+
+    rp.gpio_on_change_batch(6, batch_timeout_us=0, _callback=lambda report: None)
+    rp.ping(_urgent=False)
+    for level in (1, 0, 1):
+        emulator.set_level(6, level)
+    final = rp.gpio_on_change_batch(6, on_rising_edge=0, on_falling_edge=0)   # reports the pending edges
+    assert list(rp2daq.decode_gpio_batch(final)[2]) == [True, False, True]
+
+    time.sleep(0.05)
+    assert [e.events for e in events] == [8, 4]
+    print(f"Emulated device {emulator.device_id} on {emulator.port} works")
+    rp.quit()
+    emulator.close()
@@ -0,0 +1,22 @@
+#!/usr/bin/python3  
+#-*- coding: utf-8 -*-
+"""
+Streams the ADC continuously and shows the last 100 ms of all channels in a live plot. 
+
+The LiveView object keeps millions of recent samples and their min/max decimated envelopes, 
+so the plot stays fluent at the full 500 ksps rate; see live_view.py for details.
+"""
+
+## User options
+channels = [0, 1]    # 0,1,2 are GPIO 26-28;  3 is V_ref and 4 is internal thermometer
+clkdiv = 95          # 48 MHz/(95+1) = 500 ksps in total, shared by all channels
+
+import rp2daq
+import live_view
+
+rp = rp2daq.Rp2daq()
+channel_mask = sum(2**ch for ch in channels)
+view = live_view.LiveView(channel_mask=channel_mask, clkdiv=clkdiv)
+rp.adc(channel_mask=channel_mask, blocksize=1000*len(channels), infinite=1, clkdiv=clkdiv, _callback=view)
+view.show(window_s=0.1)   # blocks until the window is closed
+rp.adc_stop()
@@ -10,6 +10,11 @@
 # 50 000 messages per second seems at the edge of what rp2daq handles; higher frequency results 
 # in reports being silently dropped. 
 
+# For faster signals, set BATCHED = True. Then the edges are logged by gpio_on_change_batch, which 
+# sends one report per up to 1000 edges; its data are decoded into NumPy arrays of timestamps.
+
+BATCHED = False
+
 wait_sec = 1.0
 clkdiv = 250       # Since system clock is 250 MHz, so 250 corresponds to 1 MHz
 wrap_value = 20-1  # Dividing 1 MHz by 20 results in 50 000 reports/s
@@ -39,10 +44,23 @@ def event_counter(rv):
     ## Define a report handler 
     count[0] += 1
 
-rp.gpio_on_change(gpio=0, 
-        on_rising_edge=True, 
-        on_falling_edge=False, 
-        _callback=event_counter) # Start asynchronous reporting on each GPIO change
+def batch_counter(rv): 
+    ## Define a report handler for batched edges; each report carries many of them
+    time_us, gpio, rising = rp2daq.decode_gpio_batch(rv)
+    count[0] += len(time_us)
+    if rv.events_lost: 
+        print(f'Warning: {rv.events_lost} edges were lost')
+
+if BATCHED:
+    rp.gpio_on_change_batch(gpio=0, 
+            on_rising_edge=True, 
+            on_falling_edge=False, 
+            _callback=batch_counter) # Start asynchronous logging of GPIO changes in batches
+else:
+    rp.gpio_on_change(gpio=0, 
+            on_rising_edge=True, 
+            on_falling_edge=False, 
+            _callback=event_counter) # Start asynchronous reporting on each GPIO change
 
 time.sleep(wait_sec)
 
@@ -5,7 +5,7 @@
 ## combination of bits is possible, too - only make sure it is set in the bit mask.
 
 ## Some tips:
-## * Note that maximum count of patterns in one sequence is 16.
+## * Note that maximum count of patterns in one sequence is 512.
 ## * GPIO 25 (i.e. on-board LED) is the maximum number to be set by the sequence. Further binary
 ##   digits are ignored
 ## * If the sequence behaves weird, make sure the bit mask has 1 on all pins being used.
@@ -13,9 +13,10 @@
 ## * It may be more convenient to address GPIOs by bit-shifting, like 1<<25, instead of long binary 
 ##   numbers like here).
 ## * After a sequence finishes, the used GPIOs are left in the output state of its last stage.
-## * Given by the USB messaging and Python code execution, the delay between two consecutive sequences 
-##   is some 2-3 ms, with significant jitter. 
-## * Re-defining active sequences asynchronously wasn't tested yet. Use at your own risk.
+## * When the next sequence is issued only after the report of the previous one arrives, the USB messaging 
+##   and Python code execution delay it by some 2-3 ms, with significant jitter. 
+## * Sequences issued while another one runs are queued (up to 8) and follow it without a gap. For long
+##   waveforms, use the GpioSequence class in gpio_sequence.py which streams them chunk by chunk.
 
 import rp2daq, time
 rp = rp2daq.Rp2daq()
@@ -29,7 +30,7 @@ while True:
                        #         2. ...2 ...1 ...1 .1
                        #         5. ...0 ...6 ...2 .098_7654_3210   = GPIO numbering 
         rp.gpio_out_seq(0b0000_0010_0000_0000_0000_0000_0000_0011,    # the bit mask
-                        0b0000_0010_0000_0000_0000_0000_0000_0011, 10, #  0
+                       [0b0000_0010_0000_0000_0000_0000_0000_0011, 10, #  0
                         0b0000_0000_0000_0000_0000_0000_0000_0010, delay_us, #  1
                         0b0000_0000_0000_0000_0000_0000_0000_0001, delay_us, #  2
                         #0b0000_0000_0000_0000_0000_0000_0000_0010, delay_us, #  3
@@ -46,6 +47,6 @@ while True:
                         #0b0000_0000_0000_0000_0000_0000_0000_0011, delay_us, # 13
                         #0b0000_0010_0000_0000_0000_0000_0000_0001, delay_us, # 14
                         #0b0000_0000_0000_0000_0000_0000_0000_0000, delay_us, # 15  
-                        )
+                        ])
         )
 
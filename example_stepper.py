@@ -22,10 +22,15 @@ result = rp.stepper_move(1,
 print("The stepper has finished its movement, giving following return values:\n", result)
 import time
 time.sleep(.3)
+
+# Instead of polling stepper_status(), the device can push the positions periodically
+rp.stepper_telemetry(stepper_mask=0b10, interval_us=50000, 
+        _callback=lambda r: print("  stepper 1 is now at", rp.stepper_state[1].nanopos))
 result = rp.stepper_move(1, 
         to=zero_pos[1] + 1000000, 
         speed=560, 
         ) 
+rp.stepper_telemetry(interval_us=0)  # stop the telemetry
 print("The stepper has finished its movement, giving following return values:\n", result)
 
 print("Its status is:\n", rp.stepper_status(0))
@@ -71,3 +71,10 @@ print("All steppers have finished their jobs, quitting")
 time.sleep(.1)
 
 # Note the stepper position etc. can also be monitored independently (even from within a callback) with rp.stepper_status(0)
+
+# Tip: For longer paths, stepper_planner.MotionPlanner does the same grouping, but additionally chooses
+# the speed of each axis so that all arrive together, and issues each segment straight from the callbacks:
+#   import stepper_planner
+#   planner = stepper_planner.MotionPlanner(rp, inertia={0: 190, 1: 190}, max_speed=64)
+#   for f in planner.run([{0: zero_pos[0]+x*200000, 1: zero_pos[1]+y*200000} for x,y in coords_to_go]): 
+#       f.result()
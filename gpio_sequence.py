@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+"""
+Host-side compiler for long GPIO output sequences.
+
+A single gpio_out_seq command can hold up to 512 stages, and each command costs a USB round
+trip of some 2-3 ms. The GpioSequence class accepts arbitrarily long lists of edges, compiles
+them into the minimum number of gpio_out_seq chunks and streams them asynchronously, so that
+the device always has the next chunk queued before the running one finishes. The outputs thus
+change without gaps between the chunks.
+
+Typical use:
+
+    seq = GpioSequence(rp)
+    seq.add_waveforms({0: [(0, 1), (10, 0), (15, 1)], 1: [(5, 1), (20, 0)]})
+    stats = seq.run()
+    print(stats.max_gap_us, stats.jitter_us)
+"""
+
+from collections import namedtuple
+import logging
+import threading
+
+import c_code_parser
+
+
+
+GpioSequenceStats = namedtuple('GpioSequenceStats',
+        ['chunk_count', 'stage_count', 'gaps_us', 'max_gap_us', 'mean_gap_us', 'jitter_us', 'underruns', 'duration_us'])
+
+
+
+class GpioSequence():
+    def __init__(self, rp, initial_value=0):
+        """
+        Collects edges for later compilation. All times are in microseconds from the start of
+        the sequence. The *initial_value* bit mask defines the state of the used GPIOs before
+        their first edge.
+        """
+        self.rp = rp
+        self.initial_value = initial_value
+        self.edges = []  # (time_us, gpio, value) tuples
+
+        self.max_stages = c_code_parser.get_C_code_define('GPIO_OUT_SEQ_MAXLEN')
+        self.ring_stages = c_code_parser.get_C_code_define('GPIO_OUT_SEQ_RING')
+        self.queue_length = c_code_parser.get_C_code_define('GPIO_OUT_SEQ_QUEUE')
+
+        self.done = threading.Event()
+        self.stats = None
+        self.error = None
+
+    def add_edges(self, edges):
+        """ Adds an iterable of (time_us, gpio, value) tuples, in any order. """
+        for time_us, gpio, value in edges:
+            assert time_us >= 0, 'Edges cannot be placed before the sequence start'
+            self.edges.append((int(time_us), gpio, 1 if value else 0))
+
+    def add_waveforms(self, waveforms):
+        """ Adds a dict which maps each GPIO number to a list of (time_us, value) pairs. """
+        for gpio, waveform in waveforms.items():
+            self.add_edges((time_us, gpio, value) for time_us, value in waveform)
+
+    def compile_stages(self):
+        """
+        Merges all edges into a list of (value, wait_us) stages, where the value is the bit
+        pattern of all used GPIOs. Simultaneous edges make a single stage.
+        """
+        gpio_mask = 0
+        for _, gpio, _ in self.edges:
+            gpio_mask |= (1 << gpio)
+
+        stages, value, t = [], self.initial_value & gpio_mask, 0
+        for time_us, gpio, bit in sorted(self.edges, key=lambda e: e[0]):
+            if time_us > t:
+                stages.append([value, time_us - t])
+                t = time_us
+            value = (value & ~(1 << gpio)) | (bit << gpio)
+        stages.append([value, 1])
+
+        # Pauses too long for int32 are split into extra stages that only wait
+        split_stages = []
+        for value, wait_us in stages:
+            while wait_us > 2**31-1:
+                split_stages.append([value, 2**31-1])
+                value, wait_us = -1, wait_us - (2**31-1)
+            split_stages.append([value, wait_us])
+        return gpio_mask, split_stages
+
+    def compile(self, max_in_flight=2):
+        """
+        Returns the GPIO mask and a list of flat sequences, each suitable for one gpio_out_seq
+        command. The stages are split into the minimum number of chunks of similar length, so
+        that *max_in_flight* chunks fit into the device queue at once.
+        """
+        assert 1 <= max_in_flight <= self.queue_length
+        gpio_mask, stages = self.compile_stages()
+        chunk_max = min(self.max_stages, self.ring_stages // max_in_flight)
+        chunk_count = -(-len(stages) // chunk_max)  # i.e. ceil()
+        bounds = [len(stages) * n // chunk_count for n in range(chunk_count + 1)]
+        chunks = [[x for stage in stages[a:b] for x in stage] for a, b in zip(bounds[:-1], bounds[1:])]
+        return gpio_mask, chunks
+
+    def run(self, max_in_flight=2, wait=True):
+        """
+        Streams the compiled chunks to the device. Up to *max_in_flight* chunks are issued in
+        advance, the next one always being sent when a report of a finished chunk arrives.
+
+        Returns a GpioSequenceStats named tuple (or None if *wait* is False; then wait for the
+        `done` event and read the `stats` attribute). The *gaps_us* are the delays of each chunk
+        start after the scheduled end of the previous chunk's last stage, i.e. its start time
+        plus the sum of its waits; they include both the stalls when the host did not keep up
+        and the timer lateness within the chunk. Their standard deviation is the *jitter_us*.
+        *underruns* counts the chunks which had no successor waiting in the device queue.
+
+        If the device rejects a chunk (its queue was full), the output would have a hole, so no
+        further chunks are sent; the chunks already queued in the device still run. Then run()
+        raises RuntimeError; without *wait*, the `error` attribute is set and `stats` stays None.
+        """
+        gpio_mask, chunks = self.compile(max_in_flight=max_in_flight)
+        reports = []
+        lock = threading.Lock()
+        to_send = iter(chunks)
+        self.done.clear()
+        self.stats, self.error = None, None
+
+        def send_next():
+            chunk = next(to_send, None)
+            if chunk is not None:
+                self.rp.gpio_out_seq(gpio_mask, chunk, _callback=chunk_finished)
+
+        def chunk_finished(report):
+            with lock:
+                if self.done.is_set():
+                    return      # (a chunk queued before a rejection finished)
+                if report.rejected:
+                    self.error = "gpio_out_seq chunk rejected by the device; its queue was full"
+                    logging.error(self.error + ", sequence stopped")
+                    self.done.set()
+                    return
+                reports.append(report)
+                send_next()
+                if len(reports) == len(chunks):
+                    self.stats = self._get_stats(reports, chunks)
+                    self.done.set()
+
+        with lock:
+            for _ in range(max_in_flight):
+                send_next()
+
+        if wait:
+            self.done.wait()
+            if self.error:
+                raise RuntimeError(self.error)
+            return self.stats
+
+    @staticmethod
+    def _get_stats(reports, chunks):
+        # (the device reports the end of a chunk only once the next one is taken, so the end is
+        # computed from the waits; the chunks are run in the order sent)
+        scheduled_ends = [report.start_timestamp_us + sum(chunk[1::2]) for report, chunk in zip(reports, chunks)]
+        gaps = [b.start_timestamp_us - end for end, b in zip(scheduled_ends[:-1], reports[1:])]
+        underruns = sum(1 for r in reports[:-1] if not r.sequences_waiting)
+        mean_gap = sum(gaps)/len(gaps) if gaps else 0
+        return GpioSequenceStats(
+                chunk_count=len(reports),
+                stage_count=sum(len(chunk) for chunk in chunks)//2,
+                gaps_us=gaps,
+                max_gap_us=max(gaps, default=0),
+                mean_gap_us=mean_gap,
+                jitter_us=(sum((g - mean_gap)**2 for g in gaps)/len(gaps))**.5 if gaps else 0,
+                underruns=underruns,
+                duration_us=reports[-1].end_timestamp_us - reports[0].start_timestamp_us)
+
+
+
+if __name__ == "__main__":
+    # Self-check of the compilation and statistics (does not need any device)
+    seq = GpioSequence(rp=None, initial_value=0b10)
+    seq.add_waveforms({0: [(0, 1), (10, 0)], 1: [(10, 0), (2**32, 1)]})
+    gpio_mask, stages = seq.compile_stages()
+    assert gpio_mask == 0b11
+    assert stages == [[0b11, 10], [0b00, 2**31-1], [-1, 2**32-10-(2**31-1)], [0b10, 1]], stages
+
+    seq = GpioSequence(rp=None)
+    stage_count = 3*seq.max_stages + 7
+    seq.add_edges((t, 3, t % 2) for t in range(stage_count))
+    for max_in_flight in (1, 2, 4):
+        chunk_max = min(seq.max_stages, seq.ring_stages // max_in_flight)
+        gpio_mask, chunks = seq.compile(max_in_flight=max_in_flight)
+        sizes = [len(chunk)//2 for chunk in chunks]
+        assert sum(sizes) == stage_count and all(len(chunk) % 2 == 0 for chunk in chunks)
+        assert len(chunks) == -(-stage_count // chunk_max) and max(sizes) <= chunk_max
+        assert max(sizes) - min(sizes) <= 1, sizes
+
+    Report = namedtuple('gpio_out_seq_report_values',
+            ['start_timestamp_us', 'end_timestamp_us', 'sequences_waiting', 'rejected'])
+    chunks = [[1, 100, 0, 100], [1, 50, 0, 50], [1, 10, 0, 10]]
+    reports = [Report(1000, 1203, 1, 0), Report(1203, 1305, 0, 0), Report(1310, 1331, 0, 0)]
+    stats = GpioSequence._get_stats(reports, chunks)
+    assert stats.gaps_us == [3, 7] and stats.max_gap_us == 7 and stats.mean_gap_us == 5
+    assert stats.jitter_us == 2 and stats.underruns == 1
+    assert stats.chunk_count == 3 and stats.stage_count == 6 and stats.duration_us == 331
+    print("gpio_sequence self-check passed")
@@ -25,6 +25,8 @@ struct {
 	//uint8_t block_terminated_by_trigger;	// TODO
 } iADC_config;
 
+uint8_t iADC_buffers_lent = 0;  // set while the buffers are used by the logic analyzer (see logic_analyzer.c)
+
 
 // =============================================================================
 
@@ -45,6 +47,7 @@ void adc() {
     /* Initiates analog-to-digital conversion (ADC), using the RP2040 built-in feature.
      *
      * When ADC is already active, this takes no action. Use adc_stop() first in such a case.  
+     * The same applies when the logic analyzer is active, since it uses the same memory buffers.
      * 
      * *This command can result in one, several or infinitely many report(s). They can be 
      * almost immediate or delayed, depending on block size and timing.*
@@ -60,7 +63,7 @@ void adc() {
 	} * command = (void*)(command_buffer+1);
     // TODO implement send_data and send_statistics options
 
-    if (!(iADC_config.blocks_to_send || iADC_config.infinite)) { // re-init of running ADC makes trouble
+    if (!(iADC_config.blocks_to_send || iADC_config.infinite || iADC_buffers_lent)) { // re-init of running ADC makes trouble
         iADC_config.channel_mask = command->channel_mask; 
         iADC_config.infinite = command->infinite; 
         iADC_config.blocksize = command->blocksize; 
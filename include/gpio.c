@@ -133,7 +133,7 @@ void gpio_on_change() {
      * 
      * __Fixme__: in current firmware, edge events cannot be turned off! 
      * 
-     * *This command potentially results in multiple later reports. Note that input signal of over 10-50kHz may result in some events not being reported.*
+     * *This command potentially results in multiple later reports. Note that input signal of over 10-50kHz may result in some events not being reported; use `gpio_on_change_batch()` for such signals.*
      */
 	struct  __attribute__((packed)) {
 		uint8_t gpio;		// min=0 max=25 gpio specification
@@ -156,22 +156,219 @@ void gpio_on_change() {
 
 
 
-#define GPIO_OUT_SEQ_MAXLEN 16  // (todo) make this longer when command variable-length data
+// Batched edge logging: instead of one report per edge, the IRQ only appends a 16-bit record
+// into a buffer, which is transmitted as a bulk data payload once it is full or too old.
+//
+// Record format (LSB first):  bits 0-4 = gpio,  bit 5 = 1 for rising edge,  bits 6-15 = time
+// in microseconds since the previous record (0..1023). Longer pauses are encoded by inserting
+// extra records with gpio=31, whose bits 5-15 count the elapsed time in units of 1024 us.
+#define GPIO_BATCH_MAXLEN 1024   // max number of records in one report
+#define GPIO_BATCH_BUF_COUNT 4   // multi-buffering keeps logging events while USB is busy
+#define GPIO_BATCH_OVERFLOW 31   // pseudo-gpio number for time-overflow records
+
+typedef struct {
+    uint16_t records[GPIO_BATCH_MAXLEN];
+    uint8_t write_lock;          // set while the buffer waits for USB transmission
+} gpio_batch_buffer;
+gpio_batch_buffer gpio_batch_buffers[GPIO_BATCH_BUF_COUNT];
+
+struct {
+	uint32_t gpio_mask;          // gpios currently logged
+	uint16_t batch_events;
+	uint32_t batch_timeout_us;
+	uint8_t  active_buffer;
+	uint16_t count;              // records in the active buffer
+	uint64_t first_event_us;     // when the first record was stored into the active buffer
+	uint64_t ref_time_us;        // time reference for the first record of the active buffer
+	uint64_t prev_time_us;       // time up to which the stored records account; the time of lost
+	                             // events is carried over to the next stored record
+	uint32_t events_lost;
+} gpio_batch_config;
+
 struct __attribute__((packed)) {
+    uint8_t report_code;
+    uint16_t _data_count;
+    uint8_t _data_bitwidth;
+	uint64_t start_time_us;      // Timestamp from which the time delta of the first record is counted.
+	uint32_t events_lost;        // Number of events dropped since previous report, because all buffers were waiting for USB. Normally 0.
+} gpio_on_change_batch_report;
+
+void gpio_batch_flush() { // must not be interrupted by gpio_batch_IRQ
+	gpio_batch_buffer* buf = &gpio_batch_buffers[gpio_batch_config.active_buffer];
+
+	gpio_on_change_batch_report._data_count = gpio_batch_config.count;
+	gpio_on_change_batch_report._data_bitwidth = 16;
+	gpio_on_change_batch_report.start_time_us = gpio_batch_config.ref_time_us;
+	gpio_on_change_batch_report.events_lost = gpio_batch_config.events_lost;
+	gpio_batch_config.events_lost = 0;
+
+	buf->write_lock = 1; // will be released upon transmit
+	prepare_report_wrl(&gpio_on_change_batch_report, sizeof(gpio_on_change_batch_report),
+			buf->records,
+			gpio_batch_config.count * sizeof(buf->records[0]),
+			DATA_BY_REF,
+			&buf->write_lock);
+
+	gpio_batch_config.active_buffer = (gpio_batch_config.active_buffer + 1) % GPIO_BATCH_BUF_COUNT;
+	gpio_batch_config.count = 0;
+	gpio_batch_config.ref_time_us = gpio_batch_config.prev_time_us;
+}
+
+static inline bool gpio_batch_append(uint16_t record, uint64_t record_time_us) {
+	// Returns false if the record was dropped; its time is then left for the next stored record
+	gpio_batch_buffer* buf = &gpio_batch_buffers[gpio_batch_config.active_buffer];
+	if (buf->write_lock) // USB did not yet transmit any of the previous buffers
+		return false;
+	if (!gpio_batch_config.count)
+		gpio_batch_config.first_event_us = record_time_us;
+	buf->records[gpio_batch_config.count++] = record;
+	gpio_batch_config.prev_time_us = record_time_us; // (before a flush, which takes it as the new reference)
+	if (gpio_batch_config.count >= gpio_batch_config.batch_events)
+		gpio_batch_flush();
+	return true;
+}
+
+void gpio_batch_IRQ(uint gpio, uint32_t events) {
+	uint64_t now = time_us_64();
+	uint64_t delta = now - gpio_batch_config.prev_time_us;
+	uint8_t both_edges = (events & GPIO_IRQ_EDGE_RISE) && (events & GPIO_IRQ_EDGE_FALL);
+
+	while (delta >= 1024) {  // long pause between events
+		uint32_t units = min(delta/1024, 2047);
+		if (!gpio_batch_append(GPIO_BATCH_OVERFLOW | (units << 5), gpio_batch_config.prev_time_us + units*1024)) {
+			gpio_batch_config.events_lost += 1 + both_edges;
+			return;
+		}
+		delta -= units*1024;
+	}
+
+	if (both_edges) {
+		// Both edges came within the IRQ latency; their order is told by the present pin state
+		uint8_t rose_last = gpio_get(gpio);
+		if (!gpio_batch_append(gpio | ((!rose_last) << 5) | (delta << 6), now))
+			gpio_batch_config.events_lost += 2;
+		else if (!gpio_batch_append(gpio | (rose_last << 5), now))
+			gpio_batch_config.events_lost++;
+	} else {
+		if (!gpio_batch_append(gpio | ((events & GPIO_IRQ_EDGE_RISE) ? (1 << 5) : 0) | (delta << 6), now))
+			gpio_batch_config.events_lost++;
+	}
+}
+
+void gpio_batch_on_main_loop() { // note this is called from main USB communication loop in rp2daq.c
+	if (gpio_batch_config.count && gpio_batch_config.batch_timeout_us &&
+			(time_us_64() - gpio_batch_config.first_event_us >= gpio_batch_config.batch_timeout_us)) {
+		uint32_t irq_status = save_and_disable_interrupts();
+		if (gpio_batch_config.count) gpio_batch_flush(); // (re-check, IRQ could flush it meanwhile)
+		restore_interrupts(irq_status);
+	}
+}
+
+void gpio_on_change_batch() {
+    /* Logs edges on a gpio into a device-side buffer, and reports them in batches. Compared to
+     * `gpio_on_change()`, which sends one report per edge, this allows for continuous logging
+     * of signals up to hundreds of kHz without losing events.
+     *
+     * A report is sent once *batch_events* records accumulate, or once *batch_timeout_us*
+     * elapses since the first record in the batch. Calling this command for several gpios makes
+     * them share the same batches. Calling it with both edges disabled stops logging the gpio
+     * and immediately sends the pending records (possibly none).
+     *
+     * The `data` of each report are packed 16-bit records; use `rp2daq.decode_gpio_batch(report)`
+     * to convert them into NumPy arrays of timestamps, gpio numbers and edge directions.
+     *
+     * > [!NOTE]
+     * > The gpio interrupt handler is shared by all gpios, so this command cannot be combined with
+     * > `gpio_on_change()` or with the `trigger_gpio` option of `adc()`.
+     *
+     * *This command potentially results in multiple later reports.*
+     */
+	struct  __attribute__((packed)) {
+		uint8_t gpio;		// min=0 max=25 gpio specification
+		uint8_t on_rising_edge;  // min=0 max=1 default=1 Logs gpio rising from logical 0 to 1
+		uint8_t on_falling_edge; // min=0 max=1 default=1 Logs gpio falling from logical 1 to 0
+		uint16_t batch_events;   // min=1 max=1024 default=1000 Number of records that make a report
+		uint32_t batch_timeout_us; // min=0 default=100000 Maximum age of the oldest record before the batch
+            // is reported, even if not full. Zero disables the timeout.
+	} * args = (void*)(command_buffer+1);
+
+	uint8_t edge_mask = 0;
+	if (args->on_rising_edge) edge_mask |= GPIO_IRQ_EDGE_RISE;
+	if (args->on_falling_edge) edge_mask |= GPIO_IRQ_EDGE_FALL;
+
+	uint32_t irq_status = save_and_disable_interrupts();
+	gpio_set_irq_enabled(args->gpio, GPIO_IRQ_EDGE_RISE | GPIO_IRQ_EDGE_FALL, false);
+	gpio_batch_config.batch_events = min(max(args->batch_events, 1), GPIO_BATCH_MAXLEN);
+	gpio_batch_config.batch_timeout_us = args->batch_timeout_us;
+
+	if (edge_mask) {
+		if (!gpio_batch_config.gpio_mask) { // (re)start the time reference if nothing was logged
+			gpio_batch_config.prev_time_us = time_us_64();
+			gpio_batch_config.ref_time_us = gpio_batch_config.prev_time_us;
+		}
+		gpio_batch_config.gpio_mask |= (1 << args->gpio);
+		restore_interrupts(irq_status);
+		gpio_set_irq_enabled_with_callback(args->gpio, edge_mask, true, &gpio_batch_IRQ);
+	} else {
+		gpio_batch_config.gpio_mask &= ~(1 << args->gpio);
+		gpio_batch_flush(); // the (possibly empty) final report also unblocks synchronous calls
+		restore_interrupts(irq_status);
+	}
+}
+
+
+
+#define GPIO_OUT_SEQ_MAXLEN 512  // keep in sync with the 'maxlen' annotation of the command below
+#define GPIO_OUT_SEQ_RING 1024   // stages of all queued sequences together (must be power of 2)
+#define GPIO_OUT_SEQ_QUEUE 8     // up to 8 sequences can wait for the running one to finish
+
+volatile int32_t gpio_out_seq_value[GPIO_OUT_SEQ_RING];     // Binary value will be set as the outputs
+volatile int32_t gpio_out_seq_wait_us[GPIO_OUT_SEQ_RING];   // Microseconds to wait after setting this value
+
+typedef struct {
+	uint32_t gpio_mask;
+	uint16_t first_stage;        // index into the ring of stages
+	uint16_t seq_len;
 	uint64_t start_timestamp_us;
-	volatile int8_t  seq_stage;
-	volatile uint8_t seq_len;
-	volatile int32_t gpio_mask;
-	volatile int32_t value[GPIO_OUT_SEQ_MAXLEN];     // Binary value will be set as the outputs
-	volatile int32_t wait_us[GPIO_OUT_SEQ_MAXLEN];   // Microseconds to wait after setting this value
+} gpio_out_seq_entry;
+
+struct {
+	gpio_out_seq_entry queue[GPIO_OUT_SEQ_QUEUE];
+	volatile uint8_t  head;          // the sequence being run is queue[head]
+	volatile uint8_t  count;         // running + waiting sequences
+	volatile uint16_t seq_stage;     // stage of the running sequence
+	volatile uint16_t stages_used;   // ring stages occupied by the running + waiting sequences
+	volatile uint16_t ring_tofill;
 } gpio_out_seq_config;
 
 struct __attribute__((packed)) {
     uint8_t report_code;
 	uint64_t start_timestamp_us;
 	uint64_t end_timestamp_us;
+	uint8_t sequences_waiting;   // How many queued sequences were waiting when this one finished. If 0, outputs 
+        // stay idle until a new sequence comes.
+	uint8_t rejected;            // Normally 0; 1 if the sequence was not run, as the queue of sequences was full
+        // or the sequence had an odd count of numbers.
 } gpio_out_seq_report;
-// todo timestamps for start/end of seq
+
+void gpio_out_seq_init_pins(uint32_t gpio_mask) {
+	for (uint8_t i=0; i<=25; i++) { 
+		// gpio_init() is necessary only if the pin isn't used as software-driven output yet (otherwise 
+		// it introduces a mostly harmless sub-microsecond 0 glitch in output of a running sequence)
+		if (((1<<i) & gpio_mask) && (gpio_get_function(i) != GPIO_FUNC_SIO)) 
+			gpio_init(i);  
+	}
+	gpio_set_dir_out_masked(gpio_mask);
+}
+
+static inline int64_t gpio_out_seq_apply_stage() { // returns the delay till next stage, for the alarm
+	gpio_out_seq_entry* entry = &gpio_out_seq_config.queue[gpio_out_seq_config.head];
+	uint16_t i = (entry->first_stage + gpio_out_seq_config.seq_stage) & (GPIO_OUT_SEQ_RING-1);
+	if (gpio_out_seq_value[i] >= 0) // negative value = only wait
+		gpio_put_masked(entry->gpio_mask, gpio_out_seq_value[i]); 
+	// negative delay = more accurate timing; note zero would stop the alarm
+	return -max(gpio_out_seq_wait_us[i], 1); 
+}
 
 int64_t gpio_seq_callback(alarm_id_t id, __unused void *user_data) { 
     // Interrupt service routine for updating the GPIO sequence, initiated by the gpio_out_seq command.
@@ -180,25 +377,33 @@ int64_t gpio_seq_callback(alarm_id_t id, __unused void *user_data) {
     // TODO migrate this ISR to the second core which is dedicated to such real-time tasks; hook it to a 
     // busy loop checking for https://forums.raspberrypi.com/viewtopic.php?f=145&t=304201&p=1820770&hilit=Hermannsw+systick#p1822677.
     
+	gpio_out_seq_entry* entry = &gpio_out_seq_config.queue[gpio_out_seq_config.head];
 	gpio_out_seq_config.seq_stage++;
-	if (gpio_out_seq_config.seq_stage >= gpio_out_seq_config.seq_len) { // if beyond last sequence stage
-        gpio_out_seq_report.end_timestamp_us = time_us_64(); 
-        gpio_out_seq_report.start_timestamp_us = gpio_out_seq_config.start_timestamp_us; 
-
+	if (gpio_out_seq_config.seq_stage >= entry->seq_len) { // if beyond last sequence stage
+		uint64_t now = time_us_64();
+        gpio_out_seq_report.end_timestamp_us = now; 
+        gpio_out_seq_report.start_timestamp_us = entry->start_timestamp_us; 
+        gpio_out_seq_report.sequences_waiting = gpio_out_seq_config.count - 1; 
+        gpio_out_seq_report.rejected = 0; 
 		prepare_report(&gpio_out_seq_report, sizeof(gpio_out_seq_report), 0, 0, 0);
-		return 0;
-	} else { 
-		//if (gpio_out_seq_config.value[gpio_out_seq_config.seq_stage] >= 0)
-        gpio_put_masked(gpio_out_seq_config.gpio_mask, gpio_out_seq_config.value[gpio_out_seq_config.seq_stage]); 
-		//return min(-1, -gpio_out_seq_config.wait_us[gpio_out_seq_config.seq_stage]); // negative delay = more accurate timing
-		return -gpio_out_seq_config.wait_us[gpio_out_seq_config.seq_stage]; // negative delay = more accurate timing
-	};
+
+		gpio_out_seq_config.stages_used -= entry->seq_len;
+		gpio_out_seq_config.head = (gpio_out_seq_config.head + 1) % GPIO_OUT_SEQ_QUEUE;
+		gpio_out_seq_config.count--;
+		if (!gpio_out_seq_config.count) 
+			return 0;
+
+		// Without any delay, continue with the next sequence that was queued meanwhile
+		gpio_out_seq_config.seq_stage = 0;
+		gpio_out_seq_config.queue[gpio_out_seq_config.head].start_timestamp_us = now;
+	}
+	return gpio_out_seq_apply_stage();
 }
 
 
 void gpio_out_seq() {
     /* Sets (optionally) multiple GPIO outputs at once; (optionally) sets them 
-	 * multiple times in an accurately timed short sequence of bit patterns. 
+	 * multiple times in an accurately timed sequence of bit patterns. 
 	 *
 	 * If you need to change several pins simultaneously (within 1 ns), and/or in 
 	 * quite accurate time delay independent on how USB is busy (within 2 us jitter), 
@@ -206,92 +411,68 @@ void gpio_out_seq() {
 	 * command (calling a command takes some 2ms). Typically this is necessary for custom 
 	 * digital protocols, resistor ladders, charlieplexing etc. 
 	 *
-	 * The *gpio_mask* and *value* parameters accept bit mask; e.g. if you wish to
+	 * The *gpio_mask* and the values in *sequence* accept bit mask; e.g. if you wish to
 	 * set GPIO 0 to logical high and GPIO 4 to logical low, use gpio_mask=1+16 and
-	 * value0=1. The following parameters can be all 0, unless one wants to define 
-	 * a sequence that changes the GPIOs in time.
+	 * sequence=[1, 0]. To define a sequence that changes the GPIOs in time, append further 
+	 * pairs of values and wait times, e.g. sequence=[1, 10, 16, 10, 0, 0]. Up to 512 stages 
+	 * (i.e. 1024 numbers) can be sent in one command.
 	 *
-	 * Not all wait times and values have to be set; the defaults (negative values)
-	 * mean the unused entries won't be used. 
+	 * A negative value makes its stage only wait, leaving the outputs unchanged. Wait times 
+	 * shorter than 1 us are rounded up to 1 us.
+	 *
+	 * If a sequence is issued asynchronously while another one is running, it is queued and 
+	 * started right after the running one finishes, without any gap. Up to 8 sequences, with up
+	 * to 1024 stages in total, can be queued. Longer sequences can thus be streamed without 
+	 * interruption (see also `gpio_sequence.py`).
      * 
      * *This command results in one report when the sequence is finished.*
      */
 	struct  __attribute__((packed)) {
 		uint32_t gpio_mask;	// Only *gpio* numbers corresponding to "1" bits in mask will be initialized as outputs and changed
-		int32_t value0;     // default=-1 min=-1 Binary value will be set as the outputs
-		int32_t wait_us0;   // default=-1 min=-1 Microseconds to wait after setting this value
-		int32_t value1;     // default=-1 min=-1 Next binary value, used if not negative...
-		int32_t wait_us1;   // default=-1 min=-1 
-		int32_t value2;     // default=-1 min=-1 
-		int32_t wait_us2;   // default=-1 min=-1 
-		int32_t value3;     // default=-1 min=-1 
-		int32_t wait_us3;   // default=-1 min=-1 
-		int32_t value4;     // default=-1 min=-1 
-		int32_t wait_us4;   // default=-1 min=-1 
-		int32_t value5;     // default=-1 min=-1 
-		int32_t wait_us5;   // default=-1 min=-1 
-		int32_t value6;     // default=-1 min=-1 
-		int32_t wait_us6;   // default=-1 min=-1 
-		int32_t value7;     // default=-1 min=-1 
-		int32_t wait_us7;   // default=-1 min=-1 
-		int32_t value8;     // default=-1 min=-1 
-		int32_t wait_us8;   // default=-1 min=-1 
-		int32_t value9;     // default=-1 min=-1 
-		int32_t wait_us9;   // default=-1 min=-1 
-		int32_t value10;    // default=-1 min=-1 
-		int32_t wait_us10;  // default=-1 min=-1 
-		int32_t value11;    // default=-1 min=-1 
-		int32_t wait_us11;  // default=-1 min=-1 
-		int32_t value12;    // default=-1 min=-1 
-		int32_t wait_us12;  // default=-1 min=-1 
-		int32_t value13;    // default=-1 min=-1 
-		int32_t wait_us13;  // default=-1 min=-1 
-		int32_t value14;    // default=-1 min=-1 
-		int32_t wait_us14;  // default=-1 min=-1 
-		int32_t value15;    // default=-1 min=-1 
-		int32_t wait_us15;  // default=-1 min=-1 
+		int32_t sequence[];	// min=-1 maxlen=1024 lenmult=2 Pairs of numbers: the binary value to be set as the outputs, and 
+            // the microseconds to wait after setting it.
 	} * args = (void*)(command_buffer+1);
-    // Note: could be extended trivially, adjusting GPIO_OUT_SEQ_MAXLEN. Max cmd len given by RX_BUF_LEN.
-    // But better solution is to implement data array also for commands in the future. 
-
-    gpio_out_seq_config.start_timestamp_us = time_us_64(); 
-	gpio_out_seq_config.gpio_mask = args->gpio_mask;
-	gpio_out_seq_config.seq_len = 0;
-	for (uint8_t i=0; i<GPIO_OUT_SEQ_MAXLEN; i++) { // verbatim copy of the command values
-		gpio_out_seq_config.value[i] = *((int32_t*)(((int32_t*)(&args->value0)) +(2*i) ));  
-		gpio_out_seq_config.wait_us[i] = *((int32_t*)(((int32_t*)(&args->wait_us0)) +(2*i) )); // -2???
-		if (gpio_out_seq_config.value[i] != -1) gpio_out_seq_config.seq_len = i+1;
+
+	uint16_t array_len = COMMAND_ARRAY_LEN(args, sequence);
+	uint16_t seq_len = min(array_len/2, GPIO_OUT_SEQ_MAXLEN);
+
+	uint32_t irq_status = save_and_disable_interrupts();
+	if (!array_len || (array_len % 2) || (gpio_out_seq_config.count >= GPIO_OUT_SEQ_QUEUE) || 
+			(gpio_out_seq_config.stages_used + seq_len > GPIO_OUT_SEQ_RING)) {
+		restore_interrupts(irq_status);
+		// Empty sequence is finished immediately; unpaired values or too many sequences are rejected
+        gpio_out_seq_report.start_timestamp_us = time_us_64(); 
+        gpio_out_seq_report.end_timestamp_us = gpio_out_seq_report.start_timestamp_us; 
+        gpio_out_seq_report.sequences_waiting = gpio_out_seq_config.count; 
+        gpio_out_seq_report.rejected = (array_len > 0); 
+		prepare_report(&gpio_out_seq_report, sizeof(gpio_out_seq_report), 0, 0, 0);
+		return;
 	}
-    
-	// (re)init the masked GPIOs as output
-	gpio_set_dir_out_masked(args->gpio_mask); // FIXME did nothing? 
-	for (uint8_t i=0; i<=25; i++) { 
-        //if (((1<<i) & gpio_out_seq_config.gpio_mask) & (1<<i & ~GPIO_OE)) {
-		
-			// this is necessary only if the pin isn't initialized as output yet
-            // (otherwise it introduces a mostly harmless sub-microsecond 0 glitch in output)
-			// TODO: optimize checking if the bit is in right state yet to avoid glitches
-            gpio_init(i);  
-
-            gpio_set_dir(i, GPIO_OUT);
-        //}
-    }
-    
-	//Output the first sequence values
-    gpio_out_seq_config.seq_stage = 0;
-    if (gpio_out_seq_config.value[0] >= 0) { // TODO check all ill cases like this
-        gpio_put_masked(args->gpio_mask, gpio_out_seq_config.value[0]); 
-    }
-    add_alarm_in_us(gpio_out_seq_config.wait_us[0], 
-            gpio_seq_callback,  // launch next IRQ update
-            NULL,  // no user data needed
-            true); // ensures the alarm IRQ chain does not break on delay (and report is always sent)
-	//};
+
+	gpio_out_seq_entry* entry = &gpio_out_seq_config.queue[
+		(gpio_out_seq_config.head + gpio_out_seq_config.count) % GPIO_OUT_SEQ_QUEUE];
+	entry->gpio_mask = args->gpio_mask;
+	entry->first_stage = gpio_out_seq_config.ring_tofill;
+	entry->seq_len = seq_len;
+	for (uint16_t i=0; i<seq_len; i++) { // verbatim copy of the command values
+		uint16_t j = (entry->first_stage + i) & (GPIO_OUT_SEQ_RING-1);
+		gpio_out_seq_value[j] = args->sequence[2*i];
+		gpio_out_seq_wait_us[j] = args->sequence[2*i+1];
+	}
+	gpio_out_seq_config.ring_tofill = (gpio_out_seq_config.ring_tofill + seq_len) & (GPIO_OUT_SEQ_RING-1);
+	gpio_out_seq_config.stages_used += seq_len;
+	gpio_out_seq_config.count++;
+	gpio_out_seq_init_pins(args->gpio_mask);
+
+	if (gpio_out_seq_config.count == 1) { // nothing was running, so output the first sequence values now
+		entry->start_timestamp_us = time_us_64(); 
+		gpio_out_seq_config.seq_stage = 0;
+		add_alarm_in_us(-gpio_out_seq_apply_stage(), 
+				gpio_seq_callback,  // launch next IRQ update
+				NULL,  // no user data needed
+				true); // ensures the alarm IRQ chain does not break on delay (and report is always sent)
+	}
+	restore_interrupts(irq_status);
 
 	// A report will be sent from the callback function when the sequence ends.  
-	
 }
-
-
-
-
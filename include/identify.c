@@ -31,3 +31,26 @@ void identify() {
 	identify_report._data_bitwidth = 8;
 	prepare_report(&identify_report, sizeof(identify_report), &text, sizeof(text)-1, 1);
 }
+
+
+
+struct __attribute__((packed)) {
+    uint8_t report_code;
+    uint32_t tag;       // The number given to the command, returned unchanged.
+    uint64_t time_us;   // Device time in microseconds when the command was processed.
+} ping_report;
+
+void ping() {
+    /* Replies immediately with the current device time. Used by clock_sync.py to map the 
+     * timestamps in reports onto the computer clock.
+     * 
+     * *This command results in single near-immediate report.*
+     */
+	struct  __attribute__((packed)) {
+        uint32_t tag;   // min=0 default=0 Any number, to pair the report with the command
+	} * args = (void*)(command_buffer+1);
+
+	ping_report.time_us = time_us_64();
+	ping_report.tag = args->tag;
+	prepare_report(&ping_report, sizeof(ping_report), 0, 0, 0);
+}
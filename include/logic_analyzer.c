@@ -0,0 +1,232 @@
+// Logic analyzer: a PIO state machine samples a range of consecutive GPIOs at a rate given by its
+// clock divider, and the DMA moves the packed samples into the ADC buffers (see adc_builtin.c).
+// The two are not used at the same time, since there is no RAM left for a second set of buffers.
+
+void logic_init();
+void logic_DMA_start();
+void logic_DMA_IRQ_handler();
+void logic_start_or_schedule_after_usb();
+
+struct {
+	uint8_t first_gpio;
+	uint8_t gpio_count;
+	uint16_t clkdiv;
+	uint8_t clkdiv_frac;
+	uint16_t blocksize;
+	uint8_t infinite;
+    uint32_t blocks_to_send;
+    uint64_t start_time_us;
+	uint8_t waits_for_usb;
+	uint8_t block_delayed_by_usb;
+} logic_config;
+
+PIO logic_pio = pio0;
+int logic_sm = -1;          // claimed on the first use
+uint logic_pio_offset;
+uint16_t logic_pio_instr;
+dma_channel_config logic_DMA_cfg;
+int logic_DMA_chan;
+
+
+// =============================================================================
+
+struct __attribute__((packed)) {
+    uint8_t report_code;
+    uint16_t _data_count;
+    uint8_t _data_bitwidth;
+	uint64_t start_time_us;       // Microsecond timestamp when the first sample of this block was taken.
+	uint64_t end_time_us;         // Microsecond timestamp when the block was finished.
+    uint8_t first_gpio;           // The first_gpio value that was used; it corresponds to the lowest bit of each sample.
+    uint8_t gpio_count;           // The gpio_count value that was used, i.e. bits per sample.
+	uint16_t clkdiv;			  // The clkdiv value that was used.
+	uint8_t clkdiv_frac;		  // The clkdiv_frac value that was used.
+    uint32_t blocks_to_send;	  // How many blocks remain to be sent. Does not change if set to infinite.
+    uint8_t block_delayed_by_usb; // Normally should be 0, except USB was overloaded and the block had to wait for the USB buffer to accept new data.
+} logic_analyzer_report;
+
+void logic_analyzer() {
+    /* Samples the digital state of several consecutive GPIOs at once, at up to 250 MHz rate,
+     * and sends the samples in blocks. This is useful for recording digital buses like SPI,
+     * I2C or UART.
+     *
+     * Each sample takes *gpio_count* bits, the lowest bit being *first_gpio*. The samples
+     * are packed into 32-bit words, so that e.g. 8 GPIOs give 4 samples per word. The range
+     * ends at GPIO 29; a larger *gpio_count* is reduced (see *gpio_count* of the reports). The pins
+     * keep their function, so that also outputs (like PWM) can be recorded.
+     *
+     * Use `logic_analyzer.bit_planes(report)` or `logic_analyzer.edges(report)` to decode
+     * the reports. Note the USB cannot carry more than ca. 800 kB/s; faster sampling
+     * records separate blocks, with gaps between them (see *start_time_us* of the reports).
+     *
+     * The logic analyzer shares the memory buffers with the ADC; it takes no action if the
+     * ADC or the logic analyzer is already active.
+     *
+     * *This command can result in one, several or infinitely many report(s). They can be
+     * almost immediate or delayed, depending on block size and timing.*
+     */
+	struct __attribute__((packed)) {
+		uint8_t first_gpio;			// default=0		min=0		max=29 The lowest sampled GPIO
+		uint8_t gpio_count;			// default=8		min=1		max=30 How many consecutive GPIOs are sampled; the count of 1, 2, 4, 8 or 16 uses all bits of the packed data
+		uint16_t clkdiv;			// default=250		min=1		max=65535 Sampling rate is 250 MHz/(clkdiv + clkdiv_frac/256), e.g. 250 gives 1 Msps
+		uint8_t clkdiv_frac;		// default=0		min=0		max=255 Fractional part of the clock divider
+		uint16_t blocksize;			// default=1024		min=1		max=4096 Number of 32-bit words until a report is sent
+		uint8_t infinite;			// default=0		min=0		max=1  Disables blocks_to_send countdown; reports will keep coming until stopped by logic_analyzer_stop()
+		uint32_t blocks_to_send;	// default=1		min=1		         Limits the number of reports to be sent (if the 'infinite' option is not set)
+	} * command = (void*)(command_buffer+1);
+
+    if (!(logic_config.blocks_to_send || logic_config.infinite ||
+				iADC_config.blocks_to_send || iADC_config.infinite)) {
+        logic_config.first_gpio = command->first_gpio;
+        logic_config.gpio_count = min(command->gpio_count, 30 - command->first_gpio); // no pins beyond GPIO29
+        logic_config.clkdiv = command->clkdiv;
+        logic_config.clkdiv_frac = command->clkdiv_frac;
+        logic_config.blocksize = command->blocksize;
+        logic_config.infinite = command->infinite;
+        logic_config.blocks_to_send = command->blocks_to_send;
+		iADC_buffers_lent = 1;
+
+		logic_init();
+        logic_start_or_schedule_after_usb();
+    };
+}
+
+
+struct __attribute__((packed)) {
+    uint8_t report_code;
+    uint32_t aborted_blocks_to_send;
+} logic_analyzer_stop_report;
+
+void logic_analyzer_stop() {
+    /* Makes the logic analyzer not start another block after the active block is finished.
+     * One or more reports may still arrive after this command.
+     *
+     * If the logic analyzer is not running, this takes no action.
+     *
+     * *This command will result in one immediate report.*
+     */
+	struct __attribute__((packed)) {
+        uint8_t finish_last_block;    // min=1 max=1 default=1 (No option here - hard stopping in the middle of a block not implemented yet.)
+	} * command = (void*)(command_buffer+1);
+
+    logic_analyzer_stop_report.aborted_blocks_to_send = logic_config.blocks_to_send;
+    logic_config.infinite = 0;
+    logic_config.blocks_to_send = 0;
+	if (logic_config.waits_for_usb) {
+		logic_config.waits_for_usb = 0;
+		iADC_buffers_lent = 0;
+	}
+    prepare_report(&logic_analyzer_stop_report, sizeof(logic_analyzer_stop_report), 0,0,0);
+}
+
+
+
+// =============================================================================
+// PIO & DMA setup, and buffer management shared with the ADC
+
+void logic_init() {
+	if (logic_sm < 0) {
+		logic_sm = pio_claim_unused_sm(logic_pio, true);
+		logic_DMA_chan = dma_claim_unused_channel(true);
+
+		// The ADC has the exclusive handler of DMA_IRQ_0, DMA_IRQ_1 is shared with pwm_waveform.c
+		dma_channel_set_irq1_enabled(logic_DMA_chan, true);
+		irq_add_shared_handler(DMA_IRQ_1, logic_DMA_IRQ_handler, PICO_SHARED_IRQ_HANDLER_DEFAULT_ORDER_PRIORITY);
+		irq_set_enabled(DMA_IRQ_1, true);
+	} else {
+		pio_remove_program(logic_pio,
+				&(struct pio_program){.instructions = &logic_pio_instr, .length = 1, .origin = -1},
+				logic_pio_offset);
+	}
+
+	// The whole program is a single instruction, `in pins, <gpio_count>`, wrapping onto itself;
+	// the autopush sends the shift register to the RX FIFO when there is no room for another sample
+	logic_pio_instr = pio_encode_in(pio_pins, logic_config.gpio_count);
+	struct pio_program program = {.instructions = &logic_pio_instr, .length = 1, .origin = -1};
+	logic_pio_offset = pio_add_program(logic_pio, &program);
+
+	pio_sm_config c = pio_get_default_sm_config();
+	sm_config_set_in_pins(&c, logic_config.first_gpio);
+	sm_config_set_wrap(&c, logic_pio_offset, logic_pio_offset);
+	sm_config_set_clkdiv_int_frac(&c, logic_config.clkdiv, logic_config.clkdiv_frac);
+	sm_config_set_in_shift(&c, true, true, (32 / logic_config.gpio_count) * logic_config.gpio_count);
+	sm_config_set_fifo_join(&c, PIO_FIFO_JOIN_RX);
+	pio_sm_init(logic_pio, logic_sm, logic_pio_offset, &c);
+
+    logic_DMA_cfg = dma_channel_get_default_config(logic_DMA_chan);
+    channel_config_set_transfer_data_size(&logic_DMA_cfg, DMA_SIZE_32);
+    channel_config_set_read_increment(&logic_DMA_cfg, false); // from PIO
+    channel_config_set_write_increment(&logic_DMA_cfg, true); // into buffer
+    channel_config_set_dreq(&logic_DMA_cfg, pio_get_dreq(logic_pio, logic_sm, false));
+}
+
+void logic_DMA_start() {
+    logic_config.block_delayed_by_usb = logic_config.waits_for_usb;
+    logic_config.waits_for_usb = 0;
+
+	// Restart the state machine with empty FIFO, so that the block starts with a fresh sample
+	pio_sm_set_enabled(logic_pio, logic_sm, false);
+	pio_sm_clear_fifos(logic_pio, logic_sm);
+	pio_sm_restart(logic_pio, logic_sm);
+	pio_sm_clkdiv_restart(logic_pio, logic_sm);
+	pio_sm_exec(logic_pio, logic_sm, pio_encode_jmp(logic_pio_offset));
+
+	iADC_buffers[iADC_active_buffer].write_lock = 1; // will be released upon transmit
+	dma_channel_configure(logic_DMA_chan, &logic_DMA_cfg,
+		iADC_buffers[iADC_active_buffer].data,    // destination
+		&logic_pio->rxf[logic_sm],  // src
+		logic_config.blocksize,  // transfer count
+		true            // start immediately, waits for the DREQ from PIO
+	);
+    logic_config.start_time_us = time_us_64();
+	pio_sm_set_enabled(logic_pio, logic_sm, true);
+}
+
+void logic_start_or_schedule_after_usb() {
+    if ((logic_config.infinite) || (logic_config.blocks_to_send > 0)) {
+		if (iADC_buffers[iADC_active_buffer].write_lock) {
+			logic_config.waits_for_usb = 1;
+		} else {
+			logic_DMA_start();
+		};
+	} else {
+		iADC_buffers_lent = 0;  // the ADC may use the buffers again
+	}
+}
+
+void logic_on_buffer_transmitted() { // note this is called from main USB communication loop in rp2daq.c
+	if (logic_config.waits_for_usb && !(iADC_buffers[iADC_active_buffer].write_lock)) {
+		logic_DMA_start();
+	}
+}
+
+void logic_DMA_IRQ_handler() {
+	if (!(dma_hw->ints1 & (1u << logic_DMA_chan)))
+		return;  // (the IRQ is shared with the PWM waveform playback)
+    dma_hw->ints1 = 1u << logic_DMA_chan;  // clear the interrupt request to avoid re-trigger
+	pio_sm_set_enabled(logic_pio, logic_sm, false);
+
+    uint8_t buffer_prev = iADC_active_buffer;
+    iADC_active_buffer = (iADC_active_buffer + 1) % iADC_BUF_COUNT;
+
+    logic_analyzer_report.end_time_us = time_us_64();
+    logic_analyzer_report.start_time_us = logic_config.start_time_us;
+
+	if (logic_config.blocks_to_send) logic_config.blocks_to_send--;
+	logic_start_or_schedule_after_usb();
+
+    logic_analyzer_report._data_count = logic_config.blocksize;
+    logic_analyzer_report._data_bitwidth = 32;
+    logic_analyzer_report.first_gpio = logic_config.first_gpio;
+    logic_analyzer_report.gpio_count = logic_config.gpio_count;
+    logic_analyzer_report.clkdiv = logic_config.clkdiv;
+    logic_analyzer_report.clkdiv_frac = logic_config.clkdiv_frac;
+    logic_analyzer_report.blocks_to_send = logic_config.blocks_to_send;
+    logic_analyzer_report.block_delayed_by_usb = logic_config.block_delayed_by_usb;
+
+	prepare_report_wrl(&logic_analyzer_report,
+            sizeof(logic_analyzer_report),
+			iADC_buffers[buffer_prev].data,
+            logic_analyzer_report._data_count * 4,
+            0, // don't make buffer copy
+			&iADC_buffers[buffer_prev].write_lock); // will be auto-cleared upon transmit (see rp2daq.c)
+}
@@ -0,0 +1,253 @@
+// Waveform playback on a PWM output: a DMA channel, paced by a DMA timer, copies the samples
+// from a table into the compare register of the PWM slice. A second DMA channel re-arms it
+// with the address of the next table half, so that looping and streaming run without gaps.
+
+void pwm_waveform_DMA_IRQ_handler();
+
+#define PWM_WAVEFORM_LEN 2048    // samples in the device table; streaming uses its two halves alternately
+#define PWM_WAVEFORM_ONESHOT 0
+#define PWM_WAVEFORM_LOOP 1
+#define PWM_WAVEFORM_STREAM 2
+
+// Values for the whole compare register, i.e. the new duty cycle of one channel together with
+// the unchanged one of the other channel of the slice (narrower writes would set both)
+uint32_t pwm_waveform_table[PWM_WAVEFORM_LEN];
+uint32_t* pwm_waveform_half_address[2] __attribute__((aligned(8))); // read in a ring by the control channel
+
+struct {
+	uint8_t mode;
+	uint8_t playing;
+	uint8_t half_playing;
+	uint8_t half_filled[2];      // set by pwm_waveform_load(), cleared once played (streaming only)
+	uint8_t half_last[2];
+	uint32_t chunks_played;
+	uint64_t start_time_us;
+} pwm_waveform_config;
+
+int pwm_waveform_data_chan = -1;  // claimed on the first use
+int pwm_waveform_ctrl_chan;
+int pwm_waveform_timer;
+dma_channel_config pwm_waveform_data_cfg;
+
+
+
+struct __attribute__((packed)) {
+    uint8_t report_code;
+	uint16_t offset;			// Where the samples were stored
+	uint16_t count;				// How many samples were stored
+} pwm_waveform_load_report;
+
+void pwm_waveform_load() {
+    /* Stores the duty-cycle values of a waveform into the device table, which holds up to
+	 * 2048 samples, for later playback by pwm_waveform_start().
+	 *
+	 * The samples are converted for the PWM channel of *gpio*; the other GPIO of the same
+	 * PWM slice keeps its value as of this command during the playback.
+	 *
+	 * For streaming, the two halves of the table (offsets 0 and 1024) are loaded alternately
+	 * with the next chunk of the waveform, each time the report of pwm_waveform_start() tells
+	 * a chunk was played. Rather use `rp.pwm_waveform()`, which does all this.
+     *
+     * *This command results in one near-immediate report.*
+     */
+	struct __attribute__((packed)) {
+		uint8_t gpio;				// min=0		max=25
+		uint16_t offset;			// min=0		max=2047 Position of the first sample in the table
+		uint8_t last_chunk;			// min=0		max=1 When streaming, marks the last chunk of the waveform
+		uint16_t samples[];			// min=0 max=65535 maxlen=2048 Duty-cycle values, like the value of pwm_set_value()
+	} * args = (void*)(command_buffer+1);
+
+	uint16_t count = min(COMMAND_ARRAY_LEN(args, samples), PWM_WAVEFORM_LEN - args->offset);
+    uint slice_num = pwm_gpio_to_slice_num(args->gpio);
+	uint32_t other_channel = pwm_hw->slice[slice_num].cc;
+
+	if (pwm_gpio_to_channel(args->gpio) == PWM_CHAN_B) {
+		for (uint16_t i=0; i<count; i++)
+			pwm_waveform_table[args->offset + i] = (other_channel & 0x0000FFFF) | ((uint32_t)args->samples[i] << 16);
+	} else {
+		for (uint16_t i=0; i<count; i++)
+			pwm_waveform_table[args->offset + i] = (other_channel & 0xFFFF0000) | args->samples[i];
+	}
+
+	uint8_t half = (args->offset >= PWM_WAVEFORM_LEN/2);
+	pwm_waveform_config.half_last[half] = args->last_chunk;
+	pwm_waveform_config.half_filled[half] = 1;
+
+	pwm_waveform_load_report.offset = args->offset;
+	pwm_waveform_load_report.count = count;
+	prepare_report(&pwm_waveform_load_report, sizeof(pwm_waveform_load_report), 0, 0, 0);
+}
+
+
+
+struct __attribute__((packed)) {
+    uint8_t report_code;
+    uint64_t start_time_us;       // Microsecond timestamp when the playback started.
+    uint64_t end_time_us;         // Microsecond timestamp of this report.
+	uint32_t chunks_played;		  // How many times the waveform (or a streamed chunk) was played so far.
+	uint8_t finished;			  // 1 if the playback is over, 0 for the reports of streamed chunks played.
+	uint8_t underrun;			  // 1 if streaming stopped as the next chunk was not loaded in time.
+	uint8_t rejected;			  // 1 if the playback was not started, as another one is running.
+} pwm_waveform_start_report;
+
+void pwm_waveform_send_report(uint8_t finished, uint8_t underrun, uint8_t rejected) {
+	pwm_waveform_start_report.start_time_us = pwm_waveform_config.start_time_us;
+	pwm_waveform_start_report.end_time_us = time_us_64();
+	pwm_waveform_start_report.chunks_played = pwm_waveform_config.chunks_played;
+	pwm_waveform_start_report.finished = finished;
+	pwm_waveform_start_report.underrun = underrun;
+	pwm_waveform_start_report.rejected = rejected;
+	prepare_report(&pwm_waveform_start_report, sizeof(pwm_waveform_start_report), 0, 0, 0);
+}
+
+void pwm_waveform_start() {
+    /* Plays the waveform stored by pwm_waveform_load() on the *gpio*, which has to be
+	 * configured by pwm_configure_pair() before. The sample rate is independent of the PWM
+	 * frequency; it is 250 MHz * timer_numerator / timer_denominator, up to ca. 10 Msps.
+	 *
+	 * In the one-shot mode (0), the first *length* samples of the table are played once.
+	 * In the loop mode (1), they are repeated until pwm_waveform_stop(). In the streaming
+	 * mode (2), the chunks of *length* samples (up to 1024) stored in the table halves are
+	 * played alternately, until the one marked as the last one. The output keeps the last
+	 * value after the playback.
+	 *
+	 * *This command results in one report when the playback is finished. In the streaming
+	 * mode, it also results in one report each time a chunk was played.*
+     */
+	struct __attribute__((packed)) {
+		uint8_t gpio;				// default=0		min=0		max=25
+		uint16_t length;			// default=2048		min=1		max=2048 Number of samples played (per chunk, in the streaming mode)
+		uint8_t mode;				// default=0		min=0		max=2 One-shot (0), loop (1) or streaming (2)
+		uint16_t timer_numerator;	// default=1		min=1		max=65535
+		uint16_t timer_denominator;	// default=250		min=1		max=65535 Must not be smaller than timer_numerator, which is otherwise reduced to it
+	} * args = (void*)(command_buffer+1);
+
+	if (pwm_waveform_config.playing) {
+		pwm_waveform_send_report(1, 0, 1);
+		return;
+	}
+
+	if (pwm_waveform_data_chan < 0) {
+		pwm_waveform_data_chan = dma_claim_unused_channel(true);
+		pwm_waveform_ctrl_chan = dma_claim_unused_channel(true);
+		pwm_waveform_timer = dma_claim_unused_timer(true);
+
+		dma_channel_set_irq1_enabled(pwm_waveform_data_chan, true);
+		irq_add_shared_handler(DMA_IRQ_1, pwm_waveform_DMA_IRQ_handler, PICO_SHARED_IRQ_HANDLER_DEFAULT_ORDER_PRIORITY);
+		irq_set_enabled(DMA_IRQ_1, true);
+	}
+	uint16_t length = (args->mode == PWM_WAVEFORM_STREAM) ? min(args->length, PWM_WAVEFORM_LEN/2) : args->length;
+	// The DMA timer can not pace faster than the system clock
+	dma_timer_set_fraction(pwm_waveform_timer, min(args->timer_numerator, args->timer_denominator), args->timer_denominator);
+    gpio_set_function(args->gpio, GPIO_FUNC_PWM);
+
+	pwm_waveform_half_address[0] = &pwm_waveform_table[0];
+	pwm_waveform_half_address[1] = &pwm_waveform_table[(args->mode == PWM_WAVEFORM_STREAM) ? PWM_WAVEFORM_LEN/2 : 0];
+
+	// The control channel writes the address of the next half into the data channel, and triggers it
+    dma_channel_config ctrl_cfg = dma_channel_get_default_config(pwm_waveform_ctrl_chan);
+    channel_config_set_transfer_data_size(&ctrl_cfg, DMA_SIZE_32);
+    channel_config_set_read_increment(&ctrl_cfg, true);
+    channel_config_set_write_increment(&ctrl_cfg, false);
+	channel_config_set_ring(&ctrl_cfg, false, 3);  // i.e. wraps around the 2 addresses
+	dma_channel_configure(pwm_waveform_ctrl_chan, &ctrl_cfg,
+		&dma_hw->ch[pwm_waveform_data_chan].al3_read_addr_trig,	// destination
+		&pwm_waveform_half_address[1],							// src, the half to be played next
+		1,
+		false);
+
+    pwm_waveform_data_cfg = dma_channel_get_default_config(pwm_waveform_data_chan);
+    channel_config_set_transfer_data_size(&pwm_waveform_data_cfg, DMA_SIZE_32);
+    channel_config_set_read_increment(&pwm_waveform_data_cfg, true);	// from the table
+    channel_config_set_write_increment(&pwm_waveform_data_cfg, false);	// into the PWM compare register
+    channel_config_set_dreq(&pwm_waveform_data_cfg, dma_get_timer_dreq(pwm_waveform_timer));
+	if ((args->mode == PWM_WAVEFORM_LOOP) ||
+			((args->mode == PWM_WAVEFORM_STREAM) && !pwm_waveform_config.half_last[0]))
+		channel_config_set_chain_to(&pwm_waveform_data_cfg, pwm_waveform_ctrl_chan);
+	// (otherwise the channel chains to itself, which means no chaining)
+
+	pwm_waveform_config.mode = args->mode;
+	pwm_waveform_config.playing = 1;
+	pwm_waveform_config.half_playing = 0;
+	pwm_waveform_config.chunks_played = 0;
+    pwm_waveform_config.start_time_us = time_us_64();
+	dma_channel_configure(pwm_waveform_data_chan, &pwm_waveform_data_cfg,
+		&pwm_hw->slice[pwm_gpio_to_slice_num(args->gpio)].cc,	// destination
+		pwm_waveform_half_address[0],							// src
+		length,
+		true);
+}
+
+
+
+void pwm_waveform_halt() {
+	// Stops both channels; the data channel must not retrigger the control channel meanwhile
+	channel_config_set_chain_to(&pwm_waveform_data_cfg, pwm_waveform_data_chan);
+	dma_channel_set_config(pwm_waveform_data_chan, &pwm_waveform_data_cfg, false);
+	dma_channel_set_irq1_enabled(pwm_waveform_data_chan, false);
+	dma_channel_abort(pwm_waveform_ctrl_chan);
+	dma_channel_abort(pwm_waveform_data_chan);
+	dma_hw->ints1 = 1u << pwm_waveform_data_chan;
+	dma_channel_set_irq1_enabled(pwm_waveform_data_chan, true);
+
+	pwm_waveform_config.playing = 0;
+	pwm_waveform_config.half_filled[0] = pwm_waveform_config.half_filled[1] = 0;
+	pwm_waveform_config.half_last[0] = pwm_waveform_config.half_last[1] = 0;
+}
+
+void pwm_waveform_DMA_IRQ_handler() {
+	if (!(dma_hw->ints1 & (1u << pwm_waveform_data_chan)))
+		return;  // (the IRQ is shared with the logic analyzer)
+    dma_hw->ints1 = 1u << pwm_waveform_data_chan;  // clear the interrupt request to avoid re-trigger
+	pwm_waveform_config.chunks_played++;
+
+	if (pwm_waveform_config.mode == PWM_WAVEFORM_STREAM) {
+		uint8_t played = pwm_waveform_config.half_playing;
+		uint8_t next = played ^ 1;
+		if (pwm_waveform_config.half_last[played]) {
+			pwm_waveform_halt();
+			pwm_waveform_send_report(1, 0, 0);
+		} else if (!pwm_waveform_config.half_filled[next]) {
+			pwm_waveform_halt();  // (the stale half has been playing for a few microseconds)
+			pwm_waveform_send_report(1, 1, 0);
+		} else {
+			pwm_waveform_config.half_filled[played] = 0;
+			pwm_waveform_config.half_playing = next;
+			if (pwm_waveform_config.half_last[next]) {
+				// Do not chain after the last chunk; writing the CTRL alias does not trigger the channel
+				channel_config_set_chain_to(&pwm_waveform_data_cfg, pwm_waveform_data_chan);
+				dma_channel_set_config(pwm_waveform_data_chan, &pwm_waveform_data_cfg, false);
+			}
+			pwm_waveform_send_report(0, 0, 0);
+		}
+	} else if (pwm_waveform_config.mode == PWM_WAVEFORM_ONESHOT) {
+		pwm_waveform_halt();
+		pwm_waveform_send_report(1, 0, 0);
+	}
+}
+
+
+
+struct __attribute__((packed)) {
+    uint8_t report_code;
+	uint32_t chunks_played;		  // How many times the waveform (or a streamed chunk) was played.
+} pwm_waveform_stop_report;
+
+void pwm_waveform_stop() {
+    /* Stops the waveform playback immediately; the output keeps its current value.
+	 *
+	 * If a playback was running, its pwm_waveform_start() report comes too.
+     *
+     * *This command results in one near-immediate report.*
+     */
+	struct __attribute__((packed)) {
+        uint8_t keep_output;    // min=1 max=1 default=1 (No option here - resetting the output to a given value not implemented yet.)
+	} * args = (void*)(command_buffer+1);
+
+	pwm_waveform_stop_report.chunks_played = pwm_waveform_config.chunks_played;
+	if (pwm_waveform_config.playing) {
+		pwm_waveform_halt();
+		pwm_waveform_send_report(1, 0, 0);
+	}
+	prepare_report(&pwm_waveform_stop_report, sizeof(pwm_waveform_stop_report), 0, 0, 0);
+}
@@ -133,6 +133,114 @@ void stepper_status() {
 
 
 
+#define STEPPER_TELEMETRY_MIN_INTERVAL_US 1000  // limits the USB load to ca. 100 kB/s
+
+struct {
+	uint16_t stepper_mask;
+	uint32_t interval_us;
+	uint64_t next_time_us;
+	uint32_t reports_skipped;
+	volatile uint8_t report_now;  // set by the command on core0, so that all reports are issued by core1
+} stepper_telemetry_config;
+
+struct __attribute__((packed)) {
+    uint8_t report_code;
+    uint16_t _data_count;
+    uint8_t _data_bitwidth;
+	uint64_t timestamp_us;
+    uint16_t stepper_mask;               // Which steppers have their nanopos in the data, in ascending order.
+    uint16_t steppers_init_bitmask;
+    uint16_t steppers_moving_bitmask;
+    uint16_t steppers_endswitch_bitmask;
+    uint32_t reports_skipped;            // Number of reports skipped since the previous one due to busy USB. Normally 0.
+} stepper_telemetry_report;
+
+void mk_tx_stepper_telemetry() {
+	int32_t nanopos[MAX_STEPPER_COUNT];
+	uint8_t count = 0;
+
+	stepper_telemetry_report.steppers_init_bitmask = 0;
+	stepper_telemetry_report.steppers_moving_bitmask = 0;
+	stepper_telemetry_report.steppers_endswitch_bitmask = 0;
+	for (uint8_t m=0; m<MAX_STEPPER_COUNT; m++) {
+		if (stepper[m].initialized)
+			stepper_telemetry_report.steppers_init_bitmask |= (1<<m);
+		if (STEPPER_IS_MOVING(m))
+			stepper_telemetry_report.steppers_moving_bitmask |= (1<<m);
+		if (ENDSWITCH_TEST(m))
+			stepper_telemetry_report.steppers_endswitch_bitmask |= (1<<m);
+		if (stepper_telemetry_config.stepper_mask & (1<<m))
+			nanopos[count++] = stepper[m].nanopos;
+	}
+
+	stepper_telemetry_report._data_count = count;
+	stepper_telemetry_report._data_bitwidth = 32;
+	stepper_telemetry_report.timestamp_us = time_us_64();
+	stepper_telemetry_report.stepper_mask = stepper_telemetry_config.stepper_mask;
+	stepper_telemetry_report.reports_skipped = stepper_telemetry_config.reports_skipped;
+	stepper_telemetry_config.reports_skipped = 0;
+	prepare_report(&stepper_telemetry_report, sizeof(stepper_telemetry_report),
+			nanopos, count*sizeof(int32_t), DATA_BY_COPY);
+}
+
+void stepper_telemetry_on_update() { // called from stepper_update() on core1
+	if (stepper_telemetry_config.report_now) {
+		stepper_telemetry_config.report_now = 0;
+		mk_tx_stepper_telemetry();
+		return;
+	}
+	if (!stepper_telemetry_config.interval_us) return;
+	uint64_t now = time_us_64();
+	if (now < stepper_telemetry_config.next_time_us) return;
+
+	stepper_telemetry_config.next_time_us += stepper_telemetry_config.interval_us;
+	if (stepper_telemetry_config.next_time_us < now) // do not try to catch up after a long stall
+		stepper_telemetry_config.next_time_us = now + stepper_telemetry_config.interval_us;
+
+	// Telemetry is not worth delaying other reports; skip it if the transmit buffers are half full
+	if (((txbuf_tofill + TXBUF_COUNT - txbuf_tosend) % TXBUF_COUNT) >= TXBUF_COUNT/2) {
+		stepper_telemetry_config.reports_skipped++;
+		return;
+	}
+	mk_tx_stepper_telemetry();
+}
+
+void stepper_telemetry() {
+	/* Subscribes to periodic reports on the selected steppers. Compared to repeatedly calling
+	 * `stepper_status()`, this saves one command round trip per status update, and the reports
+	 * are generated evenly in time by the stepper control loop itself.
+	 *
+	 * Each report contains a timestamp, the init/moving/endswitch bitmasks of all steppers (like
+	 * `stepper_status()`) and the signed nanopositions of the steppers selected by "stepper_mask", as
+	 * its data in ascending order of stepper number.
+	 *
+	 * The latest values are also cached by the Python module in the `rp.stepper_state` dict,
+	 * which maps each stepper number to its state, regardless of which callback was given.
+	 *
+	 * Calling this command with interval_us=0 stops the telemetry.
+	 *
+	 * *This command results in one immediate report, followed by periodic reports if interval_us > 0.
+	 * Use it with a `_callback` function to receive them, or to just keep `rp.stepper_state` updated.*
+	 */
+	struct __attribute__((packed)) {
+		uint16_t stepper_mask;		// min=0 max=65535 default=65535   Bitmask of steppers to report the nanopos of.
+		uint32_t interval_us;		// min=0 max=100000000 default=10000   Period of the reports; set to 0 to stop them.
+            // Intervals below 1000 µs are rounded up. The timing resolution is given by the 100 µs stepper update cycle.
+	} * args = (void*)(command_buffer+1);
+
+	stepper_telemetry_config.interval_us = 0; // stop core1 from reporting while reconfigured
+	stepper_telemetry_config.stepper_mask = args->stepper_mask;
+	stepper_telemetry_config.reports_skipped = 0;
+	if (args->interval_us) {
+		stepper_telemetry_config.next_time_us = time_us_64() + max(args->interval_us, STEPPER_TELEMETRY_MIN_INTERVAL_US);
+		stepper_telemetry_config.interval_us = max(args->interval_us, STEPPER_TELEMETRY_MIN_INTERVAL_US);
+	}
+	stepper_telemetry_config.report_now = 1;  // the first report is sent within 100 µs by core1
+}
+
+
+
+
 
 
 
@@ -338,4 +446,5 @@ void stepper_update() { // called from core1_main() loop every 100 us
 			stepper[m].nanopos = new_nanopos;
 		}
 	}
+	stepper_telemetry_on_update();
 }
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+"""
+Live oscilloscope-like view of streamed ADC data.
+
+The LiveView object is a stage for the ADC stream (see adc_stream.py): it keeps the most
+recent samples of each channel in a ring buffer, and along with it a pyramid of min/max
+envelopes, each level decimated 4x more than the previous one. Rendering any time window
+then only takes the pyramid level closest to the screen resolution, so that its cost does not
+depend on how many samples are buffered or displayed. Each pixel column shows the full
+min-max range of its samples, so that no spikes are lost by decimation.
+
+With matplotlib, only the traces are redrawn on each frame (using blitting). In headless mode,
+the decimated arrays are available from the `decimated()` method, e.g. for tests and
+benchmarks; matplotlib is then not needed.
+
+    view = LiveView(channel_mask=0b11, clkdiv=95)
+    rp.adc(channel_mask=0b11, blocksize=2000, infinite=1, clkdiv=95, _callback=view)
+    view.show(window_s=0.1)
+"""
+
+import threading
+import time
+
+import numpy as np
+
+import adc_stream
+
+
+
+class LiveView():
+    def __init__(self, channel_mask=1, clkdiv=95, capacity=2**22, width=1000, headless=False):
+        """
+        The *channel_mask* and *clkdiv* must match those given to adc(). The ring buffer keeps
+        the last *capacity* samples per channel; *width* is the number of pixel columns the
+        traces are decimated to.
+        """
+        self.channels = adc_stream.channels_from_mask(channel_mask)
+        self.rate = adc_stream.sample_rate(clkdiv, channel_mask)
+        self.width = width
+        self.headless = headless
+        self.factor = 4
+
+        # Pyramid levels are added until one pixel column would cover the whole buffer
+        self.blocks = [1]
+        while self.blocks[-1] * width < capacity:
+            self.blocks.append(self.blocks[-1] * self.factor)
+        self.capacity = -(-capacity // self.blocks[-1]) * self.blocks[-1]
+
+        n = len(self.channels)
+        self.ring = np.zeros((n, self.capacity), dtype=np.uint16)
+        self.mins = [self.ring] + [np.zeros((n, self.capacity//b), dtype=np.uint16) for b in self.blocks[1:]]
+        self.maxs = [self.ring] + [np.zeros((n, self.capacity//b), dtype=np.uint16) for b in self.blocks[1:]]
+        self.total = 0   # samples per channel received so far
+        self.lock = threading.Lock()
+
+    def __call__(self, report):
+        self.append(adc_stream.split_channels(report))
+
+    def append(self, samples):
+        """ Adds a (channel_count, n) array of new samples """
+        samples = samples[:, -self.capacity:]
+        with self.lock:
+            old_total, n = self.total, samples.shape[1]
+            start = old_total % self.capacity
+            first = min(n, self.capacity - start)
+            self.ring[:, start:start+first] = samples[:, :first]
+            self.ring[:, :n-first] = samples[:, first:]
+            self.total += n
+
+            for j in range(1, len(self.blocks)):
+                size, prev_size = self.capacity // self.blocks[j], self.capacity // self.blocks[j-1]
+                e1 = self.total // self.blocks[j]
+                e0 = max(old_total // self.blocks[j], e1 - size)
+                if e1 == e0:
+                    break  # no higher level can have new entries either
+                idx = np.arange(e0 * self.factor, e1 * self.factor) % prev_size
+                shape = (len(self.channels), e1 - e0, self.factor)
+                new = np.arange(e0, e1) % size
+                self.mins[j][:, new] = self.mins[j-1][:, idx].reshape(shape).min(axis=2)
+                self.maxs[j][:, new] = self.maxs[j-1][:, idx].reshape(shape).max(axis=2)
+
+    def decimated(self, window_s=None, width=None):
+        """
+        Returns the min/max envelope of the last *window_s* seconds (or of the whole buffer) as
+        a tuple (t, mins, maxs): the time of each column in seconds relative to the newest sample,
+        and two (channel_count, columns) arrays.
+        """
+        width = width or self.width
+        with self.lock:
+            n = min(self.total, self.capacity)
+            if window_s is not None:
+                n = min(n, int(window_s * self.rate))
+            j = 0
+            while j+1 < len(self.blocks) and self.blocks[j+1] * width <= n:
+                j += 1
+            block, size = self.blocks[j], self.capacity // self.blocks[j]
+            e1 = self.total // block
+            e0 = max(e1 - n // block, 0)
+            idx = np.arange(e0, e1) % size
+            mins, maxs = self.mins[j][:, idx], self.maxs[j][:, idx]
+            t_last = self.total
+
+        columns = min(width, e1 - e0)
+        if not columns:
+            empty = np.zeros((len(self.channels), 0), dtype=np.uint16)
+            return np.zeros(0), empty, empty
+        bounds = (np.arange(columns) * (e1 - e0)) // columns
+        t = ((e0 + bounds) * block - t_last) / self.rate
+        return t, np.minimum.reduceat(mins, bounds, axis=1), np.maximum.reduceat(maxs, bounds, axis=1)
+
+    def show(self, window_s=0.1, interval_ms=30, ylim=(0, 4095)):
+        """ Opens a matplotlib window that continuously shows the last *window_s* seconds (blocking) """
+        assert not self.headless, 'No window can be shown in headless mode'
+        import matplotlib.pyplot as plt
+
+        fig, ax = plt.subplots(figsize=(12, 6))
+        lines = [ax.plot([], [], lw=.7, c='rgbycm'[ch], label=adc_stream.ADC_CHANNEL_NAMES[ch], animated=True)[0]
+                for ch in self.channels]
+        ax.set_xlim(-window_s, 0)
+        ax.set_ylim(*ylim)
+        ax.set_xlabel("time (s)")
+        ax.set_ylabel("ADC readout")
+        ax.legend(loc='upper left')
+        ax.grid()
+
+        background = {}
+        def grab_background(event=None):   # also needed after the window is resized
+            background['bbox'] = fig.canvas.copy_from_bbox(ax.bbox)
+        fig.canvas.mpl_connect('draw_event', grab_background)
+
+        def update():
+            if 'bbox' not in background:
+                return
+            t, mins, maxs = self.decimated(window_s)
+            fig.canvas.restore_region(background['bbox'])
+            for line, mn, mx in zip(lines, mins, maxs):
+                # vertical stroke from min to max in each column draws the whole envelope
+                line.set_data(np.repeat(t, 2), np.column_stack((mn, mx)).ravel())
+                ax.draw_artist(line)
+            fig.canvas.blit(ax.bbox)
+            fig.canvas.flush_events()
+
+        timer = fig.canvas.new_timer(interval=interval_ms)
+        timer.add_callback(update)
+        timer.start()
+        plt.show()
+
+
+
+if __name__ == "__main__":
+    # Headless benchmark: the rendering time should stay the same for any buffer or window length
+    view = LiveView(channel_mask=0b11, clkdiv=95, capacity=2**23, headless=True)
+    block = (2048 + 2047 * np.sin(np.arange(2 * 2**23) / 1000.)).astype(np.uint16).reshape(2, -1)
+
+    t0 = time.time()
+    for i in range(0, block.shape[1], 5000):
+        view.append(block[:, i:i+5000])
+    dt = time.time() - t0
+    print(f"Appended {view.total} samples per channel in {dt:.3f} s, i.e. {view.total*2/dt/1e6:.1f} MS/s")
+
+    for window_s in (1e-3, 1e-2, .1, 1., 10., 100.):
+        t0 = time.time()
+        for x in range(100):
+            t, mins, maxs = view.decimated(window_s)
+        print(f"window {window_s:7.3f} s: {mins.shape[1]:4d} columns rendered in {(time.time()-t0)*10:.3f} ms")
+
+    # Check the envelope against the raw data: each column must span the first sample it covers,
+    # and the whole envelope must span the whole window
+    t, mins, maxs = view.decimated(2**20 / view.rate)
+    first_samples = block[:, view.total + np.round(t * view.rate).astype(int)]
+    assert np.all(mins <= first_samples) and np.all(first_samples <= maxs)
+    assert mins.min() == block[:, -2**20:].min() and maxs.max() == block[:, -2**20:].max()
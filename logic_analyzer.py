@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+"""
+Decoding of the logic_analyzer() reports.
+
+The device samples *gpio_count* consecutive GPIOs starting at *first_gpio*, and packs as many
+samples as fit into each 32-bit word of the report data (e.g. 4 samples of 8 GPIOs). The
+functions here unpack them with NumPy array operations only, so that even the full-rate
+blocks are decoded in a fraction of a millisecond:
+
+    rp.logic_analyzer(first_gpio=2, gpio_count=4, clkdiv=25, blocks_to_send=1)  # 10 Msps
+    report = ...                                # the report, e.g. from the callback
+    planes = logic_analyzer.bit_planes(report)  # boolean array of shape (4, sample count)
+    e = logic_analyzer.edges(report, gpios=[2, 3])
+    print(e.time_s[e.gpio == 2])                # times of the edges on GPIO 2
+
+pack_samples() does the packing of the device, for generating synthetic bus traffic.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from adc_stream import SYS_CLOCK_HZ
+
+
+Edges = namedtuple('Edges', ['index', 'gpio', 'rising', 'time_s'])
+
+
+
+def sample_rate(clkdiv=250, clkdiv_frac=0):
+    """ Samples per second for the given logic_analyzer() clock divider """
+    return SYS_CLOCK_HZ / (clkdiv + clkdiv_frac / 256)
+
+
+
+def samples_per_word(gpio_count):
+    return 32 // gpio_count
+
+
+
+def samples(report):
+    """ Returns the samples as uint32 array, bit 0 of each being the state of *first_gpio* """
+    n = report.gpio_count
+    per_word = samples_per_word(n)
+    # The PIO shifts the samples in from the top; a word not filled entirely keeps them in its upper bits
+    words = np.asarray(report.data, dtype=np.uint64) >> np.uint64(32 - per_word * n)
+    shifts = np.arange(per_word, dtype=np.uint64) * np.uint64(n)
+    return ((words[:, None] >> shifts) & np.uint64((1 << n) - 1)).astype(np.uint32).ravel()
+
+
+
+def _bits(report, gpios):
+    if gpios is None:
+        return np.arange(report.gpio_count)
+    bits = np.asarray(gpios) - report.first_gpio
+    if np.any((bits < 0) | (bits >= report.gpio_count)):
+        raise ValueError(f"Only GPIOs {report.first_gpio} to {report.first_gpio + report.gpio_count - 1} were sampled")
+    return bits
+
+
+
+def bit_planes(report, gpios=None):
+    """
+    Returns a boolean array of shape (len(gpios), sample count); row i holds the states of
+    GPIO gpios[i]. By default, all sampled GPIOs are returned in their order.
+    """
+    bits = _bits(report, gpios).astype(np.uint32)
+    return ((samples(report)[None, :] >> bits[:, None]) & 1).astype(bool)
+
+
+
+def sample_times(report):
+    """ Device times of the samples in seconds, i.e. start_time_us plus the sampling period times index """
+    n = samples_per_word(report.gpio_count) * len(report.data)
+    return report.start_time_us * 1e-6 + np.arange(n) / sample_rate(report.clkdiv, report.clkdiv_frac)
+
+
+
+def edges(report, gpios=None, previous=None):
+    """
+    Lists all level changes on *gpios* (by default all sampled) as an Edges tuple of arrays,
+    sorted by time: sample *index* where the new level appears first, the *gpio* number,
+    whether the edge is *rising*, and *time_s* on the device clock.
+
+    Edges at the boundary of two blocks are found by passing the last sample of the preceding
+    block as *previous* (e.g. `samples(prev_report)[-1]`); otherwise the first sample of the
+    block is taken as the initial state.
+    """
+    bits = _bits(report, gpios)
+    planes = bit_planes(report, bits + report.first_gpio)
+    if previous is None:
+        first = planes[:, :1]
+    else:
+        first = ((np.uint32(previous) >> bits.astype(np.uint32)) & 1).astype(bool)[:, None]
+    changed = np.diff(planes, axis=1, prepend=first)
+    index, row = np.nonzero(changed.T)     # transposed, so that the edges come sorted by index
+    return Edges(index, bits[row] + report.first_gpio, planes[row, index],
+            report.start_time_us * 1e-6 + index / sample_rate(report.clkdiv, report.clkdiv_frac))
+
+
+
+def pack_samples(sample_values, gpio_count):
+    """
+    Packs the samples into 32-bit words as the device does. Returns them as a list of ints,
+    like the data of a report; a trailing incomplete word is padded with the last sample.
+    """
+    per_word = samples_per_word(gpio_count)
+    s = np.asarray(sample_values, dtype=np.uint64) & np.uint64((1 << gpio_count) - 1)
+    s = np.concatenate([s, np.repeat(s[-1:], -len(s) % per_word)]).reshape(-1, per_word)
+    shifts = np.arange(per_word, dtype=np.uint64) * np.uint64(gpio_count) + np.uint64(32 - per_word * gpio_count)
+    return np.bitwise_or.reduce(s << shifts, axis=1).astype(np.uint32).tolist()
+
+
+
+if __name__ == "__main__":
+    # Self-check on synthetic SPI traffic (does not need any device): chip select on GPIO 0,
+    # clock on GPIO 1 and data on GPIO 2, sampled 8x per clock period
+    import time
+
+    Report = namedtuple('logic_analyzer_report_values', ['report_code', 'data_count', 'data_bitwidth',
+            'start_time_us', 'end_time_us', 'first_gpio', 'gpio_count', 'clkdiv', 'clkdiv_frac',
+            'blocks_to_send', 'block_delayed_by_usb', 'data'])
+    rng = np.random.default_rng(0)
+
+    def spi_traffic(payload, oversampling=8, idle=16):
+        """ Returns the samples of SPI mode 0 transfer of the payload bytes, MSB first """
+        bits = np.unpackbits(np.asarray(payload, dtype=np.uint8))
+        clk = np.tile(np.repeat([0, 1], oversampling // 2), len(bits))
+        mosi = np.repeat(bits, oversampling)
+        cs = np.zeros(len(clk), dtype=np.uint32)
+        pad = lambda x, value: np.concatenate([np.full(idle, value), x, np.full(idle, value)])
+        return pad(cs, 1) | pad(clk, 0) << 1 | pad(mosi, 0) << 2
+
+    payload = rng.integers(0, 256, 500)
+    spi = spi_traffic(payload)
+    for first_gpio, gpio_count in ((5, 3), (0, 4), (8, 8), (0, 30)):    # the SPI lines from first_gpio on
+        report = Report(0, 0, 32, 1_000_000, 0, first_gpio, gpio_count, 25, 0, 0, 0, pack_samples(spi, gpio_count))
+        assert np.array_equal(samples(report)[:len(spi)], spi)
+
+        # Decoding the SPI bytes from the edges: data are read at the rising edges of the clock
+        t0 = time.perf_counter()
+        e = edges(report)
+        clk_rising = e.index[(e.gpio == first_gpio + 1) & e.rising]
+        mosi = bit_planes(report, [first_gpio + 2])[0]
+        decoded = np.packbits(mosi[clk_rising]).tolist()
+        dt = time.perf_counter() - t0
+        assert decoded == payload.tolist(), gpio_count
+        assert e.index[e.gpio == first_gpio].tolist() == [16, len(spi) - 16]
+        print(f"{gpio_count:2d} GPIOs: {len(report.data)} words, {len(e.index)} edges decoded in {dt*1e3:.1f} ms")
+
+    # Edges across the block boundary
+    a = Report(0, 0, 32, 0, 0, 0, 8, 25, 0, 0, 0, pack_samples([0, 0, 0, 1], 8))
+    b = Report(0, 0, 32, 1, 0, 0, 8, 25, 0, 0, 0, pack_samples([3, 3, 3, 3], 8))
+    assert edges(b).index.size == 0
+    e = edges(b, previous=samples(a)[-1])
+    assert e.index.tolist() == [0] and e.gpio.tolist() == [1] and e.rising.tolist() == [True]
+    assert abs(sample_times(b)[1] - (1e-6 + 0.1e-6)) < 1e-12
+
+    # Throughput on a full-size block (4096 words) of random traffic
+    report = Report(0, 0, 32, 0, 0, 0, 8, 25, 0, 0, 0, rng.integers(0, 2**32, 4096).tolist())
+    t0 = time.perf_counter()
+    for x in range(20):
+        planes = bit_planes(report)
+    dt_planes = (time.perf_counter() - t0) / 20
+    t0 = time.perf_counter()
+    for x in range(20):
+        e = edges(report)
+    dt_edges = (time.perf_counter() - t0) / 20
+    print(f"Full block of {planes.shape[1]} samples: bit planes in {dt_planes*1e3:.2f} ms, " +
+            f"{len(e.index)} edges in {dt_edges*1e3:.2f} ms")
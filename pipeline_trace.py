@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+"""
+Timeline of the report pipeline, for diagnosing stalls.
+
+Each report passes through the USB backend process (reading the bytes), the report processing
+thread (decoding them) and the callback dispatching thread (waiting in the callback queue, and
+running the callback). With tracing enabled, each of these steps is recorded as a span into a
+fixed-size ring buffer, which keeps the latest events:
+
+    rp = rp2daq.Rp2daq(trace_events=200_000)
+    ...
+    rp.export_trace("trace.json")
+
+The file is in the Chrome trace-event format; open it at https://ui.perfetto.dev or in
+chrome://tracing. Recording one span costs a few hundred nanoseconds; without tracing, the
+pipeline only checks that the tracer is None.
+
+Both processes take the time from time.perf_counter_ns(), which is the same system-wide
+monotonic clock on Linux, Windows and macOS.
+"""
+
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+
+# Kinds of spans, and the (process, thread) where they are shown
+USB_READ, COALESCE, RX_WAIT, DECODE, QUEUED, CALLBACK = range(6)
+SPAN_NAMES = {USB_READ: "USB read", COALESCE: "coalescing wait", RX_WAIT: "waiting for bytes",
+        DECODE: "decode", QUEUED: "in callback queue", CALLBACK: "callback"}
+SPAN_THREADS = {USB_READ: (1, 1), COALESCE: (1, 1), RX_WAIT: (0, 1), DECODE: (0, 1), QUEUED: (0, 2), CALLBACK: (0, 2)}
+THREAD_NAMES = {(0, 1): "report processor", (0, 2): "callback dispatcher", (1, 1): "USB receiver"}
+PROCESS_NAMES = {0: "rp2daq main process", 1: "USB backend process"}
+
+
+
+class BackendTrace():
+    """ Ring of spans in shared memory, filled by the USB backend process """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.spans = multiprocessing.RawArray('q', 4 * capacity)    # kind, start, end, detail
+        self.count = multiprocessing.RawValue('q', 0)
+
+    def record(self, kind, start_ns, end_ns, detail):
+        i = self.count.value
+        j = 4 * (i % self.capacity)
+        self.spans[j:j+4] = (kind, start_ns, end_ns, detail)
+        self.count.value = i + 1
+
+    def latest(self):
+        count = self.count.value
+        spans = self.spans[:]
+        for i in range(max(0, count - self.capacity), count):
+            j = 4 * (i % self.capacity)
+            yield tuple(spans[j:j+4])
+
+
+
+class PipelineTracer():
+    def __init__(self, capacity=100_000):
+        """ Keeps the last *capacity* spans of the main process, and as many of the backend """
+        self.capacity = capacity
+        self.spans = [None] * capacity
+        self.counter = itertools.count()    # next() is atomic, so threads do not need a lock
+        self.backend = BackendTrace(capacity)
+
+    def record(self, kind, start_ns, end_ns, detail):
+        """ Records a span; *detail* is the report type, or the byte count for the byte transfers """
+        self.spans[next(self.counter) % self.capacity] = (kind, start_ns, end_ns, detail)
+
+    def traced_callback(self, args):
+        """ Runs a callback from the callback queue (see Rp2daq_internals._report_processor) """
+        callback, report, queued_ns = args
+        start_ns = time.perf_counter_ns()
+        callback(report)
+        self.record(QUEUED, queued_ns, start_ns, report[0])
+        self.record(CALLBACK, start_ns, time.perf_counter_ns(), report[0])
+
+    def events(self, report_names=None):
+        """ Returns the recorded spans as a list of trace events, sorted by time """
+        report_names = report_names or {}
+        spans = [s for s in self.spans if s] + list(self.backend.latest())
+        events = []
+        for kind, start_ns, end_ns, detail in sorted(spans, key=lambda s: s[1]):
+            pid, tid = SPAN_THREADS[kind]
+            if kind in (USB_READ, COALESCE, RX_WAIT):
+                name, args = SPAN_NAMES[kind], {"bytes": detail}
+            else:
+                report_name = report_names.get(detail, str(detail))
+                name, args = f"{report_name} {SPAN_NAMES[kind]}", {"report": report_name}
+            events.append({"name": name, "cat": "rp2daq", "ph": "X", "pid": pid, "tid": tid,
+                    "ts": start_ns / 1000, "dur": (end_ns - start_ns) / 1000, "args": args})
+        return events
+
+    def export(self, filename, report_names=None):
+        """ Writes the spans into a JSON file in the Chrome trace-event format """
+        metadata = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}}
+                for pid, name in PROCESS_NAMES.items()]
+        metadata += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                for (pid, tid), name in THREAD_NAMES.items()]
+        with open(filename, "w") as of:
+            json.dump({"traceEvents": metadata + self.events(report_names), "displayTimeUnit": "ms"}, of)
+
+
+
+if __name__ == "__main__":
+    # Measures the cost of recording a span, and writes a small synthetic trace
+    import tempfile
+
+    n = 1_000_000
+    tracer = PipelineTracer(capacity=100_000)
+    t0 = time.perf_counter()
+    for i in range(n):
+        tracer.record(DECODE, i, i + 1, 8)
+    dt_main = (time.perf_counter() - t0) / n
+    t0 = time.perf_counter()
+    for i in range(n):
+        tracer.backend.record(USB_READ, i, i + 1, 64)
+    dt_backend = (time.perf_counter() - t0) / n
+    t0 = time.perf_counter()
+    for i in range(n):
+        start_ns = time.perf_counter_ns()
+        tracer.record(DECODE, start_ns, time.perf_counter_ns(), 8)
+    dt_timed = (time.perf_counter() - t0) / n
+    disabled = None
+    t0 = time.perf_counter()
+    for i in range(n):
+        if disabled:
+            disabled.record(DECODE, i, i + 1, 8)
+    dt_disabled = (time.perf_counter() - t0) / n
+    print(f"Recording a span: {dt_main*1e9:.0f} ns in the main process, {dt_backend*1e9:.0f} ns in the backend, " +
+            f"{dt_timed*1e9:.0f} ns including both timestamps; disabled: {dt_disabled*1e9:.0f} ns")
+
+    tracer = PipelineTracer(capacity=1000)
+    now = time.perf_counter_ns()
+    for i in range(1500):
+        tracer.backend.record(USB_READ, now + i*1000, now + i*1000 + 300, 4000)
+        tracer.record(DECODE, now + i*1000 + 400, now + i*1000 + 600, 8)
+        tracer.traced_callback((lambda report: None, (8, 0), time.perf_counter_ns()))
+    filename = os.path.join(tempfile.gettempdir(), "rp2daq_trace_selfcheck.json")
+    tracer.export(filename, {8: "adc"})
+    with open(filename) as f:
+        events = json.load(f)["traceEvents"]
+    assert len([e for e in events if e["ph"] == "X"]) == 2000 and events[-1]["name"].startswith("adc")
+    print(f"Wrote {len(events)} events to {filename}")
@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+"""
+Running heavy report callbacks in a pool of worker processes.
+
+Normally all callbacks run in one thread of the main process, where they compete for the GIL
+with the thread decoding the reports; slow analysis of each ADC block would then make the
+incoming data pile up. With
+
+    rp.adc(..., infinite=1, _callback=analyze, _callback_executor="process")
+
+each report is instead passed to `analyze(report)` in a worker process, so that the analysis
+scales over CPU cores. The data payload travels through shared memory, and arrives as a
+read-only NumPy array which is only valid until the function returns. The function has to be
+defined at module level (so that it can be pickled), and on Windows or macOS the script needs
+the usual `if __name__ == "__main__":` guard.
+
+To receive the values returned by the function, give a ProcessOffload object instead:
+
+    offload = process_offload.ProcessOffload(workers=4, max_in_flight=8, result_callback=plot)
+    rp.adc(..., infinite=1, _callback=analyze, _callback_executor=offload)
+
+The results are passed to *result_callback* in the same order as the reports came, from the
+usual callback thread of the main process; this callback should be quick.
+"""
+
+from collections import deque
+import concurrent.futures
+import logging
+from multiprocessing import shared_memory
+import os
+import queue
+import threading
+
+import numpy as np
+
+import adc_shared_memory
+
+
+MAX_PAYLOAD_BYTES = 65535 * 4   # data_count is 16-bit, the widest data are 32-bit
+
+
+
+# Worker process side: attached once by the pool initializer
+_shm, _report_classes = None, {}
+
+def _worker_init(name):
+    global _shm
+    _shm = adc_shared_memory.attach(name)
+
+def _worker_call(fn, class_name, fields, values, offset, count, dtype):
+    from collections import namedtuple
+    cls = _report_classes.get((class_name, fields))
+    if cls is None:
+        cls = _report_classes[(class_name, fields)] = namedtuple(class_name, fields)
+    if count is not None:
+        data = np.ndarray((count,), dtype=dtype, buffer=_shm.buf, offset=offset)
+        data.flags.writeable = False
+        values = values + (data,)
+    return fn(cls(*values))
+
+
+
+class ProcessOffload():
+    def __init__(self, workers=None, max_in_flight=None, result_callback=None, slot_bytes=MAX_PAYLOAD_BYTES):
+        """
+        Starts a pool of *workers* processes (by default one per CPU core). At most
+        *max_in_flight* reports (by default twice the worker count) are processed or waiting
+        at once; further reports wait in the callback queue of the main process, so no data
+        are lost. The *result_callback* receives the return values of the worker function.
+        """
+        self.workers = workers or os.cpu_count()
+        self.max_in_flight = max_in_flight or 2 * self.workers
+        self.result_callback = result_callback
+        self.slot_bytes = slot_bytes
+        self.dispatch = lambda fn, arg: fn(arg)    # Rp2daq directs this to its callback thread
+
+        self.shm = shared_memory.SharedMemory(create=True, size=self.max_in_flight * slot_bytes)
+        self.free_slots = queue.Queue()
+        for slot in range(self.max_in_flight):
+            self.free_slots.put(slot)
+        self.in_flight = deque()
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                initializer=_worker_init, initargs=(self.shm.name,))
+
+    def wrap(self, fn):
+        """ Returns a report callback which runs *fn* on the report in a worker process """
+        return lambda report: self.submit(fn, report)
+
+    def submit(self, fn, report):
+        values, count, dtype = tuple(report), None, None
+        slot = self.free_slots.get()    # waits if max_in_flight reports are being processed
+        if 'data' in report._fields:
+            values = values[:-1]
+            dtype = np.uint8 if report.data_bitwidth <= 8 else np.uint16 if report.data_bitwidth <= 16 else np.uint32
+            count = len(report.data)
+            if count * np.dtype(dtype).itemsize > self.slot_bytes:
+                self.free_slots.put(slot)
+                raise ValueError(f"Report data of {count} values do not fit into the slot of {self.slot_bytes} B")
+            np.ndarray((count,), dtype=dtype, buffer=self.shm.buf, offset=slot*self.slot_bytes)[:] = report.data
+
+        with self.lock:
+            future = self.executor.submit(_worker_call, fn, type(report).__name__, report._fields,
+                    values, slot*self.slot_bytes, count, dtype)
+            self.in_flight.append(future)
+        future.add_done_callback(lambda f: self._on_done(slot))
+
+    def _on_done(self, slot):
+        self.free_slots.put(slot)
+        with self.lock:     # results are passed on strictly in the order of submitting
+            while self.in_flight and self.in_flight[0].done():
+                self.dispatch(self._deliver, self.in_flight.popleft())
+
+    def _deliver(self, future):
+        try:
+            result = future.result()
+        except Exception:
+            logging.exception("Offloaded callback failed")
+            return
+        if self.result_callback:
+            self.result_callback(result)
+
+    def shutdown(self):
+        """ Waits for the reports in flight to be processed, and frees the shared memory """
+        self.executor.shutdown(wait=True)
+        self.shm.close()
+        self.shm.unlink()
+
+
+
+def _benchmark_analysis(report):
+    # a moderately heavy per-block analysis: spectrum and its peak
+    spectrum = np.abs(np.fft.rfft(np.tile(report.data.astype(float), 50)))
+    return report.blocks_to_send, int(spectrum[1:].argmax())
+
+
+
+if __name__ == "__main__":
+    # Benchmark on synthetic ADC-like reports (does not need any device)
+    from collections import namedtuple
+    import time
+
+    Report = namedtuple('adc_report_values', ['report_code', 'data_count', 'data_bitwidth', 'blocks_to_send', 'data'])
+    rng = np.random.default_rng(0)
+    reports = [Report(8, 4000, 12, 300-i, rng.integers(0, 4096, 4000).tolist()) for i in range(300)]
+
+    t0 = time.time()
+    expected = [_benchmark_analysis(r._replace(data=np.array(r.data))) for r in reports]
+    dt_inline = time.time() - t0
+    print(f"In the callback thread: {len(reports)/dt_inline:.0f} blocks/s")
+
+    results, done = [], threading.Event()
+    def result_cb(result):
+        results.append(result)
+        if len(results) == len(reports):
+            done.set()
+    offload = ProcessOffload(max_in_flight=16, result_callback=result_cb)
+    offload.submit(_benchmark_analysis, reports[0])  # warm up the worker processes
+    time.sleep(1)
+    results.clear()
+    t0 = time.time()
+    callback = offload.wrap(_benchmark_analysis)
+    for r in reports:
+        callback(r)
+    done.wait()
+    dt = time.time() - t0
+    print(f"In {offload.workers} worker processes: {len(reports)/dt:.0f} blocks/s")
+    offload.shutdown()
+    assert results == expected, "results must come in the original order"
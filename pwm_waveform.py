@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+"""
+Arbitrary waveforms on PWM outputs, played by the device from a DMA-driven table.
+
+Setting the duty cycle by pwm_set_value() costs a USB round trip of some 2 ms per sample. The
+PwmWaveform class instead uploads the samples into the device table, which the DMA copies into
+the PWM compare register at a precise rate. Waveforms of up to 2048 samples are played once
+or in a loop; longer ones are streamed in chunks of 1024 samples, the host loading the next
+chunk each time one was played:
+
+    rp.pwm_configure_pair(gpio=0, wrap_value=999)       # 250 kHz PWM with 1000 levels
+    t = np.arange(100_000) / 50_000
+    rp.pwm_waveform(0, 500 + 400 * np.sin(2 * np.pi * 50 * t), rate=50_000)   # 2 s of 50 Hz
+
+When low-pass filtered, the PWM output gives the analog waveform. Streaming needs the host to
+load a chunk within the time the other one plays, i.e. 1024 / rate seconds; rates up to some
+100 ksps are thus safe, while the one-shot and loop playback work up to several Msps.
+"""
+
+from collections import namedtuple
+from fractions import Fraction
+import threading
+
+import numpy as np
+
+import c_code_parser
+from adc_stream import SYS_CLOCK_HZ
+
+
+
+ONESHOT, LOOP, STREAM = range(3)    # modes of pwm_waveform_start(), see pwm_waveform.c
+
+
+
+def rate_fraction(rate):
+    """
+    Returns the (numerator, denominator) of the DMA timer which is closest to the *rate* in
+    samples per second, and the rate they actually give.
+    """
+    if not SYS_CLOCK_HZ / 65535 <= rate <= SYS_CLOCK_HZ:
+        raise ValueError(f"Rate must be between {SYS_CLOCK_HZ/65535:.0f} and {SYS_CLOCK_HZ:.0f} samples per second")
+    f = Fraction(rate / SYS_CLOCK_HZ).limit_denominator(65535)
+    return f.numerator, f.denominator, SYS_CLOCK_HZ * f.numerator / f.denominator
+
+
+
+class PwmWaveform():
+    def __init__(self, rp, gpio, samples, rate, loop=False):
+        """
+        Prepares the playback of *samples* (duty-cycle values up to the wrap_value set by
+        pwm_configure_pair) on *gpio* at *rate* samples per second. Rates below 3815 sps are
+        obtained by repeating each sample. With *loop*, the waveform plays until stop().
+        """
+        self.rp, self.gpio = rp, gpio
+        self.table_length = c_code_parser.get_C_code_define('PWM_WAVEFORM_LEN')
+
+        samples = np.rint(np.asarray(samples, dtype=float)).astype(np.int64)
+        if samples.ndim != 1 or not len(samples):
+            raise ValueError("Samples must be a non-empty 1-D array")
+        if samples.min() < 0 or samples.max() > 65535:
+            raise ValueError("Samples must be duty-cycle values from 0 to 65535")
+        repeat = int(np.ceil(SYS_CLOCK_HZ / 65535 / rate))
+        self.samples = np.repeat(samples, repeat).astype(np.uint16)
+        self.numerator, self.denominator, self.rate = rate_fraction(rate * repeat)
+        self.rate /= repeat
+
+        if len(self.samples) <= self.table_length:
+            self.mode = LOOP if loop else ONESHOT
+            self.chunks = [self.samples]
+        elif loop:
+            raise ValueError(f"Only waveforms up to {self.table_length} samples can be looped")
+        else:
+            self.mode = STREAM
+            chunk_length = self.table_length // 2
+            padded = np.concatenate([self.samples, np.repeat(self.samples[-1:], -len(self.samples) % chunk_length)])
+            self.chunks = np.split(padded, len(padded) // chunk_length)  # (the last value is held anyway)
+
+        self.done = threading.Event()
+        self.report = None      # the last pwm_waveform_start report
+
+    def start(self):
+        """ Uploads the waveform (or its first two chunks) and starts the playback """
+        self.done.clear()
+        for index, chunk in enumerate(self.chunks[:2]):
+            self._load(index, wait=True)
+        self.rp.pwm_waveform_start(self.gpio, len(self.chunks[0]), self.mode,
+                self.numerator, self.denominator, _callback=self._playback_report)
+        return self
+
+    def wait(self, timeout=None):
+        """ Waits until the playback is over; returns the final pwm_waveform_start report """
+        self.done.wait(timeout)
+        return self.report
+
+    def stop(self):
+        self.rp.pwm_waveform_stop()
+        return self.wait()
+
+    def _load(self, index, wait=False):
+        offset = (index % 2) * (self.table_length // 2)
+        last_chunk = int(self.mode == STREAM and index == len(self.chunks) - 1)
+        self.rp.pwm_waveform_load(self.gpio, offset, last_chunk, self.chunks[index],
+                _callback=None if wait else (lambda report: None))
+
+    def _playback_report(self, report):
+        self.report = report
+        if report.finished:
+            self.done.set()
+        elif report.chunks_played + 1 < len(self.chunks):
+            self._load(report.chunks_played + 1)     # into the half just played
+
+
+
+if __name__ == "__main__":
+    # Self-check with a simulated device, which plays the table halves as the firmware does
+    # (does not need any device)
+    import time
+
+    Report = namedtuple('pwm_waveform_start_report_values',
+            ['report_code', 'start_time_us', 'end_time_us', 'chunks_played', 'finished', 'underrun', 'rejected'])
+
+    class SimulatedDevice():
+        def __init__(self, chunk_time_s=0.002):
+            self.table, self.played = np.zeros(2048, dtype=np.uint16), []
+            self.filled, self.last = [0, 0], [0, 0]
+            self.chunk_time_s, self.stopped = chunk_time_s, threading.Event()
+
+        def pwm_waveform_load(self, gpio, offset, last_chunk, samples, _callback=None):
+            self.table[offset:offset+len(samples)] = samples
+            half = int(offset >= 1024)
+            self.filled[half], self.last[half] = 1, last_chunk
+
+        def pwm_waveform_start(self, gpio, length, mode, numerator, denominator, _callback=None):
+            def play():
+                chunks = 0
+                while True:
+                    half = chunks % 2 if mode == STREAM else 0
+                    self.played.append(self.table[half*1024:half*1024+length].copy())
+                    time.sleep(self.chunk_time_s)
+                    chunks += 1
+                    finished = mode == ONESHOT or (mode == STREAM and self.last[half]) or self.stopped.is_set()
+                    underrun = mode == STREAM and not finished and not self.filled[1 - half]
+                    if mode == STREAM:
+                        self.filled[half] = 0
+                    _callback(Report(0, 0, 0, chunks, int(finished or underrun), int(underrun), 0))
+                    if finished or underrun:
+                        return
+            threading.Thread(target=play).start()
+
+        def pwm_waveform_stop(self):
+            self.stopped.set()
+
+    assert rate_fraction(1e6)[:2] == (1, 250) and abs(rate_fraction(44100)[2] - 44100) < 0.5
+    for rate in (SYS_CLOCK_HZ * 1.001, 1000):
+        try:
+            rate_fraction(rate)
+            raise AssertionError(f"rate {rate} accepted")
+        except ValueError:
+            pass
+
+    rng = np.random.default_rng(0)
+    for length in (1, 2048, 2049, 10_000):
+        samples = rng.integers(0, 1000, length)
+        device = SimulatedDevice()
+        report = PwmWaveform(device, 0, samples, rate=100_000).start().wait()
+        played = np.concatenate(device.played)
+        assert report.finished and not report.underrun
+        assert np.array_equal(played[:length], samples) and np.all(played[length:] == samples[-1])
+        print(f"{length} samples played in {len(device.played)} chunk(s)")
+
+    device = SimulatedDevice()
+    waveform = PwmWaveform(device, 0, rng.integers(0, 1000, 100), rate=1000, loop=True).start()
+    time.sleep(0.02)
+    report = waveform.stop()
+    assert report.finished and report.chunks_played >= 5 and waveform.rate == 1000
+    assert np.array_equal(device.played[0], np.repeat(waveform.samples[::4], 4))
+    print(f"Looped {report.chunks_played} times, each sample repeated 4x to get {waveform.rate:.0f} sps")
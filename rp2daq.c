@@ -4,7 +4,9 @@
 #include <hardware/clocks.h>
 #include <hardware/dma.h>
 #include <hardware/irq.h>
+#include <hardware/pio.h>
 #include <hardware/pwm.h>
+#include <hardware/sync.h>
 #include <pico/binary_info.h>
 #include <pico/multicore.h>
 #include <pico/stdlib.h>
@@ -16,7 +18,9 @@
 #include "include/identify.c"
 #include "include/gpio.c"
 #include "include/adc_builtin.c"
+#include "include/logic_analyzer.c"
 #include "include/pwm.c"
+#include "include/pwm_waveform.c"
 #include "include/stepper.c"
 
 // === I/O MESSAGING INFRASTRUCTURE ===
@@ -38,43 +42,60 @@ message_descriptor message_table[] = // #new_features: add your command to this
                 {&gpio_out,			&gpio_out_report},
                 {&gpio_in,			&gpio_in_report},
                 {&gpio_on_change,	&gpio_on_change_report},
+                {&gpio_on_change_batch,	&gpio_on_change_batch_report},
                 {&gpio_highz,		&gpio_highz_report},
                 {&gpio_pull,		&gpio_pull_report},
                 {&gpio_out_seq,		&gpio_out_seq_report},
                 {&adc,				&adc_report},
-                {&adc_stop,		    &adc_stop_report},
+                {&adc_stop,		    &adc_stop_report},         // urgent
                 {&pwm_configure_pair, &pwm_configure_pair_report},
                 {&pwm_set_value,	&pwm_set_value_report},
                 {&stepper_init,		&stepper_init_report},
                 {&stepper_move,		&stepper_move_report},
                 {&stepper_status,	&stepper_status_report},
+                {&stepper_telemetry,	&stepper_telemetry_report},
+                {&ping,				&ping_report},             // urgent
+                {&logic_analyzer,	&logic_analyzer_report},
+                {&logic_analyzer_stop,	&logic_analyzer_stop_report},  // urgent
+                {&pwm_waveform_load,	&pwm_waveform_load_report},
+                {&pwm_waveform_start,	&pwm_waveform_start_report},
+                {&pwm_waveform_stop,	&pwm_waveform_stop_report},    // urgent
                 //
-			 // {handler fn ref,	report struct instance ref}
+			 // {handler fn ref,	report struct instance ref}    (optionally "// urgent" to send it before others)
         };  
 
                 //{&adc_set_trigger,	&adc_set_trigger_report},
 
+static inline uint8_t rx_wait_byte() {
+    int c;
+    while ((c = getchar_timeout_us(0)) == PICO_ERROR_TIMEOUT) 
+        busy_wait_us_32(1); // todo-optimization: avoid busy loop entirely?
+    return (uint8_t) c;
+}
+
 static inline void rx_next_command() {
-    int packet_size;
+    int first_byte;
+    uint16_t packet_size;
     uint8_t packet_data;
     message_descriptor message_entry;
     command_buffer[0] = 0x00;
 
     // Tries to pull a byte from the USB built-in buffer. If not available, just quit.
-    if ((packet_size = getchar_timeout_us(0)) == PICO_ERROR_TIMEOUT) {
+    if ((first_byte = getchar_timeout_us(0)) == PICO_ERROR_TIMEOUT) {
         return; 
     } else {
-        // If a byte is present, it encodes the length of the respective command. Get it entire.
-        // The next byte is the command ID and the following bytes are the associated data bytes
-        // (small todo: allow 16bit packet_size e.g. for DAC output)
+        // If a byte is present, it starts the 16-bit little-endian length of the respective 
+        // command. Get the command entire. Its first byte is the command ID and the following 
+        // bytes are the associated data bytes.
+        packet_size = first_byte | (rx_wait_byte() << 8);
         for (int i = 0; i < packet_size; i++) {
-            while ((packet_data = (uint8_t) getchar_timeout_us(0)) == PICO_ERROR_TIMEOUT) 
-                busy_wait_us_32(1); // todo-optimization: avoid busy loop entirely?
-            command_buffer[i] = packet_data;
+            packet_data = rx_wait_byte();
+            if (i < RXBUF_LEN) command_buffer[i] = packet_data; // (over-long commands are drained)
         }
+        command_length = packet_size;
 
-        // Check for unknown message - this should never happen. (todo: report it)
-        if (command_buffer[0] >= ARRAY_LEN(message_table))  // FIXME comm freezes when commented out
+        // Check for unknown or over-long message - this should never happen. (todo: report it)
+        if ((command_buffer[0] >= ARRAY_LEN(message_table)) || (packet_size > RXBUF_LEN))
             return; 
 
         // Seek for the associated command handler function, implemented in the include/*.c files
@@ -206,6 +227,8 @@ int main() {  // CPU core0 can be fully occupied with USB communication
 		}
 
 		iADC_on_buffer_transmitted();
+		logic_on_buffer_transmitted();
+		gpio_batch_on_main_loop();
 	}
 }
 
@@ -1,5 +1,5 @@
 
-#define FIRMWARE_VERSION {"rp2daq_250317_"}
+#define FIRMWARE_VERSION {"rp2daq_261020_"}
 
 
 #define TUD_OPT_HIGH_SPEED (1)
@@ -26,10 +26,14 @@
 #define min(a,b) ({ __typeof__ (a) _a = (a); __typeof__ (b) _b = (b);  _a < _b ? _a : _b; })
 
 
-// Simple buffer for incoming commands
-// (small fixme: python module should check no command is longer than RXBUF_LEN bytes
-#define RXBUF_LEN 1024    
+// Simple buffer for incoming commands; their length is a 16-bit number, but RAM is precious
+// (the python module checks no command is longer than RXBUF_LEN bytes)
+#define RXBUF_LEN 8192    
 uint8_t command_buffer[RXBUF_LEN];
+uint16_t command_length;  // length of the command being handled, including its 1-byte ID
+
+// Number of items in a variable-length array, that may be the last field of a command struct
+#define COMMAND_ARRAY_LEN(args, field)  ((command_length - 1 - sizeof(*(args))) / sizeof((args)->field[0]))
 
 // Cyclic buffer for staging reports to be sent (fixed-length structures only)
 #define TXBUF_LEN 256    // (longer data than this can be transmitted as reference to memory)
@@ -13,7 +13,9 @@ More information and examples on https://github.com/FilipDominec/rp2daq or in RE
 
 
 import atexit
-from collections import deque, namedtuple
+from collections import Counter, deque, namedtuple
+import functools
+import inspect
 import logging
 import multiprocessing
 import os
@@ -30,6 +32,9 @@ import tkinter
 import types
 
 import c_code_parser
+import pipeline_trace
+import transports
+import usb_backend_process
 
 
 
@@ -43,15 +48,79 @@ def init_error_msgbox():  # error handling with a graphical message box
 
 
 
+def decode_gpio_batch(report):
+    """
+    Converts the packed 16-bit records from a `gpio_on_change_batch` report into three NumPy
+    arrays: absolute event timestamps (in microseconds), gpio numbers, and edge directions
+    (True for rising edge). The record format is described in include/gpio.c.
+    """
+    import numpy as np
+    records = np.asarray(report.data, dtype=np.uint16)
+    gpio = records & 0x1F
+    overflow = (gpio == 31)          # pseudo-records only extending the time between events
+    delta_us = np.where(overflow, (records >> 5).astype(np.uint64) * 1024, records >> 6)
+    time_us = report.start_time_us + np.cumsum(delta_us, dtype=np.uint64)
+    return time_us[~overflow], gpio[~overflow].astype(np.uint8), (records[~overflow] & 0x20) > 0
+
+
+
+StepperState = namedtuple('StepperState', ['nanopos', 'moving', 'endswitch', 'timestamp_us'])
+UsbStats = namedtuple('UsbStats', usb_backend_process.USB_STATS_FIELDS)
+Reconnect = namedtuple('Reconnect', ['lost_at', 'restored_at', 'recovery_s', 'rearmed_commands'])
+
+# Reports whose 32-bit data payload holds signed integers (the C structs only give the bit width)
+SIGNED_DATA_REPORTS = ('stepper_telemetry',)
+
+
+# Commands setting up a lasting activity of the device. Their last calls are recorded and sent 
+# again after the device reconnected (see Rp2daq.__init__). Each function returns the key of 
+# the activity (a new call replaces the recorded one with the same key), and whether the call 
+# keeps the activity running.
+REARMED_COMMANDS = {
+        'adc':                  lambda a: ('adc', bool(a['infinite'])),
+        'adc_stop':             lambda a: ('adc', False),
+        'logic_analyzer':       lambda a: ('logic_analyzer', bool(a['infinite'])),
+        'logic_analyzer_stop':  lambda a: ('logic_analyzer', False),
+        'gpio_on_change':       lambda a: (('gpio_on_change', a['gpio']), bool(a['on_rising_edge'] or a['on_falling_edge'])),
+        'gpio_on_change_batch': lambda a: (('gpio_on_change_batch', a['gpio']), bool(a['on_rising_edge'] or a['on_falling_edge'])),
+        'pwm_configure_pair':   lambda a: (('pwm_configure_pair', a['gpio']), True),
+        'pwm_set_value':        lambda a: (('pwm_set_value', a['gpio']), True),
+        'stepper_init':         lambda a: (('stepper_init', a['stepper_number']), True),
+        }
+
+
+
 class Rp2daq():
-    def __init__(self, required_device_id="", verbose=False):
+    def __init__(self, required_device_id="", verbose=False, transport=None, reconnect_timeout_s=0, trace_events=0):
+        """
+        Connects to a rp2daq device on USB, served by a separate process. The *transport* may
+        select another way (see transports.py): "thread" serves the USB port by threads of this
+        process, for a lower latency of commands; "tcp://localhost:7777" or "unix:///tmp/rp2daq.sock"
+        connects to a device shared by rp2daq_bridge.py; "replay:///path/to/recording" plays back
+        a recorded session and "emulator" starts a simulated device. A transports.Transport
+        object may be given, too, e.g. to record the session or to use a fixed serial port.
+
+        With *reconnect_timeout_s* set, a USB device which disconnects is looked for again 
+        during this time. Once it is back, the continuous activities set up earlier (infinite 
+        ADC, GPIO change reports, PWM, steppers) are configured again and the commands issued 
+        meanwhile are sent. Each such gap is recorded in `rp.reconnects`. Note the device may 
+        have restarted, so e.g. its timestamps and stepper positions start from zero again.
+
+        With *trace_events* set, the last that many steps of report processing are recorded 
+        for export_trace().
+        """
 
         logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO, 
                 format='%(asctime)s (%(threadName)-9s) %(message)s',) # filename='rp2.log',
 
+        # Latest state of each stepper, kept updated by the stepper_telemetry reports
+        self.stepper_state = {}
+        self.reconnects = []    # Reconnect tuples, marking the gaps in the reports
+
         # Most of the technicalities are delegated to the following class. Rp2daq's namespace, 
         # exposed to the user, will be kept clean and dynamically populated with useful commands.
-        self._i = Rp2daq_internals(externals=self, required_device_id=required_device_id, verbose=verbose)
+        self._i = Rp2daq_internals(externals=self, required_device_id=required_device_id, verbose=verbose, 
+                transport=transport, reconnect_timeout_s=reconnect_timeout_s, trace_events=trace_events)
 
         atexit.register(self.quit) # (fixme?) does not work well with Spyder console
 
@@ -61,38 +130,118 @@ class Rp2daq():
         time.sleep(0.01) # is this necessary?
         if self._i.run_event.is_set():
             self._i.run_event.clear()
-            self._i.terminate_queue.put(b'1')   # let the subprocess release the port on its own
-            self._i.terminate_queue.get(block=True) # wait for confirmation it succeeded
+            with self._i.backend_lock:  # not while the backend is being restarted
+                if not self._i.transport.usb or self._i.usb_backend_process.is_alive():
+                    self._i.terminate_queue.put(b'1')   # let the backend release the port on its own
+                    self._i.terminate_queue.get(block=True) # wait for confirmation it succeeded
+            self._i.transport.close()
+        if self._i.process_offload:
+            self._i.process_offload.shutdown()
+            self._i.process_offload = None
+
+    def usb_stats(self):
+        """
+        Returns the statistics of receiving data from USB: the number of reads and bytes, the largest 
+        chunk read at once, the estimated byte rate, and the current and total time the receiving 
+        loop waited for the data to coalesce (see AdaptiveReadPolicy in usb_backend_process.py). 
+        Returns None if the device is not connected on USB (e.g. through rp2daq_bridge.py).
+        """
+        if not self._i.transport.usb:
+            return None
+        return UsbStats(*self._i.usb_stats)
+
+    def export_trace(self, filename):
+        """
+        Writes the recorded timeline of USB reads, report decoding, waiting for callbacks and 
+        running them into a Chrome trace-event JSON file (see pipeline_trace.py). Needs the 
+        *trace_events* option.
+        """
+        if not self._i.tracer:
+            raise RuntimeError("Tracing is off, use e.g. Rp2daq(trace_events=100000)")
+        self._i.tracer.export(filename, self._i.report_names)
+
+    def subscribe(self, command_name, _callback, _callback_executor=None):
+        """
+        Passes all further reports of given command to the callback, even if the command was not 
+        called from this script. This is useful with reports coming from a device shared through 
+        rp2daq_bridge.py, like the ADC stream started by another client.
+        """
+        report_type = {name: code for code, name in self._i.report_names.items()}[command_name]
+        self._i.report_callbacks[report_type] = self._i._wrap_callback(_callback, _callback_executor)
+        if self._i.transport.shared:
+            import rp2daq_bridge
+            self._i._send(rp2daq_bridge.subscribe_message(report_type))
+
+    def pwm_waveform(self, gpio, samples, rate, loop=False, wait=True):
+        """
+        Plays the duty-cycle *samples* (a list or NumPy array) on *gpio* at *rate* samples per
+        second, uploading them in chunks (see pwm_waveform.py). The PWM must be configured by
+        pwm_configure_pair() before. Returns the PwmWaveform object, after the playback is over
+        if *wait* is set; a *loop* plays until its stop() method is called.
+        """
+        import pwm_waveform
+        waveform = pwm_waveform.PwmWaveform(self, gpio, samples, rate, loop=loop).start()
+        if wait and not loop:
+            waveform.wait()
+        return waveform
+
+
+
+class _BackendRestarted(Exception):
+    pass
+
+
+
+class _MessageCapture():
+    """ Stands in for Rp2daq_internals when a command function is only run to get its message """
+    def __init__(self):
+        self.run_event = threading.Event()
+        self.run_event.set()
+        self.sync_report_cb_queues, self.report_callbacks = {}, {}
+        self.message = None
+
+    def _wrap_callback(self, callback, executor):
+        return callback
+
+    def _send(self, message, urgent=False):
+        self.message = message
 
 
 
 class Rp2daq_internals(threading.Thread):
-    def __init__(self, externals, required_device_id="", verbose=False):
+    def __init__(self, externals, required_device_id="", verbose=False, transport=None, reconnect_timeout_s=0,
+            trace_events=0):
         threading.Thread.__init__(self) 
 
         self._e = externals
+        self.transport = transports.get(transport)
+        self.reconnect_timeout_s = reconnect_timeout_s
+        self.backend_lock = threading.Lock()
+        self.send_lock = threading.Lock()   # the reconnect supervisor swaps the command_queue under it
+        self.rearm_lock = threading.Lock()
+        self.rearm_messages = {}            # activity key -> message, see REARMED_COMMANDS
+        self.swallow_reports = Counter()    # report type -> number of replies to re-armed commands to drop
+        self.process_offload = None     # default pool for _callback_executor="process", started on demand
+        self.tracer = pipeline_trace.PipelineTracer(trace_events) if trace_events else None
 
         self._register_commands()
 
-        # auto-checking binary compatibility of device's firmware against available C code
-        rp2daq_h_ver = c_code_parser.get_C_code_version()
-        self.port_name = self._find_device(required_device_id, required_firmware_version=rp2daq_h_ver)
-
         ## Asynchronous communication using threads
         self.sleep_tune = 0.001
 
-        self.report_queue = multiprocessing.Queue()  
-        self.command_queue = multiprocessing.Queue()  
-        self.terminate_queue = multiprocessing.Queue()  
-
-        # Establish reliable USB connection using a child process, patching the multiprocessing.Process
-        # class so that user scripts are no more required to contain the __name__=='__main__' guard clause.
-        import usb_backend_process as ubp
-        self.usb_backend_process = ubp.PatchedProcess(
-                target=ubp.usb_backend, 
-                args=(self.report_queue, self.command_queue, self.terminate_queue, self.port_name))
-        self.usb_backend_process.daemon = True
-        self.usb_backend_process.start()
+        if not self.transport.usb:
+            # Device owned by a bridge server (which also checked its firmware version), or a replay;
+            # served by threads of this process, as there is no USB data flow to be kept fluent
+            self.report_queue, self.command_queue, self.terminate_queue = self.transport.open()
+        else:
+            # auto-checking binary compatibility of device's firmware against available C code
+            rp2daq_h_ver = c_code_parser.get_C_code_version()
+            self.port_name = self._find_device(required_device_id, required_firmware_version=rp2daq_h_ver,
+                    port=self.transport.port)
+            self.device_id = self.port_name.serial_number or required_device_id
+            self.usb_stats = multiprocessing.Array('d', len(usb_backend_process.USB_STATS_FIELDS), lock=False)
+            self.command_queue = self.transport.command_lanes()
+            self._start_usb_backend(self.command_queue)
 
         # Additionally, run two separate threads in the main process te deal with incoming reports.  
         self.report_processing_thread = threading.Thread(target=self._report_processor, daemon=True)
@@ -105,6 +254,87 @@ class Rp2daq_internals(threading.Thread):
         self.report_processing_thread.start()
         self.callback_dispatching_thread.start()
         self.run_event.set()
+        if reconnect_timeout_s and self.transport.usb:
+            threading.Thread(target=self._reconnect_supervisor, daemon=True).start()
+
+
+    def _start_usb_backend(self, command_queue):
+        # A process or a thread, depending on the transport; it is joined by the reconnect supervisor
+        self.report_queue, self.terminate_queue, self.usb_backend_process = self.transport.start_backend(
+                command_queue, self.port_name, self.usb_stats, self.tracer.backend if self.tracer else None)
+
+
+    def _reconnect_supervisor(self):
+        """
+        A thread which restarts the USB backend whenever it ends while the device is in
+        use, and re-arms the recorded activities. Callbacks and other state of this process are
+        kept as they are.
+        """
+        while True:
+            self.usb_backend_process.join()
+            if not self.run_event.is_set():     # regular quit()
+                return
+            lost_at = time.time()
+            held_commands = usb_backend_process.CommandLanes(queue.Queue, threading.Semaphore)
+            with self.send_lock:    # commands issued meanwhile wait here, with those the backend did not take
+                dead_lanes, self.command_queue = self.command_queue, held_commands
+                for message, urgent in dead_lanes.drain(timeout=0.05):  # (inter-process queues deliver with delay)
+                    held_commands.put(message, urgent=urgent)
+            logging.warning(f"Device disconnected, trying to reconnect for {self.reconnect_timeout_s} s")
+
+            while self.run_event.is_set() and time.time() < lost_at + self.reconnect_timeout_s:
+                try:
+                    self.port_name = self._find_device(self.device_id, 
+                            required_firmware_version=c_code_parser.get_C_code_version(), port=self.transport.port)
+                    break
+                except RuntimeError:
+                    time.sleep(0.1)
+            else:
+                if self.run_event.is_set():
+                    logging.critical(f"Device did not reconnect within {self.reconnect_timeout_s} s")
+                return
+
+            command_queue, old_report_queue = self.transport.command_lanes(), self.report_queue
+            with self.backend_lock:
+                if not self.run_event.is_set():
+                    return
+                self._start_usb_backend(command_queue)
+            old_report_queue.put(None)  # the report processor switches to the new queue
+
+            with self.rearm_lock:
+                rearmed = list(self.rearm_messages.values())
+            with self.send_lock:
+                for message in rearmed:
+                    if self.report_callbacks.get(message[2]) is None:   # blocking command; nobody waits for the reply
+                        self.swallow_reports[message[2]] += 1
+                    command_queue.put(message)
+                for message, urgent in held_commands.drain():
+                    command_queue.put(message, urgent=urgent)
+                self.command_queue = command_queue
+
+            restored_at = time.time()
+            self._e.reconnects.append(Reconnect(lost_at, restored_at, restored_at - lost_at, len(rearmed)))
+            logging.warning(f"Device reconnected after {restored_at - lost_at:.2f} s, {len(rearmed)} commands re-armed")
+
+
+    def _rearm_recorder(self, cmd_name, command_function, method):
+        """ Wraps a command method so that its calls are recorded according to REARMED_COMMANDS """
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def recorded_method(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            capture = _MessageCapture()
+            command_function(capture, **dict(arguments.arguments, _callback=True)) # also checks the arguments
+            key, active = REARMED_COMMANDS[cmd_name](arguments.arguments)
+            with self.rearm_lock:
+                if active:
+                    self.rearm_messages[key] = capture.message
+                else:
+                    self.rearm_messages.pop(key, None)
+            return method(*args, **kwargs)
+        return recorded_method
 
 
     def _register_commands(self):
@@ -117,7 +347,11 @@ class Rp2daq_internals(threading.Thread):
 
         for cmd_name, cmd_code in names_codes.items():
             exec(cmd_code)
-            setattr(self._e, cmd_name, types.MethodType(locals()[cmd_name], self))
+            command_function = locals()[cmd_name]
+            method = types.MethodType(command_function, self)
+            if cmd_name in REARMED_COMMANDS and self.reconnect_timeout_s and self.transport.usb:
+                method = self._rearm_recorder(cmd_name, command_function, method)
+            setattr(self._e, cmd_name, method)
 
         # Search C code for report structs & generate automatically:
         self.sync_report_cb_queues = {}
@@ -126,11 +360,44 @@ class Rp2daq_internals(threading.Thread):
         # Stores callbacks (to dispatch reports as they arrive); generate corresponding named tuples for each
         self.report_callbacks = {} 
         self.report_namedtuple_classes = {} 
+        self.report_hooks = {}  # functions called on every report of given type, before its callback
         for report_type, varnames in self.report_header_varnames.items():
             self.report_namedtuple_classes[report_type] = namedtuple(
                     self.report_names[report_type] + '_report_values', 
                     varnames + (['data'] if 'data_bitwidth' in varnames else []))
 
+        for report_type, report_name in self.report_names.items():
+            if report_name == 'stepper_telemetry':
+                self.report_hooks[report_type] = self._update_stepper_state
+
+
+    def _update_stepper_state(self, report):
+        """ Caches the latest positions from a stepper_telemetry report in `rp.stepper_state`. """
+        nanopos = iter(report.data)
+        for m in range(16):
+            if report.stepper_mask & (1<<m):
+                self._e.stepper_state[m] = StepperState(
+                        nanopos=next(nanopos),
+                        moving=bool(report.steppers_moving_bitmask & (1<<m)),
+                        endswitch=bool(report.steppers_endswitch_bitmask & (1<<m)),
+                        timestamp_us=report.timestamp_us)
+
+
+    def _wrap_callback(self, callback, executor):
+        """ Returns the function to be called with each report, possibly passing it to worker processes """
+        if not executor:
+            return callback
+        assert callback, "The _callback_executor needs a _callback to run"
+        import process_offload
+        if executor == "process":
+            if not self.process_offload:
+                self.process_offload = process_offload.ProcessOffload()
+            executor = self.process_offload
+        elif not isinstance(executor, process_offload.ProcessOffload):
+            raise ValueError(f"Unknown _callback_executor {executor}, use \"process\" or a ProcessOffload object")
+        executor.dispatch = lambda fn, arg: self.async_report_cb_queue.put((fn, arg))  # results to callback thread
+        return executor.wrap(callback)
+
 
     def _report_processor(self):
         """
@@ -141,13 +408,20 @@ class Rp2daq_internals(threading.Thread):
         def queue_recv_bytes(length): # note: should re-implement with io.BytesIO() ring buffer?
             while len(self.rx_bytes) < length:
                 #c = self.report_pipe_out.recv_bytes()
-                c = self.report_queue.get()
+                wait_ns = time.perf_counter_ns() if tracer else 0
+                c = report_queue.get()
+                if c is None:   # the USB backend was restarted, see _reconnect_supervisor
+                    raise _BackendRestarted
+                if tracer:
+                    tracer.record(pipeline_trace.RX_WAIT, wait_ns, time.perf_counter_ns(), len(c))
 
                 self.rx_bytes.extend(c) # superfluous bytes are kept in deque for later use
                 #self.rx_bytes_total_len += len(c)
             return bytes([self.rx_bytes.popleft() for _ in range(length)])
 
-        def unpack_data_payload(data_bytes, count, bitwidth):
+        signed_data_types = {t for t, name in self.report_names.items() if name in SIGNED_DATA_REPORTS}
+
+        def unpack_data_payload(data_bytes, count, bitwidth, signed=False):
             if bitwidth == 8:
                 return list(data_bytes)  # for any bitwidth return a list of ints, not the bytes object
             elif bitwidth == 12:      # quick compress byte triplet into 12b integer pairs
@@ -158,11 +432,14 @@ class Rp2daq_internals(threading.Thread):
                 return [x for l in zip(odd,even) for x in l] + ([odd[-1]] if len(odd)>len(even) else [])
             elif bitwidth == 16:      # compress byte pairs into 16b integers (note: LE byte order)
                 return [a+(b<<8) for a,b in zip(data_bytes[:-1:2], data_bytes[1::2])]
+            elif bitwidth == 32:
+                return list(struct.unpack(f'<{count}i' if signed else f'<{count}I', data_bytes))
             else:
                 print(bitwidth, count, len(data_bytes))
                 raise NotImplementedError 
 
         self.run_event.wait()
+        report_queue, tracer = self.report_queue, self.tracer
 
         while self.run_event.is_set():
             try:
@@ -170,6 +447,7 @@ class Rp2daq_internals(threading.Thread):
                     # 1st: Get 1st byte to tell the report type
                     report_type_b = queue_recv_bytes(1); 
                     report_type = ord(report_type_b)
+                    decode_ns = time.perf_counter_ns() if tracer else 0
                     packet_length = self.report_header_lenghts[report_type] - 1
 
                     # 2nd: Get the corresponding header
@@ -187,17 +465,30 @@ class Rp2daq_internals(threading.Thread):
 
                         # Use pre-cached classes for each report type
                         return_values = self.report_namedtuple_classes[report_type](
-                                *report_args, unpack_data_payload(payload_raw, count, bitwidth))
+                                *report_args, unpack_data_payload(payload_raw, count, bitwidth, 
+                                    signed=report_type in signed_data_types))
                     else:
                         return_values = self.report_namedtuple_classes[report_type](
                                 *report_args)
 
+                    if tracer:
+                        tracer.record(pipeline_trace.DECODE, decode_ns, time.perf_counter_ns(), report_type)
+
                     # 4th: Register callback (if async), or wait (if sync)
+                    hook = self.report_hooks.get(report_type)
+                    if hook:
+                        hook(return_values)
                     cb = self.report_callbacks.get(report_type, False) # false for unexpected reports
-                    if cb:
+                    if cb is None and self.swallow_reports[report_type]:
+                        self.swallow_reports[report_type] -= 1
+                    elif cb and tracer:
+                        self.async_report_cb_queue.put((tracer.traced_callback, (cb, return_values, time.perf_counter_ns())))
+                    elif cb:
                         self.async_report_cb_queue.put((cb, return_values))
                     elif cb is None: # expected report from blocking command
                         self.sync_report_cb_queues[report_type].put(return_values) # unblock default callback (& send it data)
+                        if hook: # periodic reports: next ones are only passed to the hook, not piled up in the queue
+                            self.report_callbacks[report_type] = lambda _: None
                     elif cb is False: # unexpected report, from command that was not yet called in this script instance
                         logging.warning(f"Warning: Unexpected report type; you may want to reset the device. \n\tDebug info: {return_values}", 
                                 report_namedtuple_classes[return_values])
@@ -205,6 +496,10 @@ class Rp2daq_internals(threading.Thread):
                 ## TODO: enqueue to be called by yet another thread (so that sync cmds work within callbacks,too)
                 ## TODO: check if sync cmd works correctly after async cmd (of the same type)
 
+            except _BackendRestarted:
+                self.rx_bytes.clear()   # the rest of a report cut by the disconnection
+                report_queue = self.report_queue
+
             except EOFError:
                 logging.warning("Got EOF from the receiver process, quitting")
                 self._e.quit()
@@ -219,6 +514,11 @@ class Rp2daq_internals(threading.Thread):
             (cb, return_values) = self.async_report_cb_queue.get()
             cb(return_values)
 
+    def _send(self, message, urgent=False):
+        """ Passes a command message to the backend; called from *autogenerated* code for each command """
+        with self.send_lock:
+            self.command_queue.put(message, urgent=urgent)
+
     def default_blocking_callback(self, command_code): # 
         """
         Any command called without explicit `_callback` argument is blocking - i.e. the thread
@@ -232,19 +532,24 @@ class Rp2daq_internals(threading.Thread):
         kwargs = self.sync_report_cb_queues[command_code].get() # waits until default callback unblocked
         return kwargs
 
-    def _find_device(self, required_device_id, required_firmware_version=0):
+    @staticmethod
+    def _find_device(required_device_id, required_firmware_version=0, port=None):
         """
         Seeks for a compatible rp2daq device on USB, checking for its firmware version and, if 
-        specified, for its particular unique vendor name.
+        specified, for its particular unique vendor name. With *port* given, only this serial 
+        port is checked.
         """
 
-        port_list = list_ports.comports()
+        if port:
+            port_list = [types.SimpleNamespace(device=port, hwid=None, serial_number=None)]
+        else:
+            port_list = list_ports.comports()
 
         for port_name in port_list:
             # filter out ports, without disturbing previously connected devices 
             #VID=0x2e8a;  PID = 0x000a for RP2040, but 0x0009 for RP2350 
             #print(port_name.hwid)
-            if not (port_name.hwid.startswith("USB VID:PID=2E8A:000A SER="+required_device_id.upper()) or
+            if port_name.hwid is not None and not (port_name.hwid.startswith("USB VID:PID=2E8A:000A SER="+required_device_id.upper()) or
                 port_name.hwid.startswith("USB VID:PID=2E8A:0009 SER="+required_device_id.upper()) ): 
                 continue
             #print(f"port_name.hwid={port_name.hwid}")
@@ -255,7 +560,7 @@ class Rp2daq_internals(threading.Thread):
                 #time.sleep(.05) # 50ms round-trip time is enough
 
                 # the "identify" command is hard-coded here, as the receiving threads are not ready yet
-                try_port.write(struct.pack(r'<BBB', 1, 0, 1)) 
+                try_port.write(struct.pack(r'<HBB', 2, 0, 1)) 
                 time.sleep(.15) # 50ms round-trip time is enough
                 assert try_port.in_waiting == 1+2+1+30
                 id_data = try_port.read(try_port.in_waiting)[4:] 
@@ -277,12 +582,14 @@ class Rp2daq_internals(threading.Thread):
             if isinstance(required_device_id, str): # optional conversion
                 required_device_id = required_device_id.replace(":", "")
             found_device_id = id_data[14:]
-            if required_device_id and found_device_id != required_device_id:
+            if required_device_id and found_device_id.decode(errors='replace').upper() != required_device_id.upper():
                 logging.info(f"Found an rp2daq device, but its ID {found_device_id} does not match " + 
                         f"required {required_device_id}")
                 continue
 
             logging.info(f"Connected to rp2daq device with unique ID = {found_device_id.decode()} and correct FW version = {required_firmware_version}")
+            if port_name.serial_number is None:
+                port_name.serial_number = found_device_id.decode(errors='replace')
             #return try_port
             try_port.close()
             return port_name
@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+"""
+Bridge server sharing one rp2daq device among several processes.
+
+Only one process can own the serial port of the device. This server owns it and accepts any
+number of clients over TCP or a Unix socket; each client simply uses
+
+    rp = rp2daq.Rp2daq(transport="tcp://127.0.0.1:7777")
+
+with the same commands as if the device was connected directly. Commands from all clients are
+passed to the device as they come. The incoming byte stream is split into whole reports, each
+of which is sent to the client that issued the corresponding command; if more clients wait for
+the same report type, they get the reports in the order of their commands. After that, further
+reports of the same type (e.g. a continuous ADC stream) go to the client which issued the
+command last. Other clients can receive copies of them by calling `rp.subscribe(command_name,
+_callback)`.
+
+The reports are forwarded as slices of the receive buffer, without being decoded or copied.
+Note that a client which does not read its socket eventually stalls the others.
+
+Start the server with
+    python rp2daq_bridge.py tcp://127.0.0.1:7777       (or unix:///tmp/rp2daq.sock)
+and measure its overhead with
+    python rp2daq_bridge.py --benchmark usb              (before starting the server)
+    python rp2daq_bridge.py --benchmark tcp://127.0.0.1:7777
+"""
+
+import argparse
+from collections import defaultdict, deque
+import logging
+import queue
+import serial
+import socket
+import struct
+import threading
+import time
+
+import c_code_parser
+import usb_backend_process
+
+
+BRIDGE_CONTROL_CODE = 0xFF   # never a valid command code; such messages are for the server only
+UNSUBSCRIBE, SUBSCRIBE = 0, 1
+
+
+
+def parse_address(transport):
+    """ Returns the socket family and address for strings like tcp://host:port or unix:///path """
+    if transport.startswith('tcp://'):
+        host, port = transport[len('tcp://'):].rsplit(':', 1)
+        return socket.AF_INET, (host, int(port))
+    elif transport.startswith('unix://'):
+        return socket.AF_UNIX, transport[len('unix://'):]
+    raise ValueError(f"Unsupported transport {transport}, use tcp://host:port or unix:///path")
+
+
+
+def subscribe_message(report_type, subscribe=True):
+    return struct.pack('<HBBB', 3, BRIDGE_CONTROL_CODE, SUBSCRIBE if subscribe else UNSUBSCRIBE, report_type)
+
+
+
+class _TerminateQueue(queue.Queue):
+    """ Closing the socket directly on request ensures the confirmation is not consumed by others """
+    def __init__(self, sock):
+        super().__init__()
+        self.sock = sock
+        self.terminate_pending = threading.Event()
+
+    def put(self, item, *args, **kwargs):
+        if item == b'1':
+            self.terminate_pending.set()
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass    # server already disconnected, confirmation was put by the input thread
+        else:
+            super().put(item, *args, **kwargs)
+
+
+
+def connect(transport):
+    """
+    Connects to a bridge server and returns the report, command and terminate queues, which
+    behave like those connected to usb_backend_process.usb_backend().
+    """
+    family, address = parse_address(transport)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    if family == socket.AF_INET:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    report_queue, terminate_queue = queue.Queue(), _TerminateQueue(sock)
+    command_queue = usb_backend_process.CommandLanes(queue.Queue, threading.Semaphore)
+
+    def _raw_byte_output_thread():
+        while True:
+            out_bytes = command_queue.get(block=True)
+            try:
+                sock.sendall(out_bytes)
+            except OSError:
+                return
+
+    def _raw_byte_input_thread():
+        while True:
+            try:
+                in_bytes = sock.recv(1<<16)
+            except OSError:
+                in_bytes = b''
+            if not in_bytes:
+                break
+            report_queue.put(in_bytes)
+        if terminate_queue.terminate_pending.is_set():
+            logging.info("Disconnected from the bridge server")
+        else:
+            logging.error("Bridge server unexpectedly disconnected!")
+        sock.close()
+        terminate_queue.put(b'2')   # report back to main thread we are done here
+
+    threading.Thread(target=_raw_byte_output_thread, daemon=True).start()
+    threading.Thread(target=_raw_byte_input_thread, daemon=True).start()
+    return report_queue, command_queue, terminate_queue
+
+
+
+class _Client():
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.name = str(address) or 'unix socket client'
+        self.send_lock = threading.Lock()
+
+    def send(self, data):
+        with self.send_lock:
+            self.sock.sendall(data)
+
+
+
+class BridgeServer():
+    def __init__(self, transport, required_device_id=""):
+        self.report_names, self.report_header_lenghts, self.report_header_formats, \
+                self.report_header_varnames, _, _ = c_code_parser.analyze_c_firmware()
+
+        import rp2daq
+        port_name = rp2daq.Rp2daq_internals._find_device(required_device_id,
+                required_firmware_version=c_code_parser.get_C_code_version())
+        self.port = serial.Serial(port=port_name.device, timeout=None)
+        self.port_lock = threading.Lock()
+
+        self.lock = threading.Lock()                # guards the four structures below
+        self.clients = set()
+        self.pending = defaultdict(deque)           # report type -> clients waiting for it, in order
+        self.owners = {}                            # report type -> client that got the last report
+        self.subscribers = defaultdict(set)         # report type -> clients receiving copies
+
+        family, address = parse_address(transport)
+        self.server_socket = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind(address)
+        self.server_socket.listen()
+        logging.info(f"rp2daq bridge serving device {port_name.device} at {transport}")
+
+    def serve_forever(self):
+        threading.Thread(target=self._serial_reader, daemon=True).start()
+        while True:
+            sock, address = self.server_socket.accept()
+            if sock.family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = _Client(sock, address)
+            with self.lock:
+                self.clients.add(client)
+            logging.info(f"Client {client.name} connected")
+            threading.Thread(target=self._client_reader, args=(client,), daemon=True).start()
+
+    def _drop(self, client):
+        with self.lock:
+            if client not in self.clients:
+                return
+            self.clients.discard(client)
+            for waiting in self.pending.values():
+                while client in waiting:
+                    waiting.remove(client)
+            for subscribed in self.subscribers.values():
+                subscribed.discard(client)
+            for report_type in [t for t, owner in self.owners.items() if owner is client]:
+                del self.owners[report_type]
+        client.sock.close()
+        logging.info(f"Client {client.name} disconnected")
+
+    def _client_reader(self, client):
+        buf = bytearray()
+        while True:
+            try:
+                in_bytes = client.sock.recv(1<<16)
+            except OSError:
+                in_bytes = b''
+            if not in_bytes:
+                return self._drop(client)
+            buf += in_bytes
+
+            pos = 0
+            while len(buf) >= pos + 2:  # commands are framed by 16-bit length, see DEVELOPERS.md
+                length = buf[pos] + (buf[pos+1] << 8)
+                if len(buf) < pos + 2 + length:
+                    break
+                code = buf[pos+2]
+                if code == BRIDGE_CONTROL_CODE:
+                    op, report_type = buf[pos+3], buf[pos+4]
+                    with self.lock:
+                        if op == SUBSCRIBE:
+                            self.subscribers[report_type].add(client)
+                        else:
+                            self.subscribers[report_type].discard(client)
+                else:
+                    with self.lock:  # register the client before the report can possibly come
+                        self.pending[code].append(client)
+                    with memoryview(buf) as mv, self.port_lock:
+                        self.port.write(mv[pos:pos+2+length])
+                pos += 2 + length
+            del buf[:pos]
+
+    def _report_length(self, buf, pos):
+        """ Returns the length of the report starting at pos, or None if it is not complete yet """
+        report_type = buf[pos]
+        header_length = self.report_header_lenghts.get(report_type)
+        if header_length is None:
+            logging.warning(f"Unknown report type {report_type}, skipping one byte")
+            return 1
+        if len(buf) < pos + header_length:
+            return None
+        if "data_count" not in self.report_header_varnames[report_type]:
+            return header_length
+        header = dict(zip(self.report_header_varnames[report_type],
+                struct.unpack_from(self.report_header_formats[report_type], buf, pos)))
+        length = header_length - (-header["data_count"] * header["data_bitwidth"] // 8)
+        return length if len(buf) >= pos + length else None
+
+    def _route(self, report_type, report):
+        with self.lock:
+            targets = set(self.subscribers.get(report_type, ()))
+            if self.pending.get(report_type):
+                self.owners[report_type] = self.pending[report_type].popleft()
+            if report_type in self.owners:
+                targets.add(self.owners[report_type])
+        for client in targets:
+            try:
+                client.send(report)
+            except OSError:
+                self._drop(client)
+
+    def _serial_reader(self):
+        buf = bytearray()
+        while True:
+            buf += self.port.read(max(1, self.port.in_waiting))
+            pos = 0
+            with memoryview(buf) as mv:
+                while pos < len(buf):
+                    length = self._report_length(buf, pos)
+                    if length is None:
+                        break
+                    with mv[pos:pos+length] as report:
+                        self._route(buf[pos], report)
+                    pos += length
+            del buf[:pos]
+
+
+
+def benchmark(transport=None, round_trips=1000, adc_blocks=500):
+    """ Measures the command round trip latency and ADC streaming throughput """
+    import rp2daq
+    rp = rp2daq.Rp2daq(transport=transport)
+
+    latencies = []
+    for x in range(round_trips):
+        t0 = time.perf_counter()
+        rp.gpio_in(25)
+        latencies.append(time.perf_counter() - t0)
+    latencies.sort()
+    print(f"{transport or 'direct USB'}: gpio_in round trip median {latencies[len(latencies)//2]*1e3:.3f} ms, " +
+            f"99th percentile {latencies[len(latencies)*99//100]*1e3:.3f} ms")
+
+    done, received = threading.Event(), []
+    def adc_cb(rv):
+        received.append(len(rv.data))
+        if not rv.blocks_to_send:
+            done.set()
+    t0 = time.perf_counter()
+    rp.adc(blocksize=4000, blocks_to_send=adc_blocks, clkdiv=95, _callback=adc_cb)
+    done.wait()
+    dt = time.perf_counter() - t0
+    print(f"{transport or 'direct USB'}: ADC stream of {sum(received)} samples at {sum(received)/dt/1e3:.1f} ksps")
+    rp.quit()
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shares one rp2daq device among several client processes.")
+    parser.add_argument('transport', nargs='?', default='tcp://127.0.0.1:7777',
+            help="Address to serve at, like tcp://127.0.0.1:7777 or unix:///tmp/rp2daq.sock")
+    parser.add_argument('--device-id', default='', help="Unique ID of the device to serve")
+    parser.add_argument('--benchmark', action='store_true',
+            help="Instead of serving, measure latency and throughput of a running server (or 'usb' for direct connection)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s (%(threadName)-9s) %(message)s')
+    if args.benchmark:
+        benchmark(None if args.transport == 'usb' else args.transport)
+    else:
+        BridgeServer(args.transport, required_device_id=args.device_id).serve_forever()
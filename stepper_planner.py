@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+"""
+Host-side motion planner for groups of steppers.
+
+A path of multi-axis waypoints is turned into segments, in which the speed of each axis is
+chosen so that all axes of the group arrive at the waypoint together. The timing is estimated
+by a Python model of the acceleration law in `stepper_update()` (see include/stepper.c).
+
+The firmware keeps only one target per stepper and re-issuing stepper_move() restarts its
+acceleration ramp, so segments cannot be queued on the device. Instead, all commands are
+precomputed and each segment is issued directly from the report callback of the last axis
+that finished the previous one; the user thread only waits on the returned futures.
+
+Typical use:
+
+    planner = MotionPlanner(rp, inertia={0: 190, 1: 190}, max_speed=64)
+    futures = planner.run([{0: 0, 1: 0}, {0: 600000, 1: 400000}, {0: 200000, 1: 1000000}])
+    for f in futures:
+        print(f.result())   # dict of stepper_move reports, by stepper number
+"""
+
+from collections import namedtuple
+import concurrent.futures
+import threading
+
+
+UPDATE_PERIOD_US = 100    # stepper_update() is called by a 10 kHz timer
+
+
+
+def usqrt(val):
+    """ Same (terribly inaccurate) integer square root as in the firmware """
+    if val < 2:
+        return val
+    a = 100                             # USQRTSTART
+    for j in range(3):                  # USQRTITERN
+        b = val // a
+        a = (a + b) >> 2                # USQRTBOOST = 1
+    return (a << 1) & 0xFFFFFFFF
+
+
+
+def _ramp_limit(distance, inertia):
+    return (usqrt(distance) * 100 & 0xFFFFFFFF) // inertia + 1
+
+
+
+def move_cycles(distance, speed, inertia, fast_forward=True):
+    """
+    Returns the number of 100 µs stepper_update() cycles a stepper needs to travel *distance*
+    nanosteps at the maximum *speed* (in nanosteps per cycle), from a standstill and
+    with the *inertia* given to stepper_init().
+
+    With *fast_forward*, the cruising part of long moves (where neither the acceleration nor the
+    deceleration ramp limits the speed) is skipped over analytically, making the estimate cost
+    independent of the distance.
+    """
+    distance, speed, inertia = abs(int(distance)), max(int(speed), 1), max(int(inertia), 1)
+
+    # Beyond this distance from the start and the end, ramps can not limit the speed (as the
+    # firmware usqrt never falls much below the true square root)
+    ramp_span = 4 * ((speed * inertia) // 100 + 2)**2 + 1000
+
+    traveled, cycles = 0, 0
+    while traveled < distance:
+        remaining = distance - traveled
+        if fast_forward and traveled > ramp_span and remaining > ramp_span + speed:
+            skip = (remaining - ramp_span) // speed
+            traveled += skip * speed
+            cycles += skip
+            continue
+        actual = min(speed, _ramp_limit(remaining, inertia), _ramp_limit(traveled, inertia))
+        traveled = min(traveled + actual, distance)
+        cycles += 1
+    return cycles
+
+
+
+def speed_for_cycles(distance, cycles, max_speed, inertia):
+    """
+    Returns the lowest speed (at most *max_speed*) with which a move of *distance* nanosteps
+    finishes in no more than *cycles* update cycles. Found by bisection, as the move duration
+    decreases with the speed.
+    """
+    lo, hi = 1, max(int(max_speed), 1)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if move_cycles(distance, mid, inertia) <= cycles:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+
+Segment = namedtuple('Segment', ['targets', 'speeds', 'duration_us'])
+
+
+
+class MotionPlanner():
+    def __init__(self, rp, inertia, max_speed=64, endswitch_sensitive_down=1):
+        """
+        The *inertia* dict maps each stepper number in the group to the inertia it was given in
+        stepper_init(). The *max_speed* (a number, or a dict by stepper number) limits the speed
+        of each axis, in nanosteps per 100 µs as in stepper_move().
+        """
+        self.rp = rp
+        self.inertia = dict(inertia)
+        self.steppers = sorted(self.inertia)
+        if not isinstance(max_speed, dict):
+            max_speed = {m: max_speed for m in self.steppers}
+        self.max_speed = max_speed
+        self.endswitch_sensitive_down = endswitch_sensitive_down
+
+    def plan(self, path, start):
+        """
+        Converts the *path*, a list of {stepper_number: nanopos} waypoints, into a list of
+        Segments. Axes missing in a waypoint keep their previous position. The *start* dict
+        gives the initial positions.
+        """
+        segments, pos = [], dict(start)
+        for waypoint in path:
+            distances = {m: abs(waypoint.get(m, pos[m]) - pos[m]) for m in self.steppers}
+            cycles = max(move_cycles(distances[m], self.max_speed[m], self.inertia[m]) for m in self.steppers)
+            speeds = {m: speed_for_cycles(distances[m], cycles, self.max_speed[m], self.inertia[m])
+                    for m in self.steppers if distances[m]}
+            pos.update({m: waypoint.get(m, pos[m]) for m in self.steppers})
+            segments.append(Segment(targets={m: pos[m] for m in speeds}, speeds=speeds,
+                    duration_us=cycles * UPDATE_PERIOD_US))
+        return segments
+
+    def run(self, path, start=None):
+        """
+        Moves the steppers along the *path*. Returns a list of concurrent.futures.Future, one
+        per segment, each resolving to a dict of stepper_move reports by stepper number.
+
+        If an endswitch stops any axis, the corresponding future raises RuntimeError and all
+        following segments are cancelled.
+        """
+        if start is None:
+            start = {m: self.rp.stepper_status(m).nanopos for m in self.steppers}
+        segments = self.plan(path, start)
+        futures = [concurrent.futures.Future() for _ in segments]
+        state = {'index': -1, 'reports': {}}
+        lock = threading.Lock()
+
+        def start_next_segment():
+            while True:
+                state['index'] += 1
+                state['reports'] = {}
+                if state['index'] >= len(segments):
+                    return
+                segment = segments[state['index']]
+                if not futures[state['index']].set_running_or_notify_cancel():  # cancelled by user
+                    for f in futures[state['index']+1:]:
+                        f.cancel()
+                    state['index'] = len(segments)
+                    return
+                if segment.speeds:
+                    break
+                futures[state['index']].set_result({})  # no axis moves in this segment
+            for m, speed in segment.speeds.items():
+                self.rp.stepper_move(m, to=segment.targets[m], speed=speed,
+                        endswitch_sensitive_down=self.endswitch_sensitive_down, _callback=stepper_cb)
+
+        def stepper_cb(report):
+            with lock:
+                if state['index'] >= len(segments):  # the path was already aborted
+                    return
+                state['reports'][report.stepper_number] = report
+                future = futures[state['index']]
+                if report.endswitch_triggered:
+                    future.set_exception(RuntimeError(
+                            f"Stepper {report.stepper_number} stopped at endswitch, nanopos={report.nanopos}"))
+                    for f in futures[state['index']+1:]:
+                        f.cancel()
+                    state['index'] = len(segments)
+                    return
+                if len(state['reports']) == len(segments[state['index']].speeds):
+                    future.set_result(state['reports'])
+                    start_next_segment()
+
+        with lock:
+            start_next_segment()
+        return futures
+
+    def estimate_duration_us(self, path, start):
+        """ Total estimated time of moving along the path, excluding the USB latencies. """
+        return sum(s.duration_us for s in self.plan(path, start))
+
+
+
+if __name__ == "__main__":
+    # Self-check of the model (does not need any device): the fast-forwarded estimate must match
+    # the cycle-by-cycle simulation, and grouped axes must arrive within a few cycles
+    import time
+    for distance, speed, inertia in [(0, 64, 190), (1000, 64, 190), (123456, 64, 190),
+            (31500000, 260, 190), (819200, 10000, 30), (500000, 1, 1)]:
+        t0 = time.time()
+        exact = move_cycles(distance, speed, inertia, fast_forward=False)
+        t1 = time.time()
+        fast = move_cycles(distance, speed, inertia)
+        t2 = time.time()
+        print(f"distance={distance:9d} speed={speed:5d} inertia={inertia:3d}: {exact:7d} cycles " +
+                f"({t1-t0:.4f} s), fast-forwarded {fast:7d} cycles ({t2-t1:.5f} s)")
+        assert exact == fast
+
+    planner = MotionPlanner(None, inertia={0: 190, 1: 190}, max_speed=64)
+    pos = {0: 0, 1: 0}
+    for s in planner.plan([{0: 3*200000, 1: 2*200000}, {0: 2*200000, 1: 5*200000}, {0: 0, 1: 0}], pos):
+        arrival = {m: move_cycles(s.targets[m] - pos[m], s.speeds[m], 190) for m in s.speeds}
+        pos.update(s.targets)
+        print(f"segment to {s.targets} with speeds {s.speeds}: {s.duration_us/1e6:.3f} s, " +
+                f"arrival in cycles {arrival}")
+        assert max(arrival.values()) - min(arrival.values()) < s.duration_us / UPDATE_PERIOD_US * .05
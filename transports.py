@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+"""
+Ways of exchanging bytes with the device, selected by Rp2daq(transport=...).
+
+Each transport gives Rp2daq three queues: the report queue of byte chunks coming from the
+device, the command queue (usb_backend_process.CommandLanes) of messages to the device, and the
+terminate queue for the handshake on quit(). The transports are:
+
+    "process"       (default) The USB port is served by a separate process (see
+                    usb_backend_process.py), so that a CPU-heavy script can not stall the reception.
+    "thread"        The USB port is served by threads of the script process. This saves two
+                    process hops on each command and its report, which suits control loops; but
+                    a script holding the GIL for long may delay fast data streams.
+    "tcp://host:port", "unix:///path"
+                    A device shared by rp2daq_bridge.py.
+    "replay:///path/to/file"
+                    Plays back the reports recorded earlier, as replies to the same commands.
+    "emulator"      A simulated device on a pseudo-terminal (see device_emulator.py), POSIX only.
+
+The transport objects give more options, e.g. a fixed serial port instead of searching for the
+device, or recording the session for a later replay:
+
+    rp = rp2daq.Rp2daq(transport=transports.UsbThread(port="/dev/ttyACM0", record_to="session.rec"))
+
+The round-trip latency of the transports is compared by
+    python transports.py --benchmark            (add --device for a real device, too)
+"""
+
+import argparse
+import logging
+import multiprocessing
+import queue
+import struct
+import threading
+import time
+
+import usb_backend_process
+
+
+
+class Transport():
+    usb = False     # found by Rp2daq_internals._find_device; provides USB stats and can reconnect
+    shared = False  # a device shared by rp2daq_bridge.py, which accepts its subscribe messages
+
+    def __init__(self, record_to=None):
+        """ With *record_to*, all commands and reports are saved into this file, see Replay """
+        self.recorder = Recorder(record_to) if record_to else None
+
+    def open(self):
+        """ Returns the report, command and terminate queues (for the transports other than USB) """
+        raise NotImplementedError
+
+    def close(self):
+        if self.recorder:
+            self.recorder.close()
+
+    def _recorded(self, report_queue=None, command_queue=None):
+        """ Wraps the queues so that the bytes passing through them are recorded """
+        if self.recorder and report_queue is not None:
+            report_queue = _RecordedReports(report_queue, self.recorder)
+        if self.recorder and command_queue is not None:
+            command_queue = _RecordedCommands(command_queue, self.recorder)
+        return report_queue, command_queue
+
+
+
+class UsbProcess(Transport):
+    usb = True
+
+    def __init__(self, port=None, record_to=None):
+        """ Serves the device in a separate process. The serial *port* (like "/dev/ttyACM0" or
+        "COM3") is by default searched for among the USB devices. """
+        super().__init__(record_to=record_to)
+        self.port = port
+
+    def command_lanes(self):
+        return self._recorded(command_queue=usb_backend_process.CommandLanes())[1]
+
+    def start_backend(self, command_queue, port_name, stats, trace):
+        """ Starts serving the port; returns the report and terminate queues and the backend (to be joined) """
+        # New queues for each backend process, as one that died may have left their locks acquired
+        report_queue, terminate_queue = multiprocessing.Queue(), multiprocessing.Queue()
+
+        # Establish reliable USB connection using a child process, patching the multiprocessing.Process
+        # class so that user scripts are no more required to contain the __name__=='__main__' guard clause.
+        backend = usb_backend_process.PatchedProcess(
+                target=usb_backend_process.usb_backend,
+                args=(report_queue, getattr(command_queue, 'lanes', command_queue), terminate_queue, port_name, stats),
+                kwargs={'trace': trace})
+        backend.daemon = True
+        backend.start()
+        return self._recorded(report_queue=report_queue)[0], terminate_queue, backend
+
+
+
+class UsbThread(UsbProcess):
+    """ Serves the device by threads of this process, running the same usb_backend() """
+    def command_lanes(self):
+        return self._recorded(command_queue=usb_backend_process.CommandLanes(queue.Queue, threading.Semaphore))[1]
+
+    def start_backend(self, command_queue, port_name, stats, trace):
+        report_queue, requests, replies = queue.Queue(), queue.Queue(), queue.Queue()
+        backend = threading.Thread(target=usb_backend_process.usb_backend, daemon=True,
+                args=(report_queue, getattr(command_queue, 'lanes', command_queue), _TerminateLink(replies, requests),
+                    port_name, stats),
+                kwargs={'trace': trace})
+        backend.start()
+        return self._recorded(report_queue=report_queue)[0], _TerminateLink(requests, replies), backend
+
+
+
+class _TerminateLink():
+    """ One end of the quit() handshake between threads; a single queue would return the request to its sender """
+    def __init__(self, outgoing, incoming):
+        self.outgoing, self.incoming = outgoing, incoming
+
+    def put(self, item, *args, **kwargs):
+        self.outgoing.put(item)
+
+    def get(self, *args, **kwargs):
+        return self.incoming.get(*args, **kwargs)
+
+
+
+class Bridge(Transport):
+    shared = True
+
+    def __init__(self, address, record_to=None):
+        """ Connects to rp2daq_bridge.py serving at *address* like "tcp://127.0.0.1:7777" """
+        super().__init__(record_to=record_to)
+        self.address = address
+
+    def open(self):
+        import rp2daq_bridge
+        report_queue, command_queue, terminate_queue = rp2daq_bridge.connect(self.address)
+        return (*self._recorded(report_queue, command_queue), terminate_queue)
+
+
+
+class Emulator(UsbThread):
+    def __init__(self, record_to=None, **emulator_kwargs):
+        """ Starts a device_emulator.DeviceEmulator, served like a USB device by threads """
+        import device_emulator
+        self.emulator = device_emulator.DeviceEmulator(**emulator_kwargs)
+        super().__init__(port=self.emulator.port, record_to=record_to)
+
+    def close(self):
+        super().close()
+        self.emulator.close()
+
+
+
+## Recording and replay
+
+HOST, DEVICE = b'>', b'<'   # direction of the recorded bytes
+RECORDING_MAGIC = b'rp2daq recording 1\n'
+RECORD_HEADER = struct.Struct('<cdI')   # direction, seconds since the start, byte count
+
+
+
+class Recorder():
+    def __init__(self, filename):
+        self.file = open(filename, 'wb')
+        self.file.write(RECORDING_MAGIC)
+        self.lock = threading.Lock()
+        self.t0 = time.perf_counter()
+
+    def write(self, direction, data):
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(RECORD_HEADER.pack(direction, time.perf_counter() - self.t0, len(data)) + bytes(data))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+
+def read_recording(filename):
+    """ Returns the recorded (direction, time, bytes) tuples """
+    with open(filename, 'rb') as f:
+        if f.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+            raise ValueError(f"{filename} is not an rp2daq recording")
+        records = []
+        while header := f.read(RECORD_HEADER.size):
+            direction, t, length = RECORD_HEADER.unpack(header)
+            records.append((direction, t, f.read(length)))
+        return records
+
+
+
+class _RecordedReports():
+    def __init__(self, report_queue, recorder):
+        self.report_queue, self.recorder = report_queue, recorder
+
+    def get(self, *args, **kwargs):
+        chunk = self.report_queue.get(*args, **kwargs)
+        if chunk is not None:   # (None only marks a backend restart)
+            self.recorder.write(DEVICE, chunk)
+        return chunk
+
+    def put(self, *args, **kwargs):
+        self.report_queue.put(*args, **kwargs)
+
+
+
+class _RecordedCommands():
+    def __init__(self, lanes, recorder):
+        self.lanes, self.recorder = lanes, recorder
+
+    def put(self, message, urgent=False):
+        self.recorder.write(HOST, message)
+        self.lanes.put(message, urgent=urgent)
+
+    def get(self, block=True):
+        return self.lanes.get(block)
+
+    def drain(self, timeout=0.):
+        return self.lanes.drain(timeout)
+
+
+
+class Replay(Transport):
+    def __init__(self, filename, speed=None):
+        """
+        Plays back a recording: each command releases the reports which followed the same
+        command in the recording. With *speed* None they come at once, otherwise with the
+        recorded delays divided by *speed*. The commands should be the same as recorded;
+        differing ones are logged, but the playback goes on in the recorded order.
+        """
+        super().__init__()
+        self.filename, self.speed = filename, speed
+
+    def open(self):
+        self.records = read_recording(self.filename)
+        self.position = 0
+        self.lock = threading.Lock()
+        self.report_queue, self.scheduled = queue.Queue(), queue.Queue()
+        threading.Thread(target=self._feeder, daemon=True).start()
+        self._release(None)     # the reports that came before the first command
+        return self.report_queue, self, queue.Queue()
+
+    def put(self, message, urgent=False):
+        """ Takes a command, like CommandLanes.put() """
+        with self.lock:
+            while self.position < len(self.records) and self.records[self.position][0] != HOST:
+                self.position += 1  # (reports not released before, when commands differ)
+            if self.position == len(self.records):
+                logging.warning("Replay: the recording is over, command ignored")
+                return
+            direction, t, recorded = self.records[self.position]
+            if recorded != message:
+                logging.warning(f"Replay: command {message[:16]} differs from the recorded {recorded[:16]}")
+            self.position += 1
+            self._release(t)
+
+    def _release(self, command_time):
+        now = time.perf_counter()
+        while self.position < len(self.records) and self.records[self.position][0] == DEVICE:
+            direction, t, chunk = self.records[self.position]
+            if self.speed is None or command_time is None:
+                self.scheduled.put((0, chunk))
+            else:
+                self.scheduled.put((now + (t - command_time) / self.speed, chunk))
+            self.position += 1
+
+    def _feeder(self):
+        while True:
+            due, chunk = self.scheduled.get()
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.report_queue.put(chunk)
+
+
+
+def get(transport):
+    """ Returns the Transport object for a string like "thread" (or passes a Transport through) """
+    if isinstance(transport, Transport):
+        return transport
+    if transport in (None, 'process', 'usb'):
+        return UsbProcess()
+    if transport == 'thread':
+        return UsbThread()
+    if transport == 'emulator':
+        return Emulator()
+    if transport.startswith(('tcp://', 'unix://')):
+        return Bridge(transport)
+    if transport.startswith('replay://'):
+        return Replay(transport[len('replay://'):])
+    raise ValueError(f"Unknown transport {transport}, see transports.py")
+
+
+
+def benchmark(transports, round_trips=2000):
+    """ Measures the round trip of blocking ping() commands on each of the (name, transport) pairs """
+    import rp2daq
+    for name, transport in transports:
+        rp = rp2daq.Rp2daq(transport=transport)
+        for x in range(50):     # warm-up
+            rp.ping()
+        latencies = []
+        for x in range(round_trips):
+            t0 = time.perf_counter()
+            rp.ping(tag=x)
+            latencies.append(time.perf_counter() - t0)
+        rp.quit()
+        transport.close()
+        latencies.sort()
+        print(f"{name:28s} ping round trip median {latencies[len(latencies)//2]*1e3:6.3f} ms, " +
+                f"99th percentile {latencies[len(latencies)*99//100]*1e3:6.3f} ms")
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the round-trip latency of the transports.")
+    parser.add_argument('--benchmark', action='store_true', help="Run the benchmark")
+    parser.add_argument('--device', action='store_true', help="Also measure a real device connected on USB")
+    parser.add_argument('--round-trips', type=int, default=2000)
+    args = parser.parse_args()
+    if not args.benchmark:
+        parser.print_help()
+        raise SystemExit
+
+    import os
+    import tempfile
+    import device_emulator
+    import transports   # (the classes of this module, not of __main__, are recognized by rp2daq)
+    logging.basicConfig(level=logging.WARNING)
+
+    # The emulator runs in this process, so it competes for the GIL with the thread transport;
+    # on a real device, the difference between the transports is larger
+    recording = os.path.join(tempfile.gettempdir(), "rp2daq_benchmark.rec")
+    emulator = device_emulator.DeviceEmulator()
+    benchmark([("process + emulator", transports.UsbProcess(port=emulator.port)),
+            ("thread + emulator", transports.UsbThread(port=emulator.port, record_to=recording))], args.round_trips)
+    benchmark([("replay of the thread session", transports.Replay(recording))], args.round_trips)
+    emulator.close()
+    if args.device:
+        benchmark([("process + USB device", transports.UsbProcess()), ("thread + USB device", transports.UsbThread())],
+                args.round_trips)
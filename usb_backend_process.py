@@ -26,7 +26,110 @@ import serial
 import threading
 import time
 
-def usb_backend(report_queue, command_queue, terminate_queue, port_name): 
+import pipeline_trace
+
+
+# Statistics of the receiving loop, shared with the main process as a multiprocessing.Array
+USB_STATS_FIELDS = ['reads', 'bytes', 'max_chunk_bytes', 'byte_rate', 'coalesce_delay_s', 'added_latency_s']
+
+
+
+class CommandLanes():
+    """
+    Queue of commands to be sent to the device, with a separate lane for urgent commands 
+    (like adc_stop), which overtake all bulk commands still waiting. Works between processes 
+    by default; with queue.Queue and threading.Semaphore given, between threads.
+    """
+    def __init__(self, queue_class=mp.Queue, semaphore_class=mp.Semaphore):
+        self.bulk, self.urgent = queue_class(), queue_class()
+        self.urgent_pending = semaphore_class(0)
+
+    def put(self, out_bytes, urgent=False):
+        if urgent:
+            self.urgent.put(out_bytes)
+            self.urgent_pending.release()
+            self.bulk.put(b'')  # wakes up get() if it waits for bulk commands
+        else:
+            self.bulk.put(out_bytes)
+
+    def get(self, block=True):
+        """ Returns the next command to be sent; any urgent ones first. None stops the reader. """
+        while True:
+            if self.urgent_pending.acquire(False):
+                return self.urgent.get()    # surely comes, if not already there
+            out_bytes = self.bulk.get(block)
+            if out_bytes or out_bytes is None:
+                return out_bytes
+
+    def drain(self, timeout=0.):
+        """ Removes all waiting commands; returns them as (out_bytes, urgent) pairs, the urgent ones first """
+        drained = []
+        while self.urgent_pending.acquire(False):
+            drained.append((self.urgent.get(), True))
+        while True:
+            try:
+                out_bytes = self.bulk.get(timeout=timeout)
+            except queue.Empty:
+                return drained
+            if out_bytes:
+                drained.append((out_bytes, False))
+
+
+
+class AdaptiveReadPolicy():
+    """
+    Decides how long the receiving loop waits after a read before reading again.
+
+    When data come slowly, each read is forwarded immediately (a blocking read waits for the
+    first byte), so that small reports are not delayed. When they come fast, waiting lets
+    more bytes coalesce into one chunk, which saves the per-chunk overhead of the queue and of
+    report parsing in the main process. The wait is chosen to collect about *chunk_target*
+    bytes at the observed byte rate, but never longer than *latency_target_s*. Below the rate
+    which would fill *min_chunk* bytes within the latency target, no waiting is done at all.
+
+    Waiting does not help if the data stop meanwhile, typically when each report is a reply
+    to a command which the user script sends only after getting the previous reply. If a wait
+    brings less than a quarter of the expected bytes, the waiting is suspended for a number of
+    reads, which doubles with each such miss (and is reset by a successful wait).
+    """
+    def __init__(self, latency_target_s=0.002, chunk_target=16384, min_chunk=256, rate_smoothing=0.1):
+        self.latency_target_s, self.chunk_target, self.min_chunk = latency_target_s, chunk_target, min_chunk
+        self.rate_smoothing = rate_smoothing
+        self.byte_rate, self.last_time = 0., None
+        self.last_delay, self.suspended_reads, self.suspend_length = 0., 0, 1
+
+    def delay(self, chunk_bytes, now):
+        """ Updates the byte rate estimate with a chunk just read, returns the time to wait """
+        if self.last_time is not None and now > self.last_time:
+            rate = chunk_bytes / (now - self.last_time)
+            if self.last_delay:     # did the wait pay off?
+                if chunk_bytes < 0.25 * self.byte_rate * self.last_delay:
+                    self.suspended_reads, self.suspend_length = self.suspend_length, min(self.suspend_length * 2, 4096)
+                else:
+                    self.suspend_length = 1
+            self.byte_rate += self.rate_smoothing * (rate - self.byte_rate)
+        self.last_time = now
+
+        self.last_delay = 0.
+        if self.suspended_reads:
+            self.suspended_reads -= 1
+        elif self.byte_rate * self.latency_target_s >= self.min_chunk:
+            self.last_delay = min(self.latency_target_s, self.chunk_target / self.byte_rate)
+        return self.last_delay
+
+
+
+class FixedReadPolicy():
+    """ The former behaviour: a constant delay, experimentally chosen per OS """
+    def __init__(self, rx_delay=0.002 if os.name == 'posix' else 0):
+        self.rx_delay, self.byte_rate = rx_delay, 0.
+
+    def delay(self, chunk_bytes, now):
+        return self.rx_delay
+
+
+
+def usb_backend(report_queue, command_queue, terminate_queue, port_name, stats=None, rx_policy=None, trace=None): 
     """
     Default Python interpreter has a Global Interpreter Lock, due to which a high CPU load 
     in the user script can halt USB data reception, leading to USB buffer overflow and 
@@ -35,14 +138,23 @@ def usb_backend(report_queue, command_queue, terminate_queue, port_name):
 
     Relegating the raw data handling to this separate process resolves the problem with GIL. 
     To keep the communication fluent without a tight busy loop in this process, USB input and 
-    output are further separated into two threads here. 
+    output are further separated into two threads here. The *command_queue* is expected to be 
+    CommandLanes, or any queue of bytes to be sent.
 
+    The optional *stats* is a shared array of USB_STATS_FIELDS values, updated on each read.
+    The optional *trace* is a pipeline_trace.BackendTrace recording the reads and waits.
     """
 
     def _raw_byte_output_thread():
         while port.is_open:
             out_bytes = command_queue.get(block=True)
-            port.write(out_bytes)
+            if out_bytes is None:   # this backend ends, see below
+                return
+            try:
+                port.write(out_bytes)
+            except (OSError, TypeError, AttributeError):   # port closed meanwhile, see below
+                command_queue.put(out_bytes)    # not lost; a reconnect passes it to the next backend
+                return
 
 
     def _terminate_thread():
@@ -52,13 +164,16 @@ def usb_backend(report_queue, command_queue, terminate_queue, port_name):
 
 
     # Observation from stress-tests: on Linux, rp2daq.py handles more data with few-ms delay within 
-    # receiver loop, while Windows10 seems better without it 
+    # receiver loop, while Windows10 seems better without it; the adaptive policy only delays the 
+    # reads when the data come fast enough to profit from it
     # Warning: current implementation may silently lose ADC packets when they come too often >400/s 
     # (https://github.com/FilipDominec/rp2daq/issues/23)
     # see also https://github.com/hathach/tinyusb/discussions/2805 for speed optim
-    rx_delay = 0.002 if os.name == 'posix' else 0 
+    if rx_policy is None:
+        rx_policy = AdaptiveReadPolicy(latency_target_s=0.002 if os.name == 'posix' else 0.0005)
 
     terminate_pending = threading.Event()
+    raw_byte_output_thread = None
     try: 
         port = serial.Serial(port=port_name.device, timeout=None)
 
@@ -67,21 +182,124 @@ def usb_backend(report_queue, command_queue, terminate_queue, port_name):
         raw_byte_output_thread.start()
         control_thread.start()
 
+        reads, total_bytes, max_chunk, added_latency = 0, 0, 0, 0.
         while True:
-            in_bytes = port.read(max(1, port.in_waiting))
+            read_ns = time.perf_counter_ns() if trace else 0
+            in_bytes = port.read(max(1, port.in_waiting))   # blocks until at least one byte comes
+            if port.in_waiting:     # the rest of a report that arrived during the blocking read
+                in_bytes += port.read(port.in_waiting)
             report_queue.put(in_bytes)
+            if trace:
+                trace.record(pipeline_trace.USB_READ, read_ns, time.perf_counter_ns(), len(in_bytes))
+            rx_delay = rx_policy.delay(len(in_bytes), time.monotonic())
+            if stats is not None:
+                reads, total_bytes, max_chunk = reads + 1, total_bytes + len(in_bytes), max(max_chunk, len(in_bytes))
+                added_latency += rx_delay
+                stats[:] = [reads, total_bytes, max_chunk, rx_policy.byte_rate, rx_delay, added_latency]
             if rx_delay:
-                # Slight delay experimentally determined to *improve* performance on Linux: 
                 # the rx queue does not fill with unduly short byte chunks (todo: even better 
                 # would be parsing whole reports here) 
+                wait_ns = time.perf_counter_ns() if trace else 0
                 time.sleep(rx_delay) 
+                if trace:
+                    trace.record(pipeline_trace.COALESCE, wait_ns, time.perf_counter_ns(), 0)
     except (OSError, TypeError, AttributeError) as e:  # diferent OSes seem to report different errors?
-        # (todo) Should try reconnecting? 
+        # Reconnecting is up to the main process, see Rp2daq(reconnect_timeout_s=...)
         # (todo) Should somehow send termination message to the main process? 
         if terminate_pending.is_set():
             logging.info("Device successfully disconnected")
         else: 
             logging.error("Device unexpectedly disconnected! Check your cabling and restart the program.")
+        if raw_byte_output_thread:
+            # Wake the output thread, so that it does not leave a command queue lock acquired 
+            # when the process ends; the commands left are taken over after a reconnect
+            command_queue.put(None)
+            raw_byte_output_thread.join()
         del(port)
         terminate_queue.put(b'2')   # report back to main process we are done here
 
+
+
+if __name__ == "__main__":
+    # Benchmark of the read policies on a pseudo-terminal fed with timestamped packets: as replies
+    # to blocking commands sent one after another, slowly (like occasional reports) and fast (like
+    # a 750 kB/s ADC stream); needs POSIX
+    import struct
+    import types
+
+    def run(policy, packet_bytes, packets_per_s, duration_s=2.):
+        master, slave = os.openpty()
+        import tty
+        tty.setraw(slave)
+        report_queue, command_queue, terminate_queue = queue.Queue(), queue.Queue(), queue.Queue()
+        stats = [0.] * len(USB_STATS_FIELDS)
+        threading.Thread(target=usb_backend, daemon=True, args=(report_queue, command_queue, terminate_queue,
+                types.SimpleNamespace(device=os.ttyname(slave)), stats, policy)).start()
+        time.sleep(.2)
+
+        received = threading.Semaphore(1)
+        def writer():
+            t0, n = time.monotonic(), 0
+            while time.monotonic() - t0 < duration_s:
+                if not packets_per_s:   # round trips: next reply only after the previous one was received
+                    received.acquire()
+                os.write(master, struct.pack('<d', time.monotonic()) + bytes(packet_bytes - 8))
+                n += 1
+                if packets_per_s:
+                    time.sleep(max(0, t0 + n / packets_per_s - time.monotonic()))
+        threading.Thread(target=writer, daemon=True).start()
+
+        buf, latencies, chunks = b'', [], 0
+        t_end = time.monotonic() + duration_s + .2
+        while time.monotonic() < t_end:
+            try:
+                chunk = report_queue.get(timeout=.1)
+            except queue.Empty:
+                continue
+            now, chunks, buf = time.monotonic(), chunks + 1, buf + chunk
+            while len(buf) >= packet_bytes:
+                latencies.append(now - struct.unpack('<d', buf[:8])[0])
+                buf = buf[packet_bytes:]
+                received.release()
+        terminate_queue.put(b'1')
+        latencies.sort()
+        return latencies[len(latencies)//2], stats
+
+    for name, packet_bytes, rate in (('round trips', 16, None), ('slow reports', 16, 50), ('100 reports/s', 100, 100), ('ADC stream', 600, 1250)):
+        for policy in (FixedReadPolicy(0.002), FixedReadPolicy(0), AdaptiveReadPolicy()):
+            median_latency, stats = run(policy, packet_bytes, rate)
+            stats = dict(zip(USB_STATS_FIELDS, stats))
+            print(f"{name:13s} {type(policy).__name__:19s} delay={getattr(policy, 'rx_delay', 'auto')!s:5s}: " + 
+                    f"median latency {median_latency*1e3:6.3f} ms, {stats['reads']:6.0f} reads, " + 
+                    f"mean chunk {stats['bytes']/max(stats['reads'],1):7.0f} B")
+
+    # Time from putting a command to its arrival at the device, when 2000 bulk commands of 100 B
+    # wait before it and the device takes 200 kB/s (the bytes already in the pty buffer can not
+    # be overtaken)
+    def run_lanes(urgent):
+        master, slave = os.openpty()
+        import tty
+        tty.setraw(slave)
+        lanes, report_queue, terminate_queue = CommandLanes(), mp.Queue(), mp.Queue()
+        process = PatchedProcess(target=usb_backend, daemon=True, args=(report_queue, lanes, terminate_queue,
+                types.SimpleNamespace(device=os.ttyname(slave))))
+        process.start()
+        time.sleep(.5)
+        for i in range(2000):
+            lanes.put(b'\x00' * 100)
+        time.sleep(.05)
+        t0 = time.monotonic()
+        lanes.put(b'\xff' * 8, urgent=urgent)
+        while True:
+            chunk = os.read(master, 200)
+            if b'\xff' in chunk:
+                dt = time.monotonic() - t0
+                break
+            time.sleep(.001)
+        terminate_queue.put(b'1')
+        process.join(2)
+        lanes.bulk.cancel_join_thread()     # the rest of bulk commands will never be sent
+        return dt
+
+    for urgent in (False, True):
+        print(f"Command {'with' if urgent else 'without'} _urgent behind loaded queue arrived in {run_lanes(urgent)*1e3:.1f} ms")